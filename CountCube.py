@@ -0,0 +1,247 @@
+import numpy as np
+from collections import defaultdict
+from myutils import querytypes
+
+# query_type of each index in the query type arrays
+qtype_index = dict((qtype, i) for i, qtype in enumerate(querytypes))
+
+
+def hour_to_buckets(hours, period):
+    """
+    Returns the @period buckets (see myutils.periods) of @hours, an array
+    of hour buckets
+    """
+
+    if period == 'hour':
+        return hours
+    if period == 'day':
+        return hours // 24
+    if period == 'week':
+        return (hours // 24 + 3) // 7
+    if period == 'month':
+        return hours.astype('M8[h]').astype('M8[M]').astype(np.int64) + 1970 * 12
+    if period == 'year':
+        return hours.astype('M8[h]').astype('M8[Y]').astype(np.int64) + 1970
+    raise ValueError("Unknown period " + period)
+
+
+def group_sum(keys, counts):
+    """
+    Returns the distinct values of @keys and the sum of @counts for each
+    """
+    distinct, inverse = np.unique(keys, return_inverse=True)
+    return distinct, np.bincount(inverse, weights=counts, minlength=len(distinct)).astype(np.int64)
+
+
+def select_mask(n, columns):
+    """
+    Returns the boolean mask of the @n rows whose values are in the given
+    sets. @columns is a list of (array, values); values of None select
+    every row
+    """
+
+    mask = np.ones(n, dtype=bool)
+    for array, values in columns:
+        if values is not None:
+            mask &= np.in1d(array, np.fromiter(values, dtype=np.int64))
+    return mask
+
+
+class CountCube:
+    """
+    The number of rows of a reduced table (or of what hourly_counts counts
+    of it) in each hour, for each user and query type: a sparse cube
+    kept as equal-length arrays of userids, hour buckets, query type
+    indexes (into myutils.querytypes) and counts, one entry per nonzero
+    cell.
+
+    Coarser periods, and subsets of the users, query types and hours, are
+    summed from these arrays in memory (select() and profiles()), so they
+    don't need the table again.
+    """
+
+    def __init__(self, userids, hours, qtypes, counts):
+        self.userids = userids
+        self.hours = hours
+        self.qtypes = qtypes
+        self.counts = counts
+
+    @staticmethod
+    def from_rows(rows):
+        """
+        Make a CountCube from @rows of (userid, hour bucket, query_type,
+        count)
+        """
+
+        rows = list(rows)
+        return CountCube(np.array([row[0] for row in rows], dtype=np.int64),
+                         np.array([row[1] for row in rows], dtype=np.int64),
+                         np.array([qtype_index[row[2]] for row in rows], dtype=np.int64),
+                         np.array([row[3] for row in rows], dtype=np.int64))
+
+    def select(self, users=None, query_types=None, hours=None):
+        """
+        Returns the CountCube of the @users (userids) and @query_types, in
+        the hour buckets from @hours[0] up to, not including, @hours[1].
+        None selects all of them
+        """
+
+        mask = select_mask(len(self.counts),
+                           [(self.userids, users),
+                            (self.qtypes, query_types and [qtype_index[q] for q in query_types])])
+        if hours is not None:
+            mask &= (self.hours >= hours[0]) & (self.hours < hours[1])
+        return CountCube(self.userids[mask], self.hours[mask], self.qtypes[mask], self.counts[mask])
+
+    def profiles(self, period, usernames):
+        """
+        Returns peruser_divided, peruser_alltime, full_divided and
+        full_alltime (see Filter.query_profile()) by @period, with users
+        named by @usernames, a dict of userid to name
+        """
+
+        nq = len(querytypes)
+        buckets = hour_to_buckets(self.hours, period)
+
+        peruser_divided = defaultdict(dict)
+        peruser_alltime = dict()
+        full_divided = dict()
+        full_alltime = defaultdict(int)
+
+        # Cells of (user, bucket, query type), and their sums
+        users, user_index = np.unique(self.userids, return_inverse=True)
+        times, time_index = np.unique(buckets, return_inverse=True)
+        keys, sums = group_sum((user_index * len(times) + time_index) * nq + self.qtypes, self.counts)
+        for key, count in zip(keys.tolist(), sums.tolist()):
+            rest, qtype = divmod(key, nq)
+            user, time = divmod(rest, len(times))
+            user_times = peruser_divided[usernames[users[user]]]
+            time = int(times[time])
+            if time not in user_times:
+                user_times[time] = defaultdict(int)
+            user_times[time][querytypes[qtype]] = count
+
+        keys, sums = group_sum(user_index * nq + self.qtypes, self.counts)
+        for key, count in zip(keys.tolist(), sums.tolist()):
+            user, qtype = divmod(key, nq)
+            user = usernames[users[user]]
+            if user not in peruser_alltime:
+                peruser_alltime[user] = defaultdict(int)
+            peruser_alltime[user][querytypes[qtype]] = count
+
+        keys, sums = group_sum(time_index * nq + self.qtypes, self.counts)
+        for key, count in zip(keys.tolist(), sums.tolist()):
+            time, qtype = divmod(key, nq)
+            time = int(times[time])
+            if time not in full_divided:
+                full_divided[time] = defaultdict(int)
+            full_divided[time][querytypes[qtype]] = count
+            full_alltime[querytypes[qtype]] += count
+
+        # sorted by time, as (ordered) lists of tuples
+        full_divided = sorted(full_divided.iteritems())
+        for user in peruser_divided.keys():
+            peruser_divided[user] = sorted(peruser_divided[user].iteritems())
+
+        return peruser_divided, peruser_alltime, full_divided, full_alltime
+
+
+class QueryCounts:
+    """
+    The number of rows of a reduced table for each (userid, queryid, vals),
+    with the query type of each, as arrays like CountCube's. vals are kept
+    as indexes into self.vals. The top queries of any subset of users and
+    query types are summed from these in memory (select() and top())
+    """
+
+    def __init__(self, userids, queryids, qtypes, valids, counts, vals):
+        self.userids = userids
+        self.queryids = queryids
+        self.qtypes = qtypes
+        self.valids = valids
+        self.counts = counts
+        self.vals = vals
+
+    @staticmethod
+    def from_rows(rows):
+        """
+        Make a QueryCounts from @rows of (userid, queryid, query_type,
+        vals, count)
+        """
+
+        userids, queryids, qtypes, valids, counts = [], [], [], [], []
+        vals_index = {}
+        vals = []
+        for userid, queryid, query_type, v, count in rows:
+            valid = vals_index.get(v)
+            if valid is None:
+                valid = vals_index[v] = len(vals)
+                vals.append(v)
+            userids.append(userid)
+            queryids.append(queryid)
+            qtypes.append(qtype_index[query_type])
+            valids.append(valid)
+            counts.append(count)
+        return QueryCounts(np.array(userids, dtype=np.int64), np.array(queryids, dtype=np.int64),
+                           np.array(qtypes, dtype=np.int64), np.array(valids, dtype=np.int64),
+                           np.array(counts, dtype=np.int64), vals)
+
+    def select(self, users=None, query_types=None):
+        """
+        Returns the QueryCounts of the @users (userids) and @query_types.
+        None selects all of them
+        """
+
+        mask = select_mask(len(self.counts),
+                           [(self.userids, users),
+                            (self.qtypes, query_types and [qtype_index[q] for q in query_types])])
+        return QueryCounts(self.userids[mask], self.queryids[mask], self.qtypes[mask],
+                           self.valids[mask], self.counts[mask], self.vals)
+
+    def top_queries(self, queryids, valids, counts, numtop):
+        """
+        Returns the @numtop queries with the most rows, from arrays of
+        (queryid, vals index, count) with one entry per (queryid, vals),
+        as Filter.top_queries() does
+        """
+
+        queries, query_index = np.unique(queryids, return_inverse=True)
+        totals = np.bincount(query_index, weights=counts, minlength=len(queries))
+        top = np.argsort(-totals, kind='mergesort')[:numtop]
+
+        # The entries of each top query, most rows first
+        rank = np.full(len(queries), -1, dtype=np.int64)
+        rank[top] = np.arange(len(top))
+        entries = np.flatnonzero(rank[query_index] >= 0)
+        entries = entries[np.lexsort((-counts[entries], rank[query_index[entries]]))]
+
+        topqueries = [(int(queries[i]), []) for i in top]
+        for entry in entries.tolist():
+            topqueries[rank[query_index[entry]]][1].append((self.vals[valids[entry]], int(counts[entry])))
+        return topqueries
+
+    def top(self, numtop, usernames):
+        """
+        Returns full_topqueries and peruser_topqueries (see
+        Filter.query_profile()), with queryids for the queries, and users
+        named by @usernames, a dict of userid to name
+        """
+
+        nv = len(self.vals)
+        keys, sums = group_sum(self.queryids * nv + self.valids, self.counts)
+        full_topqueries = self.top_queries(keys // nv, keys % nv, sums, numtop)
+
+        peruser_topqueries = []
+        order = np.argsort(self.userids, kind='mergesort')
+        users, starts = np.unique(self.userids[order], return_index=True)
+        ends = list(starts[1:]) + [len(order)]
+        for userid, start, end in zip(users.tolist(), starts.tolist(), ends):
+            entries = order[start:end]
+            peruser_topqueries.append((usernames[userid],
+                                       self.top_queries(self.queryids[entries], self.valids[entries],
+                                                        self.counts[entries], numtop)))
+        peruser_topqueries.sort(key = lambda x: sum( sum(ct for val, ct in valcts)
+                                                     for query, valcts in x[1] ),
+                                reverse = True)
+
+        return full_topqueries, peruser_topqueries
@@ -0,0 +1,185 @@
+import hashlib
+
+from myutils import parse_user_host
+
+# Name of the MySQL lock held while handing out new userids/serverids
+ID_LOCK = 'reduced_log_ids'
+
+# Longest user or server name the users and servers tables hold
+NAME_LEN = 255
+
+
+class DimensionCache:
+    """
+    The 'users', 'servers' and 'queries' tables of the reduced_log, looked
+    up through in-memory dicts. Used by the reducer to turn each row's
+    user_host and query template into ids, and by the tool to show user
+    and server names.
+
+    users and servers are small, so they are read in full up front:
+    self.users and self.servers map names to ids, self.user_names and
+    self.server_names map ids back to names. queries is only looked up as
+    needed.
+
+    @cur must not be streaming a result set, and is committed whenever new
+    ids are handed out.
+    """
+
+    def __init__(self, cur):
+        self.cur = cur
+        self.user_hosts = {}
+        self.queryids = {}
+        self.load()
+
+    def load(self):
+        """
+        (Re)read the users and servers tables
+        """
+
+        self.cur.execute("SELECT user, userid FROM users")
+        self.users = dict(self.cur.fetchall())
+        self.cur.execute("SELECT server, serverid FROM servers")
+        self.servers = dict(self.cur.fetchall())
+        self.user_names = dict((userid, user) for user, userid in self.users.iteritems())
+        self.server_names = dict((serverid, server) for server, serverid in self.servers.iteritems())
+
+    def ids(self, user_host):
+        """
+        Returns (userid, serverid) for @user_host, an entry from the
+        'user_host' column of the general_log, handing out new ids if
+        needed. There are only a few hundred distinct user_hosts, so each
+        is parsed only once
+        """
+
+        try:
+            return self.user_hosts[user_host]
+        except KeyError:
+            self.intern([user_host])
+            return self.user_hosts[user_host]
+
+    def intern(self, user_hosts):
+        """
+        Make sure all of @user_hosts have ids. The new users and servers
+        among them are all added at once, see allocate()
+        """
+
+        parsed = {}
+        for user_host in user_hosts:
+            if user_host in self.user_hosts:
+                continue
+            user_server = parse_user_host(user_host)
+            if not isinstance(user_server, tuple):
+                # Unparseable; keep (the start of) the whole string as the user name
+                user_server = user_host[:NAME_LEN], ''
+            parsed[user_host] = user_server
+
+        new_users = set(user for user, server in parsed.itervalues() if user not in self.users)
+        new_servers = set(server for user, server in parsed.itervalues() if server not in self.servers)
+        if new_users or new_servers:
+            self.allocate(new_users, new_servers)
+
+        for user_host, (user, server) in parsed.iteritems():
+            self.user_hosts[user_host] = self.users[user], self.servers[server]
+
+    def allocate(self, users, servers):
+        """
+        Give ids to the names in @users and @servers, inserting those that
+        aren't in the tables yet with the next free ids.
+
+        Several reducer processes may find the same new user at once, so the
+        lookup and the inserts are done under a MySQL named lock, and
+        committed before the lock is released. The unique keys on the names
+        (see create_reduced_log.create_schema()) make sure no name ever gets
+        two ids. Names are compared as binary strings, in the tables as in
+        the dicts, so names differing only in case get ids of their own.
+        """
+
+        cur = self.cur
+        cur.execute("SELECT GET_LOCK('{0}', 600)".format(ID_LOCK))
+        cur.fetchall()
+        try:
+            # End any open transaction so we see ids committed by other processes
+            cur.connection.commit()
+            for table, names, ids in (('users', users, self.users),
+                                      ('servers', servers, self.servers)):
+                if not names:
+                    continue
+                column = table[:-1] # 'users' -> 'user', 'servers' -> 'server'
+                names = sorted(names)
+
+                cur.execute("SELECT {0}, {0}id FROM {1} WHERE {0} IN ({2})".format(
+                    column, table, ', '.join(['%s'] * len(names))), names)
+                ids.update(cur.fetchall())
+
+                missing = [name for name in names if name not in ids]
+                if missing:
+                    cur.execute("SELECT COALESCE(MAX({0}id) + 1, 0) FROM {1}".format(column, table))
+                    nextid = cur.fetchall()[0][0]
+                    rows = [(name, nextid + i) for i, name in enumerate(missing)]
+                    cur.executemany("INSERT INTO {1} ({0}, {0}id) VALUES (%s, %s)".format(column, table),
+                                    rows)
+                    ids.update(rows)
+            cur.connection.commit()
+        finally:
+            cur.execute("SELECT RELEASE_LOCK('{0}')".format(ID_LOCK))
+            cur.fetchall()
+
+        self.user_names = dict((userid, user) for user, userid in self.users.iteritems())
+        self.server_names = dict((serverid, server) for server, serverid in self.servers.iteritems())
+
+    def queryid(self, query, query_type):
+        """
+        Return the queryid of @query (a template) in the queries table,
+        adding it if it isn't there yet.
+
+        queries has a unique key on the SHA1 of the text, so processes adding
+        the same template at once get the same queryid without a lock.
+        """
+
+        try:
+            return self.queryids[query]
+        except KeyError:
+            pass
+
+        cur = self.cur
+        query_hash = hashlib.sha1(query).digest()
+        cur.execute("SELECT queryid FROM queries WHERE query_hash = %s", (query_hash,))
+        rows = cur.fetchall()
+        if rows:
+            queryid = rows[0][0]
+        else:
+            cur.execute("""INSERT INTO queries (query_hash, query_type, query) VALUES (%s, %s, %s)
+                           ON DUPLICATE KEY UPDATE queryid = LAST_INSERT_ID(queryid)""",
+                        (query_hash, query_type, query))
+            queryid = cur.lastrowid
+            cur.connection.commit()
+
+        self.queryids[query] = queryid
+        return queryid
+
+
+class MemoryDimensions:
+    """
+    Hands out userids, serverids and queryids from dicts, like a
+    DimensionCache that already has every id, without a db. Used where
+    the reducer is run without writing anything: by the dry run of
+    create_reduced_log.py and by benchmark.py
+    """
+
+    def __init__(self):
+        self.user_hosts = {}
+        self.queryids = {}
+
+    def ids(self, user_host):
+        try:
+            return self.user_hosts[user_host]
+        except KeyError:
+            ids = self.user_hosts[user_host] = len(self.user_hosts), 0
+            return ids
+
+    def queryid(self, query, query_type):
+        try:
+            return self.queryids[query]
+        except KeyError:
+            queryid = self.queryids[query] = len(self.queryids)
+            return queryid
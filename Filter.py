@@ -1,8 +1,12 @@
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta
+import os
+import re
 import sys
 from collections import defaultdict
-from operator import itemgetter
-from myutils import querytypes, print_and_execute
+from myutils import querytypes, print_and_execute, hour_bucket_sql, epoch, config
+from MySQLdb.cursors import SSCursor
+from Sketch import SpaceSaving
+from CountCube import CountCube, QueryCounts
 
 order = querytypes
 
@@ -42,11 +46,58 @@ class Filter:
         self.negate = negate
 
 
-    # returns a sql query to select data matching this filter in @tablename
-    def sql(self, tablename, fields=['*']):
+    # returns a sql query to select data matching this filter in @tablename.
+    # If @layout (a PartitionLayout) is given and @tablename is unified, the
+    # month tables not in unified yet are read too, and a daterange only
+    # reads the partitions and month tables it covers
+    def sql(self, tablename, fields=['*'], layout=None):
+        if layout:
+            source = layout.source(tablename, self.source_bounds())
+        else:
+            source = tablename
+
+        where_clause = self.where()
+        if where_clause is None:
+            query = "SELECT {0} FROM {1}".format(', '.join(fields), source)
+        else:
+            query = "SELECT {0} FROM {1} WHERE {2}".format(", ".join(fields),
+                                                           source, where_clause)
+        return query
+
+
+    def time_bounds(self):
+        """
+        Returns (lo, hi), the datetimes such that the daterange selects lo
+        <= event_time < hi, or None if there is no daterange
+        """
+        if self.daterange is None:
+            return None
+        return self.daterange[0], self.daterange[1] + timedelta(days=1)
+
+
+    def source_bounds(self):
+        """
+        Returns the time_bounds() of the rows this filter may select, or
+        None if they may be at any time (no daterange, or negated)
+        """
+        if self.negate:
+            return None
+        return self.time_bounds()
+
+
+    def where(self, time_column='event_time'):
+        """
+        Returns the condition selecting the rows matching this filter, for
+        the WHERE clause of a query, or None if it selects every row.
+        @time_column is the column the daterange applies to. The daterange
+        is in whole days, so the condition works just as well on the hours
+        of the hourly_counts table as on event_time
+        """
+
         if self.daterange is not None:
-            time_condition = "(event_time > '{0}' AND event_time < '{1}')".format(
-                self.daterange[0].isoformat(), (self.daterange[1] + timedelta(days=1)).isoformat())
+            lo, hi = self.time_bounds()
+            time_condition = "({0} >= '{1}' AND {0} < '{2}')".format(
+                time_column, lo.isoformat(), hi.isoformat())
         else:
             time_condition = None
 
@@ -80,11 +131,8 @@ class Filter:
         ) + ')'
         
         if where_clause in ('()', 'NOT ()'):
-            query = "SELECT {0} FROM {1}".format(', '.join(fields), tablename)
-        else:
-            query = "SELECT {0} FROM {1} WHERE {2}".format(", ".join(fields),
-                                                           tablename, where_clause)
-        return query
+            return None
+        return where_clause
 
 
     def __eq__(self, other):
@@ -97,6 +145,237 @@ class Filter:
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def query_types(self):
+        """
+        Returns the list of query types to accept, or None for all
+        """
+        if isinstance(self.query_type, basestring):
+            return [self.query_type]
+        return self.query_type or None
+
+    def covers(self, other):
+        """
+        Returns True if what Filter @other selects is what it selects of
+        the rows this filter selects, by user, query type and date alone,
+        so that it can be answered from the counts of this filter's rows
+        (see counts_selection()). Neither may be negated, and they must
+        have the same servers and search strings
+        """
+
+        if self.negate or other.negate or self.server != other.server or \
+                self.search_string != other.search_string:
+            return False
+
+        def subset(mine, theirs):
+            return mine is None or (theirs is not None and set(theirs) <= set(mine))
+
+        if not subset(self.user, other.user) or \
+                not subset(self.query_types(), other.query_types()):
+            return False
+        return self.daterange is None or (other.daterange is not None and
+                                          self.daterange[0] <= other.daterange[0] and
+                                          other.daterange[1] <= self.daterange[1])
+
+    def counts_selection(self):
+        """
+        Returns the kwargs for the select() of a CountCube that select the
+        counts of the rows this filter selects, by user, query type and
+        date (QueryCounts.select() takes all but 'hours')
+        """
+
+        selection = {'users': self.user or None, 'query_types': self.query_types(), 'hours': None}
+        if self.daterange is not None:
+            selection['hours'] = [int((bound - epoch).total_seconds()) // 3600
+                                  for bound in self.time_bounds()]
+        return selection
+
+
+class PartitionLayout:
+    """
+    Where the rows of each stretch of time are: the partitions of the
+    unified table (see create_reduced_log.unify()), one per month plus
+    'other' for anything after the last, and the reduced month tables
+    that aren't in unified yet (months still being reduced, or not unified
+    yet). The month tables are kept once unified, and reduce_progress
+    records which are. Read from @cur when made.
+
+    source() turns a daterange into the partitions and tables to read,
+    so that queries over a few months only touch those months instead of
+    relying on MySQL to prune the partitions. Where a partition holds
+    more than the unified month tables that cover the range (eg the first
+    one, which also holds the months older than it), those are read
+    instead.
+    """
+
+    month_re = re.compile(r'\d{4}_\d\d$')
+
+    def __init__(self, cur):
+        cur.execute("""SELECT PARTITION_NAME, PARTITION_DESCRIPTION
+                       FROM INFORMATION_SCHEMA.PARTITIONS
+                       WHERE TABLE_SCHEMA = 'reduced_log' AND TABLE_NAME = 'unified'
+                       ORDER BY PARTITION_ORDINAL_POSITION""")
+        # (name, start, end) of each partition, None meaning unbounded.
+        # The bounds are TO_DAYS() numbers, which are 365 more than Python's
+        # ordinals
+        self.partitions = []
+        start = None
+        for name, description in cur.fetchall():
+            if name is None:
+                # unified isn't partitioned
+                break
+            end = None if description == 'MAXVALUE' else \
+                datetime.combine(date.fromordinal(int(description) - 365), datetime.min.time())
+            self.partitions.append((name, start, end))
+            start = end
+
+        cur.execute("""SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS
+                       WHERE TABLE_SCHEMA = 'reduced_log' AND TABLE_NAME = 'reduce_progress'
+                       AND COLUMN_NAME = 'unified'""")
+        if cur.fetchone()[0]:
+            cur.execute("SELECT DISTINCT tablename FROM reduce_progress WHERE unified")
+            self.unified = set(table for table, in cur.fetchall())
+        else:
+            # not unified since reduce_progress recorded it: the months in
+            # unified are those with a partition of their own
+            self.unified = set(name for name, start, end in self.partitions)
+
+        cur.execute("SHOW TABLES")
+        self.month_tables = []
+        # (name, first, last) of the unified month tables, the first and
+        # last event_time in each, None for an empty one
+        self.unified_tables = []
+        for table, in cur.fetchall():
+            if not self.month_re.match(table):
+                continue
+            if table in self.unified:
+                cur.execute("SELECT MIN(event_time), MAX(event_time) FROM {0}".format(table))
+                first, last = cur.fetchone()
+                self.unified_tables.append((table, first, last))
+            else:
+                self.month_tables.append((table,) + self.month_range(table))
+
+        # the estimated number of rows of each partition and unified month
+        # table, to tell which are cheaper to read
+        self.rows = {}
+        cur.execute("""SELECT PARTITION_NAME, TABLE_ROWS FROM INFORMATION_SCHEMA.PARTITIONS
+                       WHERE TABLE_SCHEMA = 'reduced_log' AND TABLE_NAME = 'unified'""")
+        for name, rows in cur.fetchall():
+            self.rows['unified', name] = rows
+        cur.execute("""SELECT TABLE_NAME, TABLE_ROWS FROM INFORMATION_SCHEMA.TABLES
+                       WHERE TABLE_SCHEMA = 'reduced_log'""")
+        for name, rows in cur.fetchall():
+            self.rows[name] = rows
+
+    @staticmethod
+    def month_range(table):
+        """
+        Returns (start, end) of the month of the month table @table
+        """
+        year, month = [int(x) for x in table.split('_')]
+        start = datetime(year, month, 1)
+        end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+        return start, end
+
+    @staticmethod
+    def overlapping(parts, bounds):
+        """
+        Returns the names of @parts, (name, start, end) tuples, that may
+        have rows in @bounds, (lo, hi) as from Filter.time_bounds(), or
+        all of them if @bounds is None
+        """
+        if bounds is None:
+            return [name for name, start, end in parts]
+        lo, hi = bounds
+        return [name for name, start, end in parts
+                if (end is None or end > lo) and (start is None or start < hi)]
+
+    def tables_for(self, bounds):
+        """
+        Returns the month tables not in unified that may have rows in
+        @bounds, (lo, hi) as from Filter.time_bounds(), or None for all time
+        """
+        return self.overlapping(self.month_tables, bounds)
+
+    def cheaper_tables(self, partition, bounds):
+        """
+        Returns the (table, lo, hi) to read instead of @partition, (name,
+        start, end) as in self.partitions, for its rows in @bounds: the
+        unified month tables with rows from lo to hi, the part of @bounds
+        the partition covers. Returns None if the partition is cheaper to
+        read (by the estimated row counts), or if some rows may be in no
+        month table: if a unified month's table has been dropped, if a
+        month from lo to hi has no unified table, or if its table is
+        empty (as older versions left the months they exchanged into
+        unified)
+        """
+
+        name, start, end = partition
+        lo = bounds[0] if start is None else max(bounds[0], start)
+        hi = bounds[1] if end is None else min(bounds[1], end)
+
+        present = set(table for table, first, last in self.unified_tables)
+        if set(table for table in self.unified if self.month_re.match(table)) - present:
+            return None
+        month = datetime(lo.year, lo.month, 1)
+        while month < hi:
+            if month.strftime('%Y_%m') not in present:
+                return None
+            month = self.month_range(month.strftime('%Y_%m'))[1]
+
+        tables = []
+        for table, first, last in self.unified_tables:
+            if first is None:
+                # the rows of an empty month table may be in its month
+                if self.overlapping([(table,) + self.month_range(table)], (lo, hi)):
+                    return None
+            elif first < hi and last >= lo:
+                tables.append((table, lo, hi))
+        rows = self.rows.get(('unified', name))
+        if rows is None or sum(self.rows.get(table) or 0 for table, lo, hi in tables) >= rows:
+            return None
+        return tables
+
+    def source(self, tablename, bounds):
+        """
+        Returns what to select from (for the FROM clause of a query) to get
+        the rows of @tablename in @bounds, (lo, hi) as from
+        Filter.time_bounds(), or None for all time. For unified, this is the
+        partitions that cover @bounds, or the unified month tables where
+        they are cheaper to read (see cheaper_tables()), together with the
+        month tables not in unified that do. Other tables are returned as
+        they are
+        """
+
+        if tablename != 'unified':
+            return tablename
+
+        tables = self.tables_for(bounds)
+        if bounds is None or not self.partitions:
+            if not tables:
+                return tablename
+            selects = ["SELECT * FROM unified"]
+        else:
+            partitions = []
+            selects = []
+            for partition in self.partitions:
+                if not self.overlapping([partition], bounds):
+                    continue
+                cheaper = self.cheaper_tables(partition, bounds)
+                if cheaper is None:
+                    partitions.append(partition[0])
+                    continue
+                selects += ["SELECT * FROM {0} WHERE event_time >= '{1}' AND event_time < '{2}'".format(
+                    table, lo.isoformat(), hi.isoformat()) for table, lo, hi in cheaper]
+            if not tables and not selects:
+                if not partitions:
+                    return tablename
+                return "unified PARTITION ({0})".format(', '.join(partitions))
+            if partitions:
+                selects.insert(0, "SELECT * FROM unified PARTITION ({0})".format(', '.join(partitions)))
+
+        selects += ["SELECT * FROM {0}".format(table) for table in tables]
+        return "({0}) AS selected".format(' UNION ALL '.join(selects))
+
 
 class SearchStringList(list):
     """
@@ -115,233 +394,384 @@ class SearchStringList(list):
     def to_sql(self):
         """
         Returns a representation of this search string list suitable for use
-        in the "WHERE" clause of a sql statement.
+        in the "WHERE" clause of a sql statement. The query text is in the
+        queries table, so each search string becomes a subquery on it
         """
         if len(self) == 0:
             return None
+        matching = "queryid {0}IN (SELECT queryid FROM queries WHERE query LIKE '{1}')"
         if self.combiner == 'any':
-            return "(" + " OR ".join("query LIKE '{0}'".format(x) for x in self) + ")"
+            return "(" + " OR ".join(matching.format('', x) for x in self) + ")"
         if self.combiner == 'all':
-            return "(" + " AND ".join("query LIKE '{0}'".format(x) for x in self) + ")"
+            return "(" + " AND ".join(matching.format('', x) for x in self) + ")"
         if self.combiner == 'none':
-            return "(" + " AND ".join("query NOT LIKE '{0}'".format(x) for x in self) + ")"
+            return "(" + " AND ".join(matching.format('NOT ', x) for x in self) + ")"
         if self.combiner == 'not all':
-            return "(" + " OR ".join("query NOT LIKE '{0}'".format(x) for x in self) + ")"
+            return "(" + " OR ".join(matching.format('NOT ', x) for x in self) + ")"
         return None
 
 
 
-def query_profile(tablename, numtop, period, cur):
+def rollup_condition(filters, layout=None):
+    """
+    Returns the condition selecting the rows of the hourly_counts table
+    that count the rows of unified left by applying each of @filters in
+    turn, or None if they leave every row. Returns False if the hourly
+    counts can't tell, because some filter searches the query text, or
+    (given the PartitionLayout @layout) reads month tables that are not in
+    unified, and so not counted, as any filter without a daterange does
+    while there are some
+    """
+
+    conditions = []
+    for fil in filters:
+        if fil.search_string:
+            return False
+        if layout and layout.tables_for(fil.source_bounds()):
+            return False
+        condition = fil.where(time_column = 'hour')
+        if condition is not None:
+            conditions.append(condition)
+    return ' AND '.join(conditions) if conditions else None
+
+
+def query_profile(tablename, numtop, period, cur, filters=None, layout=None,
+                  approximate=False):
     """
     Generate profiles of the queries in @tablename
+
+    @filters, if given, is the list of Filters that were applied to the
+    unified table, in turn, to get @tablename. If none of them search the
+    query text, the counts over time are summed from the hourly_counts
+    table (see create_reduced_log.rollup_partition()) instead of counting
+    the rows of @tablename. @layout is the PartitionLayout the filters
+    were applied with, if any
+
+    If @approximate, the top queries are counted by Space-Saving sketches
+    (see approximate_topqueries()) instead of exactly. Besides the
+    profiles, returns a dict of the most the count of any vals of a top
+    query may be under its true count, for each user and for all users
+    (under None). These are all 0 if not @approximate
     """
 
-    # We are assuming the db already has the time functions defined.
-    # This is one of the actions in the create reduced log table
-    # define_time_functions(cur)
-
-    print_and_execute("""SELECT user, time, query_type, count
-                         FROM (SELECT userid, my_{1}(event_time) AS time,
-                                      query_type, count(*) AS count
-                               FROM {0}
-                               GROUP BY userid, time, query_type
-                              ) AS sth
-                            NATURAL JOIN users
-                      """.format(tablename, period), cur)
-
-    peruser_divided = defaultdict(dict)
-    peruser_alltime = dict()
-    full_divided = dict()
-    full_alltime = defaultdict(int)
-
-    for user, time, query_type, count in cur.fetchall():
-        # print user, time, query_type, count
-
-        if time not in peruser_divided[user]:
-            peruser_divided[user][time] = defaultdict(int)
-        peruser_divided[user][time][query_type] = count
-        
-        if user not in peruser_alltime:
-            peruser_alltime[user] = defaultdict(int)
-        peruser_alltime[user][query_type] += count
-        
-        if time not in full_divided:
-            full_divided[time] = defaultdict(int)
-        full_divided[time][query_type] += count
+    cur.execute("SELECT userid, user FROM users")
+    usernames = dict(cur.fetchall())
 
-        full_alltime[query_type] += count
-    
-    #sort them by time and make into (ordered) list of tuples
-    full_divided = sorted([(k, v) for (k, v) in full_divided.iteritems()], key=itemgetter(0))
-    for user in peruser_divided.keys():
-        peruser_divided[user] = sorted([(k, v) for (k, v) in peruser_divided[user].iteritems()],
-                                       key=itemgetter(0))
-
-    print_and_execute("""SELECT user, query, vals FROM {0} NATURAL JOIN users
-                      """.format(tablename), cur)
-
-    full_topqueries = defaultdict(dict)
-    peruser_topqueries = defaultdict(dict)
-    for user, query, vals in cur.fetchall():
-        full_query = full_topqueries[query]
-        if vals not in full_query:
-            full_query[vals] = 0
-        full_query[vals] += 1
-
-        peruser_user = peruser_topqueries[user]
-        if query not in peruser_user:
-            peruser_user[query] = {}
-        if vals not in peruser_user[query]:
-            peruser_user[query][vals] = 0
-        peruser_user[query][vals] += 1
-
-    print "stored queries"
-
-    for user in peruser_topqueries: #takes forever
-        peruser_topqueries[user] = map(lambda x: (x[0], sorted(x[1].iteritems(),
-                                                               key=itemgetter(1),
-                                                               reverse=True)),
-                                       sorted(peruser_topqueries[user].iteritems(),
-                                              key=lambda x: sum(ct for val, ct in x[1].iteritems()),
-                                              reverse=True)
-                                   )[:numtop]
-    print "sorted each user"
-    #takes no time:
-    peruser_topqueries = sorted(peruser_topqueries.iteritems(),
-                                key = lambda x: sum( sum(ct for val, ct in valcts) 
-                                                    for query, valcts in x[1] ),
-                                reverse = True)
-
-    print "sorted peruser_topqueries"
-    #takes a long time:
-    full_topqueries = map(lambda x: (x[0], sorted(x[1].iteritems(), key=itemgetter(1), reverse=True)),
-                          sorted([(q, c) for (q, c) in full_topqueries.iteritems()],
-                                 key = lambda x: sum(count for vals, count in x[1].iteritems()),
-                                 reverse=True))[:numtop]
-
-    print "sorted full_topqueries"
-    return peruser_divided, peruser_alltime, full_divided, full_alltime, full_topqueries, peruser_topqueries
-
-### Functions for converting time arguments to date strings for gnuplot
-time_str_fcns = {'hour': lambda hour: datetime.fromtimestamp(hour * 60 * 60).isoformat(),
-                 'day': lambda day: datetime.fromtimestamp(day * 24 * 60 * 60).isoformat(),
-                 'week': lambda wk: wk, #TODO: implement
-                 'month': lambda t: datetime((t+1)%12, t/12, 1).isoformat(),
+    profiles = load_cube(tablename, cur, filters, layout).profiles(period, usernames)
+    if approximate:
+        topqueries = approximate_topqueries(tablename, numtop, cur)
+    else:
+        topqueries = load_query_counts(tablename, cur).top(numtop, usernames) + (defaultdict(int),)
+    return profiles + with_query_texts(*topqueries, cur = cur)
+
+def load_cube(tablename, cur, filters=None, layout=None):
+    """
+    Returns the CountCube of the rows of @tablename by hour, user and query
+    type. @filters and @layout are as for query_profile()
+    """
+
+    # Each row has its hour bucket stored (see myutils.periods). On a
+    # reduced table this only reads its time_buckets index; the tool's
+    # temporary tables have no such index, so they are read in full
+    condition = rollup_condition(filters, layout) if filters is not None else False
+    if condition is False:
+        print_and_execute("""SELECT userid, hour_bucket, query_type, COUNT(*)
+                             FROM {0}
+                             GROUP BY userid, hour_bucket, query_type
+                          """.format(tablename), cur)
+    else:
+        print_and_execute("""SELECT userid, {0} AS time, query_type, CAST(SUM(count) AS SIGNED)
+                             FROM hourly_counts
+                             {1}
+                             GROUP BY userid, time, query_type
+                          """.format(hour_bucket_sql.format('hour'),
+                                     'WHERE ' + condition if condition else ''), cur)
+    return CountCube.from_rows(iter_rows(cur))
+
+def load_query_counts(tablename, cur, where=None):
+    """
+    Returns the QueryCounts of the rows of @tablename, or of those matching
+    the condition @where. The server counts the rows of each (user,
+    query, vals), so only those counts are held here. Queries are counted
+    by queryid; only the top ones are looked up in the queries table, by
+    with_query_texts()
+    """
+
+    print_and_execute("""SELECT userid, queryid, query_type, vals, COUNT(*)
+                         FROM {0}
+                         {1}
+                         GROUP BY userid, queryid, query_type, vals
+                      """.format(tablename, 'WHERE ' + where if where else ''), cur)
+    return QueryCounts.from_rows(iter_rows(cur))
+
+def with_query_texts(full_topqueries, peruser_topqueries, topquery_errors, cur):
+    """
+    Returns @full_topqueries and @peruser_topqueries, with queryids for
+    the queries, as query_profile() returns them, with query texts
+    """
+
+    texts = query_texts(set([query for query, valcts in full_topqueries] +
+                            [query for user, profile in peruser_topqueries for query, valcts in profile]),
+                        cur)
+    full_topqueries = [(texts[query], valcts) for query, valcts in full_topqueries]
+    peruser_topqueries = [(user, [(texts[query], valcts) for query, valcts in profile])
+                          for user, profile in peruser_topqueries]
+    return full_topqueries, peruser_topqueries, topquery_errors
+
+def approximate_topqueries(tablename, numtop, cur, where=None):
+    """
+    Returns the top queries of all users and of each user in @tablename,
+    as query_profile() does, and a dict of the most the count of any of
+    their vals may be under the true count (see query_profile()), from
+    the rows of @tablename (or those matching the condition @where), in
+    memory that doesn't grow with it.
+
+    The server counts the rows of each (user, query), and these are
+    summed by two SpaceSaving sketches: one of config "topquery_sketch"
+    "queries" counters for the queries of all users, and one of "pairs"
+    counters for the (user, query) pairs, from which the top queries of
+    each user are taken. Which queries are on top is approximate: users
+    with none of their queries among the pairs counted are left out, and
+    a query may be missed for one counted a little less. Then the server
+    counts the vals of just the queries on top, which are summed by
+    sketches of "vals" counters. So the total of each query shown is
+    exact, but the count of each of its vals is its counter's count less
+    its error, which is never more than its true count, and at most the
+    error under it. Whatever of the query's total that leaves out is
+    shown as '<vals not counted above>'
+    """
+
+    sizes = config.get('topquery_sketch') or {}
+    capacity = sizes.get('queries') or 2000
+    pairs_capacity = sizes.get('pairs') or 20000
+    vals_capacity = sizes.get('vals') or 10
+
+    full_sketch = SpaceSaving(capacity)
+    pair_sketch = SpaceSaving(pairs_capacity)
+
+    # An SSCursor of its own, whatever @cur is, so the counts are streamed
+    sscur = cur.connection.cursor(SSCursor)
+    print_and_execute("SELECT userid, queryid, COUNT(*) FROM {0} {1} GROUP BY userid, queryid".format(
+        tablename, 'WHERE ' + where if where else ''), sscur)
+    for userid, query, count in iter_rows(sscur):
+        full_sketch.add(query, count)
+        pair_sketch.add((userid, query), count)
+
+    # (query, count, error) of the top queries of all users, and of each user
+    full_top = [(query, count, error) for query, count, error, payload in full_sketch.top(numtop)]
+    user_tops = defaultdict(list)
+    for (userid, query), count, error, payload in pair_sketch.top(pairs_capacity):
+        if len(user_tops[userid]) < numtop:
+            user_tops[userid].append((query, count, error))
+
+    full_vals = dict((query, SpaceSaving(vals_capacity)) for query, count, error in full_top)
+    user_vals = dict(((userid, query), SpaceSaving(vals_capacity))
+                     for userid, top in user_tops.iteritems() for query, count, error in top)
+    queries = set(full_vals) | set(query for userid, query in user_vals)
+    if queries:
+        print_and_execute("""SELECT userid, queryid, vals, COUNT(*) FROM {0}
+                             WHERE {1}queryid IN ({2})
+                             GROUP BY userid, queryid, vals""".format(
+            tablename, '(' + where + ') AND ' if where else '',
+            ', '.join(str(query) for query in sorted(queries))), sscur)
+        for userid, query, vals, count in iter_rows(sscur):
+            if query in full_vals:
+                full_vals[query].add(vals, count)
+            if (userid, query) in user_vals:
+                user_vals[userid, query].add(vals, count)
+    sscur.close()
+
+    print "counted queries"
+
+    def top(ranked, vals_sketch):
+        topqueries = []
+        errors = [0]
+        for query, count, query_error in ranked:
+            sketch = vals_sketch(query)
+            top_vals = sketch.top(vals_capacity)
+            valcts = [(vals, ct - error) for vals, ct, error, payload in top_vals]
+            errors += [error for vals, ct, error, payload in top_vals]
+            uncounted = sketch.total - sum(ct for vals, ct in valcts)
+            if uncounted:
+                valcts.append(('<vals not counted above>', uncounted))
+            if valcts:
+                topqueries.append((query, valcts))
+        topqueries.sort(key = lambda x: sum(ct for vals, ct in x[1]), reverse = True)
+        return topqueries, max(errors)
+
+    cur.execute("SELECT userid, user FROM users")
+    usernames = dict(cur.fetchall())
+
+    topquery_errors = {}
+    full_topqueries, topquery_errors[None] = top(full_top, full_vals.get)
+    peruser_topqueries = []
+    for userid, ranked in user_tops.iteritems():
+        user = usernames[userid]
+        topqueries, topquery_errors[user] = top(ranked, lambda query: user_vals[userid, query])
+        peruser_topqueries.append((user, topqueries))
+    peruser_topqueries.sort(key = lambda x: sum( sum(ct for val, ct in valcts)
+                                                 for query, valcts in x[1] ),
+                            reverse = True)
+
+    return full_topqueries, peruser_topqueries, topquery_errors
+
+def iter_rows(cur, fetch_rows=10000):
+    """
+    Yields the rows of the result set of @cur, fetching @fetch_rows at a
+    time, so that an SSCursor streams them
+    """
+    while True:
+        rows = cur.fetchmany(fetch_rows)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+def query_texts(queryids, cur):
+    """
+    Returns a dict mapping each of @queryids to its text in the queries
+    table
+    """
+
+    if not queryids:
+        return {}
+    cur.execute("SELECT queryid, query FROM queries WHERE queryid IN ({0})".format(
+        ', '.join(str(x) for x in queryids)))
+    return dict(cur.fetchall())
+
+### Functions for converting time buckets (see myutils.periods) to date strings for gnuplot
+time_str_fcns = {'hour': lambda hour: (epoch + timedelta(hours = hour)).isoformat(),
+                 'day': lambda day: (epoch + timedelta(days = day)).isoformat(),
+                 'week': lambda wk: (epoch + timedelta(days = 7 * wk - 3)).isoformat(),
+                 'month': lambda t: datetime(t / 12, t % 12 + 1, 1).isoformat(),
                  'year': lambda year: datetime(year, 1, 1).isoformat()}
 
-# Writes gnuplot scripts and data files for plotting query profiles in the cwd
-def gnuplot(profiles, time_axis_label='time'):
-    peruser_divided, peruser_alltime, full_divided, full_alltime, ftq, putq = profiles
+def inline_data(rows):
+    """
+    Returns @rows as data inline in a gnuplot script, to follow a plot
+    of '-'
+    """
+    return '\n'.join('\t'.join(str(s) for s in row) for row in rows) + '\ne'
+
+# Returns the gnuplot jobs that plot query profiles into @directory, for a
+# Plotter (see Plotter.py): a list of (images, commands), the images each
+# set of commands writes and the commands, with their data inline. Each
+# is independent of the others
+def gnuplot(profiles, time_axis_label='time', directory='.'):
+    def path(filename):
+        return os.path.join(directory, filename)
+
+    peruser_divided, peruser_alltime, full_divided, full_alltime = profiles[:4]
     time_fcn = time_str_fcns[time_axis_label]
+    jobs = []
 
     #full_alltime (bar graph of all queries by type)
-    with open('full_alltime.dat', 'w') as datafile:
-        for num, cmd in enumerate(order):
-            print >>datafile, '\t'.join(str(s) for s in [num, cmd, full_alltime[cmd]])
-    
-    with open('full_alltime_script.gnu', 'w') as scriptfile:
-        print >>scriptfile, "set term png size 640,460"
-        print >>scriptfile, "set output \"full_alltime.png\""
-        print >>scriptfile, """set title "Total queries by type" """
-        print >>scriptfile, """set ylabel "queries" """
-        print >>scriptfile, "set xtics rotate"
-        print >>scriptfile, "set bmargin at screen 0.3"
-        print >>scriptfile, "set boxwidth 0.5"
-        print >>scriptfile, "set style fill solid"
-        print >>scriptfile, "set nokey"
-        print >>scriptfile, """plot "full_alltime.dat" using 1:3:xtic(2) with boxes"""
+    commands = ["set term png size 640,460",
+                """set output "{0}" """.format(path("full_alltime.png")),
+                """set title "Total queries by type" """,
+                """set ylabel "queries" """,
+                "set xtics rotate",
+                "set bmargin at screen 0.3",
+                "set boxwidth 0.5",
+                "set style fill solid",
+                "set nokey",
+                """plot '-' using 1:3:xtic(2) with boxes""",
+                inline_data([num, cmd, full_alltime[cmd]] for num, cmd in enumerate(order))]
+    jobs.append(([path("full_alltime.png")], '\n'.join(commands)))
 
 
     #full_divided (line graph of each type over time, also line graph of all over time)
-    full_divided_data = open('full_divided.dat', 'w')
-    full_divided_script = open('full_divided_script.gnu', 'w')
-    print >>full_divided_script, "set term png size 640,460"
-
+    rows = []
     lastTime = None
     for time, counts in full_divided:
         total_this_week = sum(counts.values())
         if lastTime:
             for missed_time in [x + lastTime + 1 for x in range(time - lastTime - 1)]:
-                print >>full_divided_data, '\t'.join(str(s) for s in [time_fcn(missed_time),] +
-                                                     [0,] * (len(order) + 1))
-        print >>full_divided_data, '\t'.join(str(s) for s in [time_fcn(time),] +
-                                             [counts[x]for x in order] +
-                                             [total_this_week,])
+                rows.append([time_fcn(missed_time),] + [0,] * (len(order) + 1))
+        rows.append([time_fcn(time),] + [counts[x]for x in order] + [total_this_week,])
         lastTime = time
-    usings = ', '.join(""""full_divided.dat" using 1:{0} title '{1}' with lines""".format(num + 2, qtype)
+    data = inline_data(rows)
+    usings = ', '.join("""'-' using 1:{0} title '{1}' with lines""".format(num + 2, qtype)
                        for (num, qtype) in enumerate(order))
-    print >>full_divided_script, """set output "full_divided.png" """
-    print >>full_divided_script, """set title "Queries over time" """
-    print >>full_divided_script, """set xlabel "{0}" """.format(time_axis_label)
-    print >>full_divided_script, """set ylabel "queries" """
-    print >>full_divided_script, """set xdata time"""
-    print >>full_divided_script, """set xtics rotate"""
-    print >>full_divided_script, """set timefmt "%Y-%m-%dT%H:%M:%S" """
-    print >>full_divided_script, """plot """ + usings
-    print >>full_divided_script, """set output "full_divided_total.png" """
-    print >>full_divided_script, """set title "Total queries over time" """
-    print >>full_divided_script, """set nokey"""
-    print >>full_divided_script, """plot "full_divided.dat" using 1:{0} with lines""".format(len(order) + 2)
-    full_divided_data.close()
-    full_divided_script.close()
-
-
-    #peruser_alltime (bar graphs of all queries from each user by type)
-    with open('peruser_alltime.gnu', 'w') as scriptfile:
-        print >>scriptfile, "set term png size 640,460"
-        print >>scriptfile, "set xtics rotate"
-        print >>scriptfile, "set bmargin at screen 0.3"
-        print >>scriptfile, "set boxwidth 0.5"
-        print >>scriptfile, "set nokey"
-        print >>scriptfile, "set style fill solid"
-        print >>scriptfile, """set ylabel "queries" """
-
-        # data file of total queries by user
-        with open('peruser_total.dat', 'w') as datafile:
-            for num, user in enumerate(peruser_alltime):
-                print >>datafile, '\t'.join(str(s) for s in [num, user, sum(peruser_alltime[user].values())])
-
-        for user, queries in peruser_alltime.iteritems():
-            with open('peruser_alltime_{0}.dat'.format(user), 'w') as datafile:
-                for num, cmd in enumerate(order):
-                    print >>datafile, '\t'.join(str(s) for s in [num, cmd, queries[cmd]])
-            print >>scriptfile, """set output "peruser_alltime_{0}.png" """.format(user)
-            print >>scriptfile, """set title "{0}" """.format(user)
-            print >>scriptfile, """plot "peruser_alltime_{0}.dat" using 1:3:xtic(2) with boxes""".format(user)
-
-        print >>scriptfile, 'set output "full_peruser.png"'
-        print >>scriptfile, 'set xlabel "user"'
-        print >>scriptfile, 'set title "Total queries by user"'
-        print >>scriptfile, 'plot "peruser_total.dat" using 1:3:xtic(2) with boxes'
+    commands = ["set term png size 640,460",
+                """set output "{0}" """.format(path("full_divided.png")),
+                """set title "Queries over time" """,
+                """set xlabel "{0}" """.format(time_axis_label),
+                """set ylabel "queries" """,
+                """set xdata time""",
+                """set xtics rotate""",
+                """set timefmt "%Y-%m-%dT%H:%M:%S" """,
+                """plot """ + usings] + [data] * len(order) + \
+               ["""set output "{0}" """.format(path("full_divided_total.png")),
+                """set title "Total queries over time" """,
+                """set nokey""",
+                """plot '-' using 1:{0} with lines""".format(len(order) + 2),
+                data]
+    jobs.append(([path("full_divided.png"), path("full_divided_total.png")], '\n'.join(commands)))
+
+
+    #peruser_alltime (bar graphs of all queries from each user by type).
+    # A job for each user, and one for the totals, so they can be
+    # rendered in parallel
+    peruser_alltime_settings = ["set term png size 640,460",
+                                "set xtics rotate",
+                                "set bmargin at screen 0.3",
+                                "set boxwidth 0.5",
+                                "set nokey",
+                                "set style fill solid",
+                                """set ylabel "queries" """]
+
+    # total queries by user
+    commands = peruser_alltime_settings + \
+        ["""set output "{0}" """.format(path("full_peruser.png")),
+         'set xlabel "user"',
+         'set title "Total queries by user"',
+         """plot '-' using 1:3:xtic(2) with boxes""",
+         inline_data([num, user, sum(peruser_alltime[user].values())]
+                     for num, user in enumerate(peruser_alltime))]
+    jobs.append(([path("full_peruser.png")], '\n'.join(commands)))
+
+    for user, queries in peruser_alltime.iteritems():
+        image = path("peruser_alltime_{0}.png".format(user))
+        commands = peruser_alltime_settings + \
+            ["""set output "{0}" """.format(image),
+             """set title "{0}" """.format(user),
+             """plot '-' using 1:3:xtic(2) with boxes""",
+             inline_data([num, cmd, queries[cmd]] for num, cmd in enumerate(order))]
+        jobs.append(([image], '\n'.join(commands)))
 
 
     #peruser_divided (line graphs of each type and total #, over time, for each user)
-    with open('peruser_divided.gnu', 'w') as scriptfile:
-        print >>scriptfile, "set term png size 640,460"
-        print >>scriptfile, """set xlabel "{0}" """.format(time_axis_label)
-        print >>scriptfile, """set ylabel "queries" """
-        for user, times in peruser_divided.iteritems():
-            with open('peruser_divided_{0}.dat'.format(user), 'w') as datafile:
-                lastTime = None
-                for time, counts in times:
-                    if lastTime:
-                        for missed_time in [x + lastTime + 1 for x in range(time - lastTime - 1)]:
-                            print >>datafile, '\t'.join(str(s) for s in
-                                                        [missed_time,] + [0,] * (len(order) + 1))
-
-                    total_this_week = sum(counts.values())
-                    # print >>datafile, '\t'.join(str(s) for s in [time,] + [float(counts[x])/total_this_week for x in order] + [total_this_week,])
-                    print >>datafile, '\t'.join(str(s) for s in [time,] +
-                                                [counts[x] for x in order] +
-                                                [total_this_week,])
-                    lastTime = time
-            usings = ', '.join(""""peruser_divided_{user}.dat" using 1:{colnum} title '{qtype}' with lines""".format(user=user, colnum=num+2, qtype=qtype)
-                               for (num, qtype) in enumerate(order))
-            print >>scriptfile, """set output "peruser_divided_{0}.png" """.format(user)
-            print >>scriptfile, """set title "{0}" """.format(user)
-            print >>scriptfile, "set key on"
-            print >>scriptfile, """plot """ + usings
-            print >>scriptfile, """set output "peruser_divided_total_{0}.png" """.format(user)
-            print >>scriptfile, """set title "Total queries by {0}" """.format(user)
-            print >>scriptfile, """set key off"""
-            print >>scriptfile, """plot "peruser_divided_{0}.dat" using 1:{1} with lines""".format(user, len(order) + 2)
+    for user, times in peruser_divided.iteritems():
+        rows = []
+        lastTime = None
+        for time, counts in times:
+            if lastTime:
+                for missed_time in [x + lastTime + 1 for x in range(time - lastTime - 1)]:
+                    rows.append([missed_time,] + [0,] * (len(order) + 1))
+
+            total_this_week = sum(counts.values())
+            # rows.append([time,] + [float(counts[x])/total_this_week for x in order] + [total_this_week,])
+            rows.append([time,] + [counts[x] for x in order] + [total_this_week,])
+            lastTime = time
+        data = inline_data(rows)
+
+        image = path("peruser_divided_{0}.png".format(user))
+        total_image = path("peruser_divided_total_{0}.png".format(user))
+        usings = ', '.join("""'-' using 1:{colnum} title '{qtype}' with lines""".format(colnum=num+2, qtype=qtype)
+                           for (num, qtype) in enumerate(order))
+        commands = ["set term png size 640,460",
+                    """set xlabel "{0}" """.format(time_axis_label),
+                    """set ylabel "queries" """,
+                    """set output "{0}" """.format(image),
+                    """set title "{0}" """.format(user),
+                    "set key on",
+                    """plot """ + usings] + [data] * len(order) + \
+                   ["""set output "{0}" """.format(total_image),
+                    """set title "Total queries by {0}" """.format(user),
+                    """set key off""",
+                    """plot '-' using 1:{0} with lines""".format(len(order) + 2),
+                    data]
+        jobs.append(([image, total_image], '\n'.join(commands)))
+
+    return jobs
@@ -0,0 +1,132 @@
+import os
+import re
+import sys
+import mmap
+import subprocess
+from datetime import datetime
+
+# Programs that decompress to stdout, by file extension. They run in a
+# process of their own, so decompressing overlaps reducing
+decompressors = {'.gz': ['gzip', '-dc'],
+                 '.xz': ['xz', '-dc'],
+                 '.bz2': ['bzip2', '-dc']}
+
+# The start of an entry: an optional time (yymmdd hh:mm:ss up to MySQL 5.5,
+# ISO 8601 after), the thread id, the command, a tab, and the argument.
+# The time is only written when it changed since the last entry. Lines
+# that don't match continue the argument of the entry before
+entry_re = re.compile(r"""(?:(\d{6}\s[\s\d]\d:\d\d:\d\d)|(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.\d+)?Z?)?
+                          \s+(\d+)\s(\w+(?:\ \w+)*)\t(.*)""", re.X | re.S)
+
+# Lines written when the server starts, or the log is flushed
+header_re = re.compile(r"""\S+,\ Version:\ |Tcp\ port:\ |Time\s+Id\ Command\s+Argument""", re.X)
+
+# The argument of a Connect entry: user@host on db
+connect_re = re.compile(r"""(?P<user>[^@\s]*)@(?P<host>\S*)\ on\b""", re.X)
+
+
+def open_log_file(filename):
+    """
+    Yields the lines of the general query log file @filename. Files
+    compressed with gzip, xz or bzip2 (going by their extension) are
+    decompressed by a subprocess as they are read. Other files are
+    memory-mapped, so the lines are read straight out of the page cache
+    """
+
+    for extension, command in decompressors.iteritems():
+        if filename.endswith(extension):
+            proc = subprocess.Popen(command + [filename], stdout = subprocess.PIPE,
+                                    bufsize = 1 << 16)
+            for line in iter(proc.stdout.readline, ''):
+                yield line
+            if proc.wait():
+                raise IOError("{0} failed on {1}".format(' '.join(command), filename))
+            return
+
+    with open(filename, 'rb') as infile:
+        if not os.fstat(infile.fileno()).st_size:
+            return
+        mapped = mmap.mmap(infile.fileno(), 0, access = mmap.ACCESS_READ)
+    try:
+        for line in iter(mapped.readline, ''):
+            yield line
+    finally:
+        mapped.close()
+
+
+class LogFileReader:
+    """
+    Reads a general query log file (the log_output=FILE format of the
+    MySQL general log) and yields its entries as rows like those of the
+    general_log tables: (event_time, user_host, thread_id, server_id,
+    command_type, argument).
+
+    The file only names the user of a connection in its Connect entry, so
+    the user and host are remembered for each thread id and written in
+    the user_host format of the tables ('user[user] @ host []').
+    Connections that were opened before the log starts have the user
+    'unknown'
+    """
+
+    unknown_user_host = 'unknown[unknown] @  []'
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.user_hosts = {}
+        self.bad_lines = 0
+
+    def __iter__(self):
+        event_time = None
+        entry = None
+        for line in open_log_file(self.filename):
+            m = entry_re.match(line)
+            if not m:
+                if entry:
+                    # A line break inside the argument
+                    entry[-1].append(line)
+                elif not header_re.match(line):
+                    self.bad_lines += 1
+                continue
+
+            if entry:
+                yield self.row(*entry)
+
+            old_time, new_time, thread_id, command_type, argument = m.groups()
+            if old_time:
+                event_time = datetime.strptime(' '.join(old_time.split()), '%y%m%d %H:%M:%S')
+            elif new_time:
+                event_time = datetime.strptime(new_time, '%Y-%m-%dT%H:%M:%S')
+            if event_time is None:
+                # Entries before the first time can't be placed in a month
+                entry = None
+                self.bad_lines += 1
+                continue
+            entry = event_time, int(thread_id), command_type, [argument]
+
+        if entry:
+            yield self.row(*entry)
+
+        if self.bad_lines:
+            print >>sys.stderr, "{0}: skipped {1} lines not in the general log format".format(
+                self.filename, self.bad_lines)
+
+    def row(self, event_time, thread_id, command_type, argument):
+        """
+        Returns the general_log row for an entry. @argument is the list of
+        lines it was written on
+        """
+
+        argument = ''.join(argument)
+        if argument.endswith('\n'):
+            argument = argument[:-1]
+
+        if command_type == 'Connect':
+            m = connect_re.match(argument)
+            if m:
+                self.user_hosts[thread_id] = '{0}[{0}] @ {1} []'.format(m.group('user'), m.group('host'))
+
+        user_host = self.user_hosts.get(thread_id, self.unknown_user_host)
+        if command_type == 'Quit':
+            self.user_hosts.pop(thread_id, None)
+
+        return event_time, user_host, thread_id, 0, command_type, argument
@@ -0,0 +1,81 @@
+import json
+import time
+import resource
+from datetime import datetime
+from collections import defaultdict
+
+# Keys whose values are combined by taking the largest, not the sum
+max_keys = set(['peak_rss_kb', 'max_depth'])
+
+
+class Metrics:
+    """
+    Counters and timers for one piece of the reduction job (a chunk, a
+    file). self.counts and self.seconds are dicts of named counters and
+    stage times, added to by the code doing the work. record() turns them
+    into a dict ready for write_metrics().
+
+    Timing every row costs a few percent, so the per-row stage timers are
+    only kept if @timing is True; the code doing the work checks
+    self.timing.
+    """
+
+    def __init__(self, timing=False):
+        self.timing = timing
+        self.counts = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.starttime = time.time()
+
+    def record(self, event, **fields):
+        """
+        Returns a dict of everything collected, plus the total time since
+        this Metrics was made, the peak RSS of this process, and @fields
+        """
+
+        record = {'event': event,
+                  'counts': dict(self.counts),
+                  'seconds': dict(self.seconds, total = time.time() - self.starttime),
+                  'peak_rss_kb': peak_rss_kb()}
+        record.update(fields)
+        return record
+
+
+def peak_rss_kb():
+    """
+    Returns the peak resident set size of this process, in kilobytes
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def add_records(total, record):
+    """
+    Add the numbers in @record (a Metrics.record() dict, or one of the
+    dicts in it) into @total, recursively. Numbers under the keys in
+    max_keys are combined by taking the largest. Other values are copied
+    over if @total doesn't have them yet
+    """
+
+    for key, value in record.iteritems():
+        if isinstance(value, dict):
+            add_records(total.setdefault(key, {}), value)
+        elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            if key in max_keys:
+                total[key] = max(total.get(key, value), value)
+            else:
+                total[key] = total.get(key, 0) + value
+        else:
+            total.setdefault(key, value)
+    return total
+
+
+def write_metrics(filename, record):
+    """
+    Append @record to @filename as a line of JSON, stamped with the
+    current time. Does nothing if @filename is None
+    """
+
+    if not filename:
+        return
+    record = dict(record, time = datetime.now().isoformat())
+    with open(filename, 'a') as outfile:
+        outfile.write(json.dumps(record, sort_keys = True, default = str) + '\n')
@@ -2,26 +2,68 @@ from GUI import View, ScrollableView, TextField, Label, \
 Application, Window, Font, Image
 
 import GUI.Geometry as geo
+from collections import OrderedDict
 
 
 
 class GraphView(View):
     """
     Displays an image, and cycles to the next .png file in the list when
-    clicked
+    clicked. The images are rendered by a Plotter.LazyPlots only when
+    shown (the next and previous ones in the background, ahead of time)
+    and loaded only when drawn. At most @cache_size loaded images are
+    kept, the least recently shown dropped first
     """
     DUMMY_IMLIST = [Image(file = "dummy.png"),]
 
-    def __init__(self, size, **kwargs):
+    def __init__(self, size, cache_size=20, **kwargs):
         View.__init__(self, **kwargs)
-        self.images = GraphView.DUMMY_IMLIST
+        self.images = []
+        self.plots = None
         self.im_num = 0
         self.size = size
+        self.cache_size = cache_size
+        # image file -> Image, least recently shown first
+        self.loaded = OrderedDict()
+
+    def show(self, images, plots):
+        """
+        Show the first of @images, a list of image files from @plots
+        """
+        if plots is not self.plots:
+            # The files are plotted again for new plots
+            self.loaded.clear()
+        self.images = images or []
+        self.plots = plots
+        self.im_num = 0
+        self.invalidate()
+
+    def current(self):
+        """
+        Returns the Image to draw: the dummy one while it is being
+        rendered, or if it couldn't be
+        """
+
+        if not self.images:
+            return GraphView.DUMMY_IMLIST[0]
+        n = len(self.images)
+        image = self.images[self.im_num % n]
+        rendered = self.plots.request(image)
+        for i in (self.im_num + 1, self.im_num - 1):
+            self.plots.request(self.images[i % n])
+        if not rendered:
+            return GraphView.DUMMY_IMLIST[0]
+
+        img = self.loaded.pop(image, None)
+        if img is None:
+            img = Image(file = image)
+        self.loaded[image] = img
+        while len(self.loaded) > self.cache_size:
+            self.loaded.popitem(last = False)
+        return img
 
     def draw(self, c, r):
-        if self.images == None:
-            self.images = GraphView.DUMMY_IMLIST
-        img = self.images[self.im_num % len(self.images)]
+        img = self.current()
         img.draw(c, img.bounds, (0, 0) + self.size)
 
     def mouse_up(self, event):
@@ -102,8 +144,16 @@ class TopqueryPanel(ScrollableView):
         self.currently_displayed = 0
         self.font = Font("Courier", 13)
 
-    def new_profiles(self, ftq, ptq):
-        fullpanel = [TopqueryLabel(self.get_header("ALL USERS"), [])]
+    def new_profiles(self, ftq, ptq, errors=None):
+        """
+        Make the panels for the top queries of all users, @ftq, and of
+        each user, @ptq (see Filter.query_profile()). @errors, if given, is
+        the dict of how far under the true counts the counts of the vals
+        may be, for each user and for all users (None), shown in the
+        headers
+        """
+        errors = errors or {}
+        fullpanel = [TopqueryLabel(self.get_header("ALL USERS", errors.get(None)), [])]
         maxlen = len(str(max(sum(ct for vals, ct in valcts)
                              for query, valcts in ftq)))
         maxlen = max(5, maxlen)
@@ -122,7 +172,7 @@ class TopqueryPanel(ScrollableView):
 
         # Peruser
         for user, profile in ptq:
-            this_panel = [TopqueryLabel(self.get_header(user), [])]
+            this_panel = [TopqueryLabel(self.get_header(user, errors.get(user)), [])]
             maxlen = len(str(max(sum(ct for vals, ct in valcts)
                                  for query, valcts in profile)))
             maxlen = max(5, maxlen)
@@ -175,7 +225,9 @@ class TopqueryPanel(ScrollableView):
                 comp.mouse_down(event)
                 return
 
-    def get_header(self, user):
+    def get_header(self, user, error=None):
+        if error:
+            user = "{0} (approximate: counts of vals may be up to {1} low)".format(user, error)
         return "TOP QUERIES FOR {0}\ncount | query\n".format(user) + '=' * 100
 
 
@@ -0,0 +1,318 @@
+import os
+import re
+import hashlib
+import sqlite3
+from itertools import izip
+
+# Bump this whenever a change to Normalizer changes its output, so that
+# on-disk NormalizeCache stores written by the old code are thrown away
+VERSION = 2
+
+# A number or a quoted string. Numbers that are part of a name (t1,
+# 2010_04, db.t2) are not literals, nor is the length of a
+# '<numlist len=N>'. A minus sign right after a comparison, '(' or ','
+# belongs to the number. The lookbehinds after the first character pick
+# the kind of literal, so the regex engine can skip ahead to the next
+# quote, digit or minus sign
+literal_re = re.compile(r"""(['"0-9-](?:(?<=')[^'\\]*(?:(?:\\.|'')[^'\\]*)*'"""
+                        r'''|(?<=")[^"\\]*(?:(?:\\.|"")[^"\\]*)*"'''
+                        r"""|(?<=[0-9])(?<![\w$@.`][0-9])(?<!<numlist len=[0-9])"""
+                        r"""[0-9]*(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?(?![\w$@.`])"""
+                        r"""|(?:(?<=[=<>(,]-)|(?<=[=<>(,] -))"""
+                        r"""[0-9]+(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?(?![\w$@.`])))""")
+
+# A parenthesized list of two or more literals
+_item = r""" ?(?:'[^'\\]*(?:(?:\\.|'')[^'\\]*)*'|"[^"\\]*(?:(?:\\.|"")[^"\\]*)*"|-?[0-9][0-9.eE+-]*) ?"""
+numlist_re = re.compile(r"""\((?:{0},)+{0}\)""".format(_item))
+
+# A table name, which may be quoted and qualified by a db name
+_name = r"""(?:`[^`]+`|"[^"]+"|'[^']+'|[\w$]+)"""
+# An INSERT whose rows are given with VALUES, up to the VALUES keyword
+insert_values_re = re.compile(r"""\s*INSERT\s+(?:(?:LOW_PRIORITY|DELAYED|HIGH_PRIORITY|IGNORE)\s+)*
+                                  (?:INTO\s+)?({0}(?:\s*\.\s*{0})?)\s*(?:\([^)]*\)\s*)?VALUES?\b""".format(_name),
+                              re.I | re.X)
+
+
+def numlist_sub_fcn(m):
+    """
+    Replaces IN-lists, and other lists of literals at least 20 characters
+    long (as the old numlist_re did), with '<numlist len=N>'
+    """
+    if m.start() < 3 or m.string[m.start() - 3:m.start()].upper() not in ('IN ', ' IN'):
+        if m.end() - m.start() < 22:
+            return m.group()
+    items = m.group()
+    if "'" in items or '"' in items:
+        return '<numlist len={0}>'.format(len(literal_re.findall(items)))
+    return '<numlist len={0}>'.format(items.count(',') + 1)
+
+
+class Normalizer:
+    """
+    Puts queries from the general_log into the standard form stored in the
+    reduced log. Replaces myutils.clean(), the numlist substitution,
+    myutils.repl_constants() and the query type checks of the old
+    reduce_log().
+
+    Each step is a single regex scan done in C, rather than a loop in
+    Python. The one step that has to look at every word, capitalizing
+    keywords, is only done once for each distinct query skeleton (the
+    query with its literals taken out), since most queries are the same
+    few statements with different values.
+    """
+
+    def __init__(self, reserved_words, max_skeletons=100000):
+        """
+        @reserved_words - set of (upper case) words to capitalize, see
+                          myutils.get_reserved_words()
+        @max_skeletons  - number of query skeletons to remember before
+                          starting over
+        """
+        self.reserved_words = frozenset(reserved_words)
+        self.max_skeletons = max_skeletons
+        self.skeletons = {}
+
+    def fingerprint(self):
+        """
+        Returns a string that changes whenever the output of normalize()
+        might
+        """
+        words = '\n'.join(sorted(self.reserved_words))
+        return '{0}:{1}'.format(VERSION, hashlib.sha1(words).hexdigest())
+
+    def normalize(self, query):
+        """
+        Returns a tuple (cleaned, query_type, template, vals):
+
+        cleaned    - @query with keywords capitalized, runs of whitespace
+                     replaced by a single space, and IN-lists replaced by
+                     '<numlist len=N>', as clean() and numlist_re did. This
+                     is what QueryReducer rules are checked against
+        query_type - an element of myutils.querytypes
+        template   - @cleaned with every number and quoted string replaced
+                     by '?'. INSERTs with VALUES become
+                     'INSERT INTO <table> <values>'
+        vals       - list of the literals replaced by '?' in @template, in
+                     order
+        """
+
+        m = insert_values_re.match(query)
+        if m:
+            # The rows can be huge, and none of them end up in the template,
+            # so only the start of the query is looked at
+            head = self.normalize(query[:m.start(1)])[0]
+            cleaned = '{0} {1}{2}'.format(head, m.group(1), query[m.end(1):])
+            return cleaned, 'INSERT', 'INSERT INTO {0} <values>'.format(m.group(1)), []
+
+        if '\0' in query:
+            query = query.replace('\0', '')
+
+        cleaned = ' '.join(query.split())
+        if '(' in cleaned:
+            cleaned = numlist_re.sub(numlist_sub_fcn, cleaned)
+
+        # Even elements are the text between literals, odd ones the literals
+        parts = literal_re.split(cleaned)
+        skeleton = '\0'.join(parts[::2])
+        try:
+            pieces, query_type, template = self.skeletons[skeleton]
+        except KeyError:
+            pieces, query_type, template = self.add_skeleton(skeleton)
+
+        parts[::2] = pieces
+        return ''.join(parts), query_type, template, parts[1::2]
+
+    def add_skeleton(self, skeleton):
+        """
+        Capitalize the keywords of @skeleton (whitespace-collapsed query
+        text with a NUL where each literal was) and remember the result.
+        Returns a tuple (pieces of the text between literals, query type,
+        template)
+        """
+
+        if len(self.skeletons) >= self.max_skeletons:
+            self.skeletons = {}
+
+        reserved_words = self.reserved_words
+        capitalized = ' '.join([upper if upper in reserved_words else word
+                                for word, upper in izip(skeleton.split(), skeleton.upper().split())])
+        template = capitalized.replace('\0', '?')
+        entry = capitalized.split('\0'), classify(template), template
+        self.skeletons[skeleton] = entry
+        return entry
+
+
+def classify(query):
+    """
+    Returns the type (an element of myutils.querytypes) of a cleaned query
+    """
+
+    upper = query[:12].upper()
+    if upper.startswith('INSERT'):
+        return 'INSERT'
+    if upper.startswith('SELECT'):
+        return 'SELECT'
+    if upper.startswith('CREATE TABLE'):
+        return 'CREATE_TABLE'
+    if upper.startswith('SET'):
+        return 'SET'
+    if upper.startswith('LOAD DATA'):
+        return 'LOAD'
+    if upper.startswith('ALTER'):
+        return 'ALTER'
+    return 'OTHER'
+
+
+class NormalizeCache:
+    """
+    Remembers the results of Normalizer.normalize() for whole statements,
+    since the general_log is mostly the same statements over and over.
+    Has the same normalize() method as a Normalizer, and calls the
+    Normalizer it wraps for statements it hasn't seen.
+
+    Recently used statements are kept until the cached results take up
+    about @max_mb megabytes. This is an approximate LRU done with two
+    dicts, since an ordered dict costs more per lookup than normalizing
+    does: new results go into the current generation, and once it holds
+    half of @max_mb it becomes the old generation, replacing the one
+    before. Statements found in the old generation are moved back into
+    the current one. Statements longer
+    than @max_query_len aren't cached at all; they are mostly INSERTs of
+    rows that never come again.
+
+    If @filename is given, results are also kept in an sqlite database
+    there, so that a later run (after a crash, or with a different
+    reducer config) can reuse them. New results are written to it by
+    save(). The file is emptied if it was written with different reserved
+    words or an older Normalizer. Several processes can share one file.
+
+    hits, disk_hits and misses count the lookups answered from memory,
+    from the file, and by the Normalizer.
+    """
+
+    # Rough per-entry cost of the dict slot and tuple holding a result
+    entry_overhead = 200
+
+    def __init__(self, normalizer, max_mb=64, max_query_len=4096, filename=None):
+        """
+        @normalizer    - the Normalizer to cache the results of
+        @max_mb        - memory cap, in megabytes
+        @max_query_len - longest statement to cache
+        @filename      - sqlite file to keep results in across runs, or None
+        """
+        self.normalizer = normalizer
+        self.max_bytes = int(max_mb * (1 << 20))
+        self.max_query_len = max_query_len
+        self.filename = filename
+
+        self.current = {}
+        self.old = {}
+        self.nbytes = 0
+        self.hits = self.disk_hits = self.misses = 0
+
+        self.db = None
+        self.pid = None
+        self.unsaved = []
+
+    def normalize(self, query):
+        """
+        Same as Normalizer.normalize(), except vals is a tuple
+        """
+
+        if len(query) > self.max_query_len:
+            self.misses += 1
+            return self.normalizer.normalize(query)
+
+        try:
+            result = self.current[query]
+            self.hits += 1
+            return result
+        except KeyError:
+            pass
+
+        result = self.old.pop(query, None)
+        if result:
+            self.hits += 1
+        else:
+            result = self.load(query)
+            if result:
+                self.disk_hits += 1
+            else:
+                self.misses += 1
+                cleaned, query_type, template, vals = self.normalizer.normalize(query)
+                result = cleaned, query_type, template, tuple(vals)
+                if self.filename:
+                    self.unsaved.append((query, result))
+
+        if self.nbytes > self.max_bytes / 2:
+            self.old = self.current
+            self.current = {}
+            self.nbytes = 0
+        self.current[query] = result
+        # The cleaned query and vals are about as long as the query
+        self.nbytes += 2 * len(query) + len(result[2]) + self.entry_overhead
+        return result
+
+    def counts(self):
+        """
+        Returns a tuple (hits, disk hits, misses)
+        """
+        return self.hits, self.disk_hits, self.misses
+
+    def connect(self):
+        """
+        Returns the connection to the sqlite file, opening it first if this
+        process hasn't yet. A connection can't be used across a fork, so
+        each worker process opens its own
+        """
+
+        if self.db and self.pid == os.getpid():
+            return self.db
+
+        self.pid = os.getpid()
+        self.db = sqlite3.connect(self.filename, timeout = 600)
+        self.db.text_factory = str
+        self.db.execute("""CREATE TABLE IF NOT EXISTS normalized (query_hash TEXT PRIMARY KEY,
+                                                                  cleaned TEXT,
+                                                                  query_type TEXT,
+                                                                  template TEXT,
+                                                                  vals TEXT)""")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        fingerprint = self.normalizer.fingerprint()
+        rows = self.db.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchall()
+        if not rows or rows[0][0] != fingerprint:
+            self.db.execute("DELETE FROM normalized")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (fingerprint,))
+        self.db.commit()
+        return self.db
+
+    def load(self, query):
+        """
+        Returns the result for @query from the sqlite file, or None
+        """
+
+        if not self.filename:
+            return None
+        rows = self.connect().execute("""SELECT cleaned, query_type, template, vals FROM normalized
+                                         WHERE query_hash = ?""",
+                                      (hashlib.sha1(query).hexdigest(),)).fetchall()
+        if not rows:
+            return None
+        cleaned, query_type, template, vals = rows[0]
+        # Literals never contain NULs, normalize() strips them
+        return cleaned, query_type, template, tuple(vals.split('\0')) if vals else ()
+
+    def save(self):
+        """
+        Write the results normalized since the last save() to the sqlite
+        file, if there is one
+        """
+
+        if not self.unsaved:
+            return
+        db = self.connect()
+        db.executemany("INSERT OR REPLACE INTO normalized VALUES (?, ?, ?, ?, ?)",
+                       [(hashlib.sha1(query).hexdigest(), cleaned, query_type, template, '\0'.join(vals))
+                        for query, (cleaned, query_type, template, vals) in self.unsaved])
+        db.commit()
+        self.unsaved = []
@@ -0,0 +1,209 @@
+import sys
+import time
+import threading
+from Queue import Queue, Empty
+
+
+class StallQueue(Queue):
+    """
+    A bounded Queue that keeps track of how long its producer spent blocked
+    because it was full (put_stall: the consumer is the bottleneck) and
+    how long its consumer spent blocked because it was empty (get_stall:
+    the producer is the bottleneck), and of how full it was
+    """
+
+    def __init__(self, maxsize):
+        Queue.__init__(self, maxsize)
+        self.put_stall = 0.0
+        self.get_stall = 0.0
+        self.puts = 0
+        self.total_depth = 0
+        self.max_depth = 0
+
+    def put(self, item, block=True, timeout=None):
+        depth = self.qsize()
+        self.puts += 1
+        self.total_depth += depth
+        self.max_depth = max(self.max_depth, depth)
+        if depth < self.maxsize or not block:
+            Queue.put(self, item, block, timeout)
+        else:
+            starttime = time.time()
+            try:
+                Queue.put(self, item, block, timeout)
+            finally:
+                self.put_stall += time.time() - starttime
+
+    def get(self, block=True, timeout=None):
+        if self.qsize() or not block:
+            return Queue.get(self, block, timeout)
+        starttime = time.time()
+        try:
+            return Queue.get(self, block, timeout)
+        finally:
+            self.get_stall += time.time() - starttime
+
+    def stats(self):
+        """
+        Returns a dict of the stall times and depths so far
+        """
+        return {'put_stall': self.put_stall,
+                'get_stall': self.get_stall,
+                'mean_depth': float(self.total_depth) / self.puts if self.puts else 0.0,
+                'max_depth': self.max_depth}
+
+
+class Fetcher(threading.Thread):
+    """
+    Fetches the result set of @cur in batches of @fetch_rows rows, and puts
+    them on @queue, followed by None. If fetching fails, the exception is
+    put on @queue instead. @cur is only used by this thread until it is
+    done, or stopped by stop()
+    """
+
+    def __init__(self, cur, queue, fetch_rows):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.cur = cur
+        self.queue = queue
+        self.fetch_rows = fetch_rows
+        self.stopped = False
+
+    def run(self):
+        try:
+            while not self.stopped:
+                rows = self.cur.fetchmany(self.fetch_rows)
+                if not rows:
+                    break
+                self.queue.put(rows)
+            self.queue.put(None)
+        except Exception as e:
+            self.queue.put(e)
+
+    def stop(self):
+        """
+        Stop fetching, throwing away the rows queued, and wait for the
+        thread to finish, so that @cur can be closed. For when the
+        consumer fails
+        """
+        self.stopped = True
+        while self.is_alive():
+            try:
+                self.queue.get(timeout = 0.1)
+            except Empty:
+                pass
+
+    def rows(self):
+        """
+        Yields the fetched rows, one at a time. Meant to be called by the
+        consumer of the queue
+        """
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            for row in batch:
+                yield row
+
+
+class Writer(threading.Thread):
+    """
+    Writes what comes through @queue to @sink (see Sinks.py), and calls
+    @checkpoint when told to. Takes items put on the queue by a
+    WriterQueue.
+
+    If writing fails, the error is kept in self.error, and the rest of the
+    queue is thrown away, so that the producer never blocks on a queue
+    nobody reads. The same goes once self.aborted is set (see
+    WriterQueue.abort()).
+
+    write_seconds and checkpoint_seconds are the time spent writing to the
+    sink and in checkpoints.
+    """
+
+    def __init__(self, queue, sink, checkpoint):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.sink = sink
+        self.checkpoint = checkpoint
+        self.error = None
+        self.aborted = False
+        self.write_seconds = 0.0
+        self.checkpoint_seconds = 0.0
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error or self.aborted:
+                continue
+            kind, arg = item
+            starttime = time.time()
+            try:
+                if kind == 'write':
+                    self.sink.write(arg)
+                    self.write_seconds += time.time() - starttime
+                else:
+                    self.checkpoint(*arg)
+                    self.checkpoint_seconds += time.time() - starttime
+            except Exception as e:
+                print >>sys.stderr, "Writing to {0} failed: {1}".format(self.sink.tablename, e)
+                self.error = e
+
+
+class WriterQueue:
+    """
+    File-like front end for a Writer: collects what is written to it and
+    puts it on @queue in blocks of @block_writes write() calls (print >>
+    makes two per line). checkpoint() queues a checkpoint after everything
+    written so far. Checks for a failed Writer whenever it queues
+    something, so errors surface in the producer
+    """
+
+    def __init__(self, queue, writer, block_writes=1000):
+        self.queue = queue
+        self.writer = writer
+        self.block_writes = block_writes
+        self.lines = []
+
+    def write(self, s):
+        self.lines.append(s)
+        if len(self.lines) >= self.block_writes:
+            self.flush()
+
+    def flush(self):
+        if self.writer.error:
+            raise self.writer.error
+        if self.lines:
+            self.queue.put(('write', ''.join(self.lines)))
+            self.lines = []
+
+    def checkpoint(self, *args):
+        self.flush()
+        self.queue.put(('checkpoint', args))
+
+    def close(self):
+        """
+        Queue what is left, and wait for the Writer to finish with it
+        """
+        self.flush()
+        self.queue.put(None)
+        self.writer.join()
+        if self.writer.error:
+            raise self.writer.error
+
+    def abort(self):
+        """
+        Throw away what hasn't been written yet, and wait for the Writer to
+        stop, so that its sink can be closed. For when the producer fails
+        """
+        self.lines = []
+        if not self.writer.is_alive():
+            return
+        self.writer.aborted = True
+        self.queue.put(None)
+        self.writer.join()
@@ -0,0 +1,209 @@
+import os
+import re
+import sys
+import subprocess
+import threading
+from Queue import Queue
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+# gnuplot's warnings, which don't stop a plot
+warning_re = re.compile(r'warning:', re.I)
+
+
+class Gnuplot:
+    """
+    A gnuplot process that is kept open, and fed commands through a pipe.
+    Each run() starts from gnuplot's defaults again (reset), so the
+    settings of one plot don't carry over to the next. If gnuplot exits
+    (it may, on an error), a new one is started for the next run()
+    """
+
+    # Printed (to stderr, like gnuplot's errors) after each run's commands
+    done_marker = 'GNUPLOT RUN DONE'
+
+    def __init__(self):
+        self.proc = None
+
+    def start(self):
+        self.proc = subprocess.Popen(['gnuplot'], stdin = subprocess.PIPE,
+                                     stdout = open(os.devnull, 'w'),
+                                     stderr = subprocess.PIPE)
+        # The lines of gnuplot's error output, read as they come by a
+        # thread of their own, so that gnuplot never blocks writing them
+        # (and stops reading its commands) while run() is still writing
+        # those. None once gnuplot exits
+        self.errors = Queue()
+        reader = threading.Thread(target = self.read_errors, args = (self.proc.stderr, self.errors))
+        reader.daemon = True
+        reader.start()
+
+    @staticmethod
+    def read_errors(stderr, errors):
+        for line in iter(stderr.readline, ''):
+            errors.put(line.rstrip('\n'))
+        errors.put(None)
+
+    def run(self, commands):
+        """
+        Runs @commands. Returns gnuplot's error output, or None if there
+        were no errors
+        """
+
+        if self.proc is None:
+            self.start()
+        try:
+            self.proc.stdin.write('reset\n{0}\nunset output\nprint "{1}"\n'.format(
+                commands, self.done_marker))
+            self.proc.stdin.flush()
+        except IOError:
+            pass
+
+        lines = []
+        while True:
+            line = self.errors.get()
+            if line is None:
+                self.proc.wait()
+                self.proc = None
+                lines.append("gnuplot exited")
+                break
+            if line == self.done_marker:
+                break
+            lines.append(line)
+
+        for line in lines:
+            if line.strip() and not warning_re.search(line):
+                return '\n'.join(lines)
+        if lines:
+            print >>sys.stderr, '\n'.join(lines)
+        return None
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc = None
+
+
+class Plotter:
+    """
+    @processes (defaults to the number of cores) Gnuplots, kept open
+    between jobs, and a pool of as many threads to run the jobs on them
+    in parallel (see run(), and LazyPlots)
+    """
+
+    def __init__(self, processes=None):
+        self.processes = processes or cpu_count()
+        self.gnuplots = Queue()
+        for i in range(self.processes):
+            self.gnuplots.put(Gnuplot())
+        self.pool = ThreadPool(self.processes)
+
+    def run(self, job):
+        """
+        Runs @job, (images, commands) as made by Filter.gnuplot(), on one
+        of the Gnuplots. Returns (images, error output, or None)
+        """
+        images, commands = job
+        gnuplot = self.gnuplots.get()
+        try:
+            error = gnuplot.run(commands)
+        finally:
+            self.gnuplots.put(gnuplot)
+        return images, error
+
+    def failed(self, images, error):
+        """
+        Report that the job plotting @images failed with @error, and
+        delete the images, so that no half-written or old images are shown
+        """
+        print >>sys.stderr, "Plotting {0} failed: {1}".format(', '.join(images), error)
+        for image in images:
+            if os.path.exists(image):
+                os.remove(image)
+
+    def close(self):
+        self.pool.close()
+        while not self.gnuplots.empty():
+            self.gnuplots.get().close()
+
+
+class LazyPlots:
+    """
+    The images of @jobs (as made by Filter.gnuplot()), each rendered by
+    @plotter only once it is asked for (request()), in the background.
+    Used from the GUI's thread, while the rendering happens in the
+    plotter's.
+    """
+
+    def __init__(self, plotter, jobs):
+        self.plotter = plotter
+        self.jobs = dict((image, job) for job in jobs for image in job[0])
+        self.rendered = set()
+        self.submitted = set()
+        # (images, error) of the failed jobs not taken by take_failures() yet
+        self.failures = []
+        self.changed = False
+
+        # Jobs submitted, but not done yet
+        self.lock = threading.Condition()
+        self.running = 0
+        self.closed = False
+
+    def request(self, image):
+        """
+        Returns True if @image has been rendered. If not, has it rendered
+        in the background (unless it failed) and returns False
+        """
+
+        if image in self.rendered:
+            return True
+        job = self.jobs.get(image)
+        with self.lock:
+            if job is None or self.closed or id(job) in self.submitted:
+                return False
+            self.submitted.add(id(job))
+            self.running += 1
+        self.plotter.pool.apply_async(self.render, (job,))
+        return False
+
+    def render(self, job):
+        try:
+            if not self.closed:
+                images, error = self.plotter.run(job)
+                if error:
+                    self.plotter.failed(images, error)
+                    self.failures.append((images, error))
+                else:
+                    self.rendered.update(images)
+                self.changed = True
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.lock.notify_all()
+
+    def take_changed(self):
+        """
+        Returns True if images have been rendered (or failed) since the
+        last call
+        """
+        changed, self.changed = self.changed, False
+        return changed
+
+    def take_failures(self):
+        """
+        Returns the (images, error) of the jobs that failed since the last
+        call
+        """
+        failures, self.failures = self.failures, []
+        return failures
+
+    def close(self):
+        """
+        Render nothing more, and wait for the jobs being rendered, so that
+        the images can be written again
+        """
+        with self.lock:
+            self.closed = True
+            while self.running:
+                self.lock.wait()
@@ -0,0 +1,265 @@
+import sys
+import time
+import threading
+from Queue import Queue, Empty
+from MySQLdb import DatabaseError
+from MySQLdb.cursors import CursorUseResultMixIn
+from myutils import get_conn, config
+
+
+class Cancelled(Exception):
+    """
+    Raised in a QueryWorker job that was cancelled, or whose statement ran
+    longer than the config "query_timeout"
+    """
+    pass
+
+
+class WatchedCursor:
+    """
+    Wraps the cursor @cur of a QueryWorker, so that the worker knows when
+    each statement is running (from execute() until its results are all
+    read) and can kill it. A statement that fails because it was killed
+    raises Cancelled
+    """
+
+    def __init__(self, cur, worker):
+        self.cur = cur
+        self.worker = worker
+        self.connection = WatchedConnection(cur.connection, worker)
+
+    def execute(self, query, args=None):
+        self.worker.start_statement()
+        result = self.call(self.cur.execute, query, args)
+        if not isinstance(self.cur, CursorUseResultMixIn):
+            # The results were read by execute()
+            self.worker.end_statement()
+        return result
+
+    def fetchone(self):
+        row = self.call(self.cur.fetchone)
+        if row is None:
+            self.worker.end_statement()
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self.call(self.cur.fetchmany, size or self.cur.arraysize)
+        if not rows:
+            self.worker.end_statement()
+        return rows
+
+    def fetchall(self):
+        rows = self.call(self.cur.fetchall)
+        self.worker.end_statement()
+        return rows
+
+    def call(self, method, *args):
+        try:
+            return method(*args)
+        except DatabaseError:
+            self.worker.end_statement()
+            self.worker.check()
+            raise
+
+    def __getattr__(self, name):
+        return getattr(self.cur, name)
+
+
+class WatchedConnection:
+    """
+    Wraps the connection of a QueryWorker, so that the cursors made from
+    it are WatchedCursors too
+    """
+
+    def __init__(self, conn, worker):
+        self.conn = conn
+        self.worker = worker
+
+    def cursor(self, *args):
+        return WatchedCursor(self.conn.cursor(*args), self.worker)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+class QueryWorker(threading.Thread):
+    """
+    Runs jobs on a db connection of its own (to @dbname), one at a time, in
+    a thread of its own, so that the GUI doesn't wait on them.
+
+    A job is a function of a cursor on that connection, submitted with a
+    function to call with its result once it is done. The done functions
+    are called from poll(), by the thread that submitted the jobs (the
+    GUI's, which must not be touched from other threads). Temporary
+    tables belong to the connection, so everything that uses them has to
+    be a job.
+
+    cancel() kills the running statement (with KILL QUERY, from another
+    connection) and drops the jobs waiting to run. A watchdog thread does
+    the same to any statement that runs longer than the config
+    "query_timeout" seconds, if given.
+    """
+
+    def __init__(self, dbname):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.dbname = dbname
+        self.jobs = Queue()
+        self.results = Queue()
+        self.running = False
+        self.cancelled = None
+        self.statement_started = None
+        # Counts the statements run, so that a kill meant for one can
+        # tell if it is still running
+        self.statement = 0
+        self.job_started = None
+        self.progress = ''
+
+        # The connection KILL QUERY is sent on, made when first needed.
+        # Used by the GUI's thread and the watchdog's, one at a time. Held
+        # by the worker's thread too while a statement starts or ends, so
+        # that no statement starts while one is being killed
+        self.kill_lock = threading.Lock()
+        self.kill_conn = None
+
+        self.conn = get_conn(dbname)
+        self.cur = WatchedCursor(self.conn.cursor(), self)
+        self.cur.execute("SELECT CONNECTION_ID()")
+        self.connection_id = self.cur.fetchall()[0][0]
+
+        self.timeout = config.get('query_timeout')
+        if self.timeout:
+            watchdog = threading.Thread(target = self.watch)
+            watchdog.daemon = True
+            watchdog.start()
+
+    def submit(self, job, done):
+        """
+        Run @job(cursor) on the worker, then call @done(result, error) from
+        poll(). error is the exception @job raised (a Cancelled if it was
+        cancelled), or None
+        """
+        self.running = True
+        self.jobs.put((job, done))
+
+    def run(self):
+        while True:
+            job, done = self.jobs.get()
+            self.cancelled = None
+            self.job_started = time.time()
+            self.progress = ''
+            try:
+                result, error = job(self.cur), None
+            except Exception as e:
+                result, error = None, e
+                if not isinstance(e, Cancelled):
+                    print >>sys.stderr, "Job failed: {0}".format(e)
+                self.discard()
+            self.end_statement()
+            self.results.put((done, result, error))
+            self.job_started = None
+
+    def discard(self):
+        """
+        Read what is left of the result set of a failed statement, so the
+        connection can be used again
+        """
+        try:
+            while self.cur.cur.fetchmany(1000):
+                pass
+        except Exception:
+            pass
+
+    def poll(self):
+        """
+        Call the done functions of the jobs that are done. Returns False
+        once there are no jobs left
+        """
+
+        while True:
+            try:
+                done, result, error = self.results.get_nowait()
+            except Empty:
+                break
+            done(result, error)
+        self.running = not (self.jobs.empty() and self.job_started is None
+                            and self.results.empty())
+        return self.running
+
+    def start_statement(self):
+        """
+        Note that a statement is starting, unless the job has been
+        cancelled (see check())
+        """
+        with self.kill_lock:
+            self.check()
+            self.statement += 1
+            self.statement_started = time.time()
+
+    def end_statement(self):
+        """
+        Note that the running statement, if any, is done
+        """
+        with self.kill_lock:
+            self.statement_started = None
+
+    def check(self):
+        """
+        Raise Cancelled if the running job has been cancelled. Jobs call
+        this between steps that don't run statements
+        """
+        if self.cancelled:
+            raise Cancelled(self.cancelled)
+
+    def cancel(self, reason='Cancelled'):
+        """
+        Cancel the running job, and those waiting to run
+        """
+
+        while True:
+            try:
+                job, done = self.jobs.get_nowait()
+            except Empty:
+                break
+            self.results.put((done, None, Cancelled(reason)))
+        if self.job_started is not None:
+            self.cancelled = reason
+            self.kill()
+
+    def kill(self, statement=None, reason=None):
+        """
+        Kill the running statement, if any, or only if it is @statement
+        (a self.statement number), cancelling the job for @reason if given
+        """
+
+        with self.kill_lock:
+            if self.statement_started is None or statement not in (None, self.statement):
+                return
+            if reason:
+                self.cancelled = reason
+            try:
+                if self.kill_conn is None:
+                    self.kill_conn = get_conn(self.dbname)
+                self.kill_conn.cursor().execute("KILL QUERY {0}".format(self.connection_id))
+            except DatabaseError as e:
+                print >>sys.stderr, "Could not kill the running query: {0}".format(e)
+                self.kill_conn = None
+
+    def watch(self):
+        while True:
+            time.sleep(0.5)
+            statement, started = self.statement, self.statement_started
+            if started is not None and not self.cancelled and time.time() - started > self.timeout:
+                print >>sys.stderr, "Killing a query that ran longer than {0} sec".format(self.timeout)
+                self.kill(statement, "Query ran longer than {0} sec".format(self.timeout))
+
+    def status(self):
+        """
+        Returns a line saying what the running job is doing, and for how
+        long, or '' if there is none
+        """
+
+        started = self.job_started
+        if started is None:
+            return ''
+        return "{0} ({1:.0f} sec)".format(self.progress or 'Working', time.time() - started)
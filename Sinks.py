@@ -0,0 +1,170 @@
+import os
+import sys
+import time
+import threading
+
+from myutils import get_conn
+
+
+class TempFileSink:
+    """
+    Collects reduced rows (lines in LOAD DATA format) in a temp file on
+    local disk, and loads the file into the reduced table on flush().
+
+    Each sink has its own connection (self.db, self.cur). flush() does not
+    commit, so the caller can record its progress in the same transaction
+    as the rows. bytes_written and load_seconds count what went through
+    the sink, and the time spent in LOAD DATA
+    """
+
+    def __init__(self, tablename, chunknum):
+        self.tablename = tablename
+        self.filename = '{0}_reduced.{1}.tmp'.format(tablename, chunknum)
+        self.db = get_conn(dbname = 'reduced_log')
+        self.cur = self.db.cursor()
+        self.outfile = None
+        self.bytes_written = 0
+        self.load_seconds = 0.0
+
+    def write(self, s):
+        if not self.outfile:
+            self.outfile = open(self.filename, 'w')
+        self.outfile.write(s)
+        self.bytes_written += len(s)
+
+    def flush(self):
+        """
+        Load the rows written since the last flush
+        """
+        if not self.outfile:
+            return
+        self.outfile.close()
+        self.outfile = None
+        starttime = time.time()
+        self.cur.execute("LOAD DATA LOCAL INFILE '{0}' INTO TABLE {1}".format(self.filename,
+                                                                            self.tablename))
+        self.load_seconds += time.time() - starttime
+        os.remove(self.filename)
+
+    def close(self):
+        """
+        Load anything left, commit, and close the connection
+        """
+        self.flush()
+        self.db.commit()
+        self.cur.close()
+        self.db.close()
+
+    def abort(self):
+        """
+        Throw away the rows not committed yet, and close the connection
+        """
+        if self.outfile:
+            self.outfile.close()
+            self.outfile = None
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        self.db.rollback()
+        self.cur.close()
+        self.db.close()
+
+
+class FifoSink:
+    """
+    Streams reduced rows straight into the reduced table through a named
+    pipe. A LOAD DATA LOCAL INFILE on the pipe runs in a background thread
+    while the reducer is still writing rows, so the rows never touch the
+    local disk. flush() ends the current LOAD; the next write() starts
+    another one.
+
+    Like TempFileSink, each sink has its own connection (self.db,
+    self.cur), flush() does not commit, and bytes_written and
+    load_seconds count what went through the sink and the time the LOAD
+    DATAs took (while the rows were being written)
+    """
+
+    def __init__(self, tablename, chunknum):
+        self.tablename = tablename
+        self.filename = '{0}_reduced.{1}.fifo'.format(tablename, chunknum)
+        self.db = get_conn(dbname = 'reduced_log')
+        self.cur = self.db.cursor()
+        self.outfile = None
+        self.loader = None
+        self.error = None
+        self.bytes_written = 0
+        self.load_seconds = 0.0
+
+    def start(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.mkfifo(self.filename)
+
+        self.error = None
+        self.loader = threading.Thread(target = self.load)
+        self.loader.daemon = True
+        self.loader.start()
+        # Blocks until the loader opens the other end of the pipe
+        self.outfile = open(self.filename, 'w')
+
+    def load(self):
+        starttime = time.time()
+        try:
+            self.cur.execute("LOAD DATA LOCAL INFILE '{0}' INTO TABLE {1}".format(self.filename,
+                                                                                self.tablename))
+            self.load_seconds += time.time() - starttime
+        except Exception as e:
+            self.error = e
+            print >>sys.stderr, "Loading {0} into {1} failed: {2}".format(self.filename,
+                                                                        self.tablename, e)
+            # Keep reading so that the writer doesn't block forever on a
+            # pipe nobody reads
+            with open(self.filename) as infile:
+                while infile.read(1 << 16):
+                    pass
+
+    def write(self, s):
+        if not self.outfile:
+            self.start()
+        self.outfile.write(s)
+        self.bytes_written += len(s)
+
+    def flush(self):
+        """
+        Close the pipe and wait for the current load to finish
+        """
+        if not self.outfile:
+            return
+        self.outfile.close()
+        self.outfile = None
+        self.loader.join()
+        os.remove(self.filename)
+        if self.error:
+            raise self.error
+
+    def close(self):
+        """
+        Finish the current load, commit, and close the connection
+        """
+        self.flush()
+        self.db.commit()
+        self.cur.close()
+        self.db.close()
+
+    def abort(self):
+        """
+        End the current load, throw away the rows not committed yet, and
+        close the connection
+        """
+        if self.outfile:
+            self.outfile.close()
+            self.outfile = None
+            self.loader.join()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        self.db.rollback()
+        self.cur.close()
+        self.db.close()
+
+
+sink_types = {'tempfile': TempFileSink,
+              'fifo': FifoSink}
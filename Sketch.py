@@ -0,0 +1,75 @@
+from heapq import heappush, heapreplace
+
+
+class SpaceSaving:
+    """
+    Space-Saving heavy hitters sketch (Metwally et al.): counts the items
+    of a stream in at most @capacity counters, whatever the length of the
+    stream. Items that are not counted yet take the counter of the least
+    counted item, and inherit its count as their error, so a counted
+    item's count is at most its error (never more than total /
+    capacity) over its true count, and count - error is at most its
+    true count. Any item counted more than total / capacity times is
+    among those counted.
+
+    If given, @payload is called to make an object kept with each counter,
+    for counting something about the item (see add()). It is thrown away
+    with the counter.
+    """
+
+    def __init__(self, capacity, payload=None):
+        self.capacity = capacity
+        self.payload = payload
+        self.total = 0
+        # item -> [count, error, payload]
+        self.counters = {}
+        # (count, item) of every counter. Counts only go up, so an entry
+        # may be lower than its counter, but never higher
+        self.heap = []
+
+    def add(self, item, count=1):
+        """
+        Count @count more of @item. Returns the payload of its counter
+        """
+
+        self.total += count
+        counter = self.counters.get(item)
+        if counter is None:
+            payload = self.payload() if self.payload else None
+            if len(self.counters) < self.capacity:
+                counter = [0, 0, payload]
+                heappush(self.heap, (0, item))
+            else:
+                mincount = self.evict(item)
+                counter = [mincount, mincount, payload]
+            self.counters[item] = counter
+        counter[0] += count
+        return counter[2]
+
+    def evict(self, item):
+        """
+        Drops the least counted item, giving its place in the heap to
+        @item. Returns its count
+        """
+
+        heap = self.heap
+        counters = self.counters
+        while True:
+            count, least = heap[0]
+            actual = counters[least][0]
+            if actual == count:
+                break
+            heapreplace(heap, (actual, least))
+        heapreplace(heap, (count, item))
+        del counters[least]
+        return count
+
+    def top(self, n):
+        """
+        Returns the (item, count, error, payload) of the @n items with the
+        highest guaranteed counts (count - error), highest first
+        """
+
+        ranked = sorted(self.counters.iteritems(), key=lambda x: x[1][0] - x[1][1],
+                        reverse=True)[:n]
+        return [(item, count, error, payload) for item, (count, error, payload) in ranked]
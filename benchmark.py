@@ -0,0 +1,339 @@
+"""
+Benchmarks for the query reduction code. Usage:
+
+    $ python benchmark.py normalizer <sample> [rows]
+    $ python benchmark.py suite [rows ...] [--seed=N] [--stages=a,b,...] [--batch=N]
+                                [--metrics=FILE] [--db=MONTH]
+
+normalizer compares Normalizer with the old normalization code on
+<sample>, either a file of logged statements, one per line, or the
+name of a general_log table, in which case its first [rows] (default
+100000) statements are used.
+
+suite times each stage of the reduction, in rows/sec, on synthetic
+logs of each of the given sizes (default 1000000; see
+generate_log.py). The rows are generated in batches of --batch
+(default 10000) rows, and each stage is timed on each batch, so memory
+use doesn't grow with the size. The stages are
+
+    generate     - making the rows (not part of the reduction)
+    parse        - reading them back from a general query log file
+    clean        - myutils.clean(), as the old code used
+    legacy       - the old normalization (clean(), numlist, repl_constants())
+    normalize    - Normalizer.normalize()
+    cached       - NormalizeCache.normalize()
+    accept       - QueryReducer.accept(), with the configured rules
+    reduce_rows  - create_reduced_log.reduce_rows(), the whole reduction of
+                   a row but for fetching and loading, with ids handed out
+                   in memory
+
+--stages picks some of them. With --db=MONTH, the rows are also
+loaded into general_log.MONTH and reduced into reduced_log.MONTH with
+the configured --reduce settings, timing the whole thing end to end.
+Both tables are replaced, so MONTH should be one with no real logs.
+The top queries of reduced_log.MONTH are then counted exactly
+(exact_top) and approximately (approx_top), as the tool does with
+"Approximate Top Queries" unchecked and checked.
+With --metrics=FILE, the results are appended to FILE as lines of
+JSON (see Metrics.py), for comparing runs.
+"""
+
+import sys
+import os
+import re
+import time
+import getopt
+from itertools import islice
+
+from myutils import get_conn, get_reserved_words, clean, repl_constants, config
+from Normalizer import Normalizer, NormalizeCache
+from QueryReducer import QueryReducer
+from LogFile import LogFileReader
+from generate_log import LogGenerator, TableWriter, FileWriter
+from Metrics import peak_rss_kb, write_metrics
+from Dimensions import MemoryDimensions
+
+reserved_words = get_reserved_words('mysql_keywords.txt')
+
+
+### The query normalization done by create_reduced_log.py before Normalizer
+numlist_re = re.compile(r'\([0-9, ]{20,}\)')
+numlist_sub_fcn = lambda x: '<numlist len={0}>'.format(x.group(0).count(',') + 1)
+insert_re = re.compile(r"(INSERT INTO ['`]?\w+['`]?)")
+values_re = re.compile(r'VALUES', re.I)
+
+def legacy_normalize(query):
+    """
+    Returns (query_type, template, vals) for @query, the way reduce_log()
+    computed them with clean(), numlist_re and repl_constants()
+    """
+
+    cleaned_query = clean(query, reserved_words)
+    cleaned_query = numlist_re.sub(numlist_sub_fcn, cleaned_query)
+    cleaned_query, vals = repl_constants(cleaned_query)
+
+    if cleaned_query.startswith('INSERT INTO'):
+        query_type = 'INSERT'
+        if values_re.search(cleaned_query):
+            cleaned_query = insert_re.match(cleaned_query).group(0) + ' <values>'
+            vals = []
+    elif cleaned_query.startswith('SELECT'):
+        query_type = 'SELECT'
+    elif cleaned_query.startswith('CREATE TABLE'):
+        query_type = 'CREATE_TABLE'
+    elif cleaned_query.startswith('SET'):
+        query_type = 'SET'
+    elif cleaned_query.startswith('LOAD DATA'):
+        query_type = 'LOAD'
+    elif cleaned_query.startswith('ALTER'):
+        query_type = 'ALTER'
+    else:
+        query_type = 'OTHER'
+
+    return query_type, cleaned_query, vals
+
+
+def load_sample(sample, rows=100000):
+    """
+    Return a list of statements from @sample, a file of statements (one
+    per line) or a general_log table name
+    """
+
+    if os.path.exists(sample):
+        with open(sample) as infile:
+            return [line.rstrip('\n') for line in infile if line.strip()]
+
+    db = get_conn(dbname = 'general_log')
+    cur = db.cursor()
+    cur.execute("""SELECT argument FROM {0} WHERE command_type IN ('Execute', 'Query')
+                   LIMIT {1}""".format(sample, int(rows)))
+    queries = [x for x, in cur.fetchall()]
+    cur.close()
+    db.close()
+    return queries
+
+
+def time_rows(fcn, queries):
+    """
+    Run @fcn on each of @queries. Returns (seconds taken, set of distinct
+    results)
+    """
+
+    starttime = time.time()
+    results = [fcn(query) for query in queries]
+    seconds = time.time() - starttime
+    return seconds, results
+
+
+def bench_normalizer(queries):
+    normalizer = Normalizer(reserved_words)
+
+    print "{0} statements, {1} bytes".format(len(queries), sum(len(q) for q in queries))
+    print "{0: <12} {1: >10} {2: >12} {3: >10}".format('', 'seconds', 'rows/sec', 'templates')
+
+    rates = {}
+    for name, fcn, template in (('legacy', legacy_normalize, lambda r: r[1]),
+                                ('Normalizer', normalizer.normalize, lambda r: r[2])):
+        seconds, results = time_rows(fcn, queries)
+        rates[name] = len(queries) / seconds if seconds else float('inf')
+        print "{0: <12} {1: >10.3f} {2: >12.0f} {3: >10}".format(name, seconds, rates[name],
+                                                                 len(set(template(r) for r in results)))
+
+    print "speedup: {0:.2f}x".format(rates['Normalizer'] / rates['legacy'])
+
+
+class NullFile:
+    """
+    A file that throws away what is written to it
+    """
+
+    def write(self, s):
+        pass
+
+
+suite_stages = ('generate', 'parse', 'clean', 'legacy', 'normalize', 'cached', 'accept', 'reduce_rows')
+
+def bench_stages(rows, stages=suite_stages, seed=0, batch_rows=10000):
+    """
+    Time each of @stages (see the module docstring) on @rows rows from a
+    LogGenerator seeded with @seed, a batch of @batch_rows at a time.
+    Returns a dict mapping each stage to (rows, seconds)
+    """
+
+    # Imported here, since it sets up its module level reducer and
+    # normalizer from the config
+    import create_reduced_log
+
+    normalizer = Normalizer(reserved_words)
+    cache = NormalizeCache(Normalizer(reserved_words))
+    reducer = QueryReducer(**(config.get('reducer') or {}))
+    dims = MemoryDimensions()
+    logfile = 'benchmark.tmp.log'
+
+    totals = dict((stage, [0, 0.0]) for stage in set(stages) | set(['generate']))
+    def timed(stage, nrows, fcn, *args):
+        starttime = time.time()
+        result = fcn(*args)
+        totals[stage][0] += nrows
+        totals[stage][1] += time.time() - starttime
+        return result
+
+    generated = iter(LogGenerator('2010_04', rows, seed))
+    try:
+        while True:
+            batch = timed('generate', 0, list, islice(generated, batch_rows))
+            if not batch:
+                break
+            totals['generate'][0] += len(batch)
+            statements = [row for row in batch if row[4] in ('Execute', 'Query')]
+            queries = [row[5] for row in statements]
+
+            if 'parse' in stages:
+                writer = FileWriter(logfile)
+                for row in batch:
+                    writer.write_row(row)
+                writer.close()
+                timed('parse', len(batch), list, LogFileReader(logfile))
+            if 'clean' in stages:
+                timed('clean', len(queries), lambda: [clean(q, reserved_words) for q in queries])
+            if 'legacy' in stages:
+                timed('legacy', len(queries), lambda: [legacy_normalize(q) for q in queries])
+            if 'normalize' in stages:
+                normalized = timed('normalize', len(queries), lambda: [normalizer.normalize(q) for q in queries])
+            if 'cached' in stages:
+                normalized = timed('cached', len(queries), lambda: [cache.normalize(q) for q in queries])
+            if 'accept' in stages:
+                if 'normalize' not in stages and 'cached' not in stages:
+                    normalized = [normalizer.normalize(q) for q in queries]
+                user_hosts = [row[1] for row in statements]
+                timed('accept', len(queries),
+                      lambda: [reducer.accept(u, n[0]) for u, n in zip(user_hosts, normalized)])
+            if 'reduce_rows' in stages:
+                timed('reduce_rows', len(statements), create_reduced_log.reduce_rows, statements,
+                      NullFile(), dims)
+    finally:
+        if os.path.exists(logfile):
+            os.remove(logfile)
+
+    return dict((stage, tuple(total)) for stage, total in totals.iteritems())
+
+
+def bench_db(rows, month, seed=0):
+    """
+    Load @rows rows from a LogGenerator seeded with @seed into
+    general_log.@month, and reduce them into reduced_log.@month with the
+    --reduce settings from the config, replacing both tables. Returns a
+    dict mapping 'load' and 'reduce_log' to (rows, seconds)
+    """
+
+    import create_reduced_log
+
+    starttime = time.time()
+    writer = TableWriter(month, replace = True)
+    for row in LogGenerator(month, rows, seed):
+        writer.write_row(row)
+    writer.close()
+    loaded = time.time()
+
+    db = get_conn()
+    cur = db.cursor()
+    cur.execute("USE reduced_log")
+    create_reduced_log.create_progress_table(cur)
+    cur.execute("DROP TABLE IF EXISTS {0}".format(month))
+    cur.execute("DELETE FROM reduce_progress WHERE tablename = %s", (month,))
+    db.commit()
+
+    reduced = time.time()
+    create_reduced_log.reduce_log(month, cur,
+                                  processes = config.get('reduce_processes') or 1,
+                                  chunks = config.get('reduce_chunks') or 1,
+                                  sink = config.get('reduce_sink') or 'tempfile',
+                                  index_later = config.get('reduce_index_later') or False,
+                                  batch_rows = config.get('reduce_batch_rows') or 100000,
+                                  fetch_rows = config.get('reduce_fetch_rows') or 1000,
+                                  queue_depth = config.get('reduce_queue_depth') or 8)
+    done = time.time()
+    cur.close()
+    db.close()
+
+    return {'load': (rows, loaded - starttime), 'reduce_log': (rows, done - reduced)}
+
+
+def bench_topqueries(month, numtop=200):
+    """
+    Count the top @numtop queries of all users and of each user in
+    reduced_log.@month, exactly (load_query_counts()) and approximately
+    (approximate_topqueries()). Returns a dict mapping 'exact_top' and
+    'approx_top' to (rows, seconds)
+    """
+
+    from Filter import load_query_counts, approximate_topqueries
+
+    db = get_conn()
+    cur = db.cursor()
+    cur.execute("USE reduced_log")
+    cur.execute("SELECT COUNT(*) FROM {0}".format(month))
+    (rows,), = cur.fetchall()
+    cur.execute("SELECT userid, user FROM users")
+    usernames = dict(cur.fetchall())
+
+    starttime = time.time()
+    load_query_counts(month, cur).select().top(numtop, usernames)
+    exact = time.time()
+    approximate_topqueries(month, numtop, cur)
+    done = time.time()
+    cur.close()
+    db.close()
+
+    return {'exact_top': (rows, exact - starttime), 'approx_top': (rows, done - exact)}
+
+
+def bench_suite(scales, stages=suite_stages, seed=0, batch_rows=10000, metrics_file=None, month=None):
+    """
+    Run bench_stages() (and bench_db() and bench_topqueries() if @month
+    is given) at each of @scales rows, print the rows/sec of each stage,
+    and append them to @metrics_file if given
+    """
+
+    for rows in scales:
+        starttime = time.time()
+        results = bench_stages(rows, stages, seed, batch_rows)
+        if month:
+            results.update(bench_db(rows, month, seed))
+            results.update(bench_topqueries(month, config.get('numtop') or 200))
+
+        print "{0} rows, seed {1}, {2:.0f} sec".format(rows, seed, time.time() - starttime)
+        print "{0: <12} {1: >12} {2: >10} {3: >12}".format('', 'rows', 'seconds', 'rows/sec')
+        for stage in suite_stages + ('load', 'reduce_log', 'exact_top', 'approx_top'):
+            if stage in results:
+                nrows, seconds = results[stage]
+                print "{0: <12} {1: >12} {2: >10.2f} {3: >12.0f}".format(
+                    stage, nrows, seconds, nrows / seconds if seconds else 0)
+        print
+
+        write_metrics(metrics_file, {'event': 'benchmark', 'rows': rows, 'seed': seed,
+                                     'batch_rows': batch_rows, 'peak_rss_kb': peak_rss_kb(),
+                                     'stages': dict((stage, {'rows': nrows, 'seconds': seconds})
+                                                    for stage, (nrows, seconds) in results.iteritems())})
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 3 and sys.argv[1] == 'normalizer':
+        bench_normalizer(load_sample(*sys.argv[2:4]))
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'suite':
+        try:
+            opts, args = getopt.gnu_getopt(sys.argv[2:], '', ['seed=', 'stages=', 'batch=',
+                                                              'metrics=', 'db='])
+            opts = dict(opts)
+            scales = [int(x) for x in args] or [1000000]
+            stages = opts['--stages'].split(',') if '--stages' in opts else suite_stages
+            if set(stages) - set(suite_stages):
+                raise ValueError
+        except (getopt.GetoptError, ValueError):
+            print __doc__
+            sys.exit(1)
+        bench_suite(scales, stages, int(opts.get('--seed', 0)), int(opts.get('--batch', 10000)),
+                    opts.get('--metrics'), opts.get('--db'))
+    else:
+        print __doc__
+        sys.exit(1)
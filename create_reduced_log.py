@@ -1,234 +1,1207 @@
-import sys
-import os
 import re
+import sys
+import time
+import getopt
+from datetime import datetime
+from itertools import groupby
+from collections import defaultdict
+from multiprocessing import Pool
 
-from myutils import get_conn, get_reserved_words, print_and_execute, clean, repl_constants, querytypes, define_time_functions, partition_from_str, config
+from MySQLdb import DatabaseError
+
+from myutils import get_conn, get_reserved_words, print_and_execute, querytypes, partition_from_str, config
+from myutils import hour_bucket_sql, hour_bucket
 from QueryReducer import QueryReducer
+from Normalizer import Normalizer, NormalizeCache
+from Sinks import sink_types
+from Dimensions import DimensionCache, MemoryDimensions, NAME_LEN
+from LogFile import LogFileReader
+from Pipeline import StallQueue, Fetcher, Writer, WriterQueue
+from Metrics import Metrics, add_records, write_metrics
 
 reducer = QueryReducer( **(config.get('reducer') or {}) )
     
 reserved_words = get_reserved_words('mysql_keywords.txt')
 
-numlist_re = re.compile(r'\([0-9, ]{20,}\)')
-numlist_sub_fcn = lambda x: '<numlist len={0}>'.format(x.group(0).count(',') + 1)
+normalizer = NormalizeCache(Normalizer(reserved_words), **(config.get('normalize_cache') or {}))
 
-# TODO: make this regex accept dots in table names
-insert_re = re.compile(r"(INSERT INTO ['`]?\w+['`]?)")
+def month_bounds(tablename):
+    """
+    Return datetimes for the start of the month named by @tablename (eg
+    '2010_04') and the start of the month after it
+    """
+
+    year, month = [int(x) for x in tablename.split('_')]
+    if month == 12:
+        return datetime(year, 12, 1), datetime(year + 1, 1, 1)
+    return datetime(year, month, 1), datetime(year, month + 1, 1)
 
-values_re = re.compile(r'VALUES', re.I)
 
-def reduce_log(tablename, cur):
+def chunk_bounds(start, end, nchunks):
+    """
+    Split the stretch of time from @start to @end into @nchunks equal
+    chunks. Returns a list of (lo, hi) pairs, meaning lo <= event_time < hi
+    """
 
-    print >>sys.stderr, "Reducing general_log.{0} and storing into reduced_log".format(tablename)
-    print >>sys.stderr, "Selecting results..."
+    step = (end - start) / nchunks
+    edges = [start + step * i for i in range(nchunks)] + [end]
+    return zip(edges[:-1], edges[1:])
 
-    cur.execute("USE reduced_log")
-    print_and_execute("SELECT user, userid FROM users", cur)
-    users = dict(cur.fetchall())
-    usernum = max(users.values()) + 1 if users.values() else 0 # first open usernum
-    newusers = []
 
-    print_and_execute("SELECT server, serverid FROM servers", cur)
-    servers = dict(cur.fetchall())
-    servernum = max(servers.values()) + 1 if servers.values() else 0 # first open servernum
-    newservers = []
+def plan_chunks(tablename, last_end, now, nchunks):
+    """
+    Return the (lo, hi) bounds of the chunks of general_log.@tablename
+    that still have to be reduced, given that everything before @last_end
+    already has been (None if nothing has been planned yet; a table whose
+    last chunk has no upper bound needs no new chunks at all). @now is
+    the current time on the MySQL server.
 
-    cur.execute('USE general_log')
-    print_and_execute("""SELECT * FROM {0} WHERE command_type IN ('Execute', 'Query')""".format(tablename), cur)
+    The first reduction of a table has no lower bound, and once the month
+    is over the last chunk has no upper bound, so rows that fall outside
+    the month are not lost. While the month is still going, the last chunk
+    ends at @now, and the next run picks up from there.
+    """
 
-    print >>sys.stderr, "Selected results, cleaning queries and writing temp file..."
+    month_start, month_end = month_bounds(tablename)
+    start = last_end or month_start
+    end = min(now, month_end)
+    if start >= end:
+        if now < month_end:
+            return []
+        # Month closed exactly where the last run stopped
+        return [(last_end, None)]
 
-    temp_filename = '{0}_reduced.tmp'.format(tablename)
-    outfile = open(temp_filename, 'w')
+    bounds = chunk_bounds(start, end, nchunks)
+    if last_end is None:
+        bounds[0] = (None, bounds[0][1])
+    if now >= month_end:
+        bounds[-1] = (bounds[-1][0], None)
+    return bounds
 
-    for event_time, user_host, thread_id, server_id, command_type, query in cur:
 
-        cleaned_query = clean(query, reserved_words)
-        # Clean the query some more: remove numlists, replace constants
-        cleaned_query = numlist_re.sub(numlist_sub_fcn, cleaned_query)
-        try:
-            user, server, cleaned_query = reducer.accept(user_host, cleaned_query)
-        except TypeError:
+def chunk_condition(lo, hi, watermark=None):
+    """
+    SQL condition selecting the rows of the chunk lo <= event_time < hi
+    (see plan_chunks()) that come after @watermark, the last event_time
+    already reduced
+    """
+
+    conditions = ["command_type IN ('Execute', 'Query')"]
+    if watermark is not None:
+        conditions.append("event_time > '{0}'".format(watermark.isoformat()))
+    elif lo is not None:
+        conditions.append("event_time >= '{0}'".format(lo.isoformat()))
+    if hi is not None:
+        conditions.append("event_time < '{0}'".format(hi.isoformat()))
+    return ' AND '.join(conditions)
+
+
+def reduce_rows(rows, outfile, dims, checkpoint=None, batch_rows=None, metrics=None):
+    """
+    Run the reducer over @rows (tuples of general_log columns) and write the
+    accepted ones to @outfile in LOAD DATA format. user_hosts and query
+    templates are replaced by their ids through @dims, a DimensionCache.
+
+    If @checkpoint is given, it is called as checkpoint(event_time) with
+    the event_time of the last row read, every @batch_rows rows or so.
+    Batches only end where event_time changes, so that every row up to and
+    including the checkpointed event_time has been written. @rows must
+    come in event_time order (see reduce_chunk()).
+
+    If @metrics (a Metrics) is given, the rows written of each query type
+    are counted in it, and if it is timing, so is the time spent
+    normalizing, in the reducer, looking up ids, and writing.
+
+    Returns a tuple (number of rows written, event_time of the last row
+    read)
+    """
+
+    written = 0
+    batch = 0
+    last_time = None
+    # Rows come in event_time order, so the bucket is the same for runs of rows
+    bucket_time = bucket = None
+    timing = metrics and metrics.timing
+    if metrics:
+        counts, seconds = metrics.counts, metrics.seconds
+    for event_time, user_host, thread_id, server_id, command_type, query in rows:
+
+        if checkpoint and batch >= batch_rows and event_time != last_time:
+            checkpoint(last_time)
+            batch = 0
+        batch += 1
+        last_time = event_time
+
+        if timing:
+            starttime = time.time()
+        cleaned_query, query_type, template, vals = normalizer.normalize(query)
+        if timing:
+            normalized = time.time()
+            seconds['normalize'] += normalized - starttime
+        if not reducer.accept(user_host, cleaned_query):
+            if timing:
+                seconds['accept'] += time.time() - normalized
             continue
-        cleaned_query, vals = repl_constants(cleaned_query)
-        vals = ' ~ '.join(vals)
-
-        if user not in users:
-            users[user] = usernum
-            newusers.append(user)
-            usernum += 1
-        if server not in servers:
-            servers[server] = servernum
-            newservers.append(server)
-            servernum += 1
-            
-        if cleaned_query.startswith('INSERT INTO'):
-            query_type = 'INSERT'
-            if values_re.search(cleaned_query):
-                #TODO: count number of rows inserted. Nontrivial because of parens, commas, quotes, etc.
-                cleaned_query = insert_re.match(cleaned_query).group(0) + ' <values>'
-                vals = ''
-        elif cleaned_query.startswith('SELECT'):
-            query_type = 'SELECT'
-        elif cleaned_query.startswith('CREATE TABLE'):
-            # Replacing schemas with length + hash doesn't help much.
-            # There aren't many create table statements (~1%)
-            # cleaned_query = re.sub(r'\(.*\)',
-            #                        lambda x: '<schema len={0}, hash={1}>'.format(x.group().count(',')+1, x.group().__hash__()),
-            #                        cleaned_query)
-            query_type = 'CREATE_TABLE'
-        elif cleaned_query.startswith('SET'):
-            query_type = 'SET'
-        elif cleaned_query.startswith('LOAD DATA'):
-            query_type = 'LOAD'
-        elif cleaned_query.startswith('ALTER'):
-            query_type = 'ALTER'
-        else:
-            query_type = 'OTHER'
+        if timing:
+            accepted = time.time()
+            seconds['accept'] += accepted - normalized
+
+        userid, serverid = dims.ids(user_host)
+        queryid = dims.queryid(template, query_type)
+        if timing:
+            looked_up = time.time()
+            seconds['ids'] += looked_up - accepted
 
         #we ignore server_id because it's always 0...
-        cleaned_query = repr(cleaned_query)[1:-1] #deal with \n and others
-        final = event_time, users[user], servers[server], thread_id, query_type, cleaned_query, vals
+        #repr() deals with \n and others, in string literals too
+        vals = repr(' ~ '.join(vals))[1:-1]
+        if event_time != bucket_time:
+            bucket = hour_bucket(event_time)
+            bucket_time = event_time
+        final = event_time, userid, serverid, thread_id, query_type, queryid, vals, bucket
         print >>outfile, '\t'.join(str(s) for s in final)
-        
-    outfile.close()
+        written += 1
+        if metrics:
+            counts['rows_' + query_type] += 1
+            if timing:
+                seconds['format'] += time.time() - looked_up
+
+    return written, last_time
+
+
+def rule_metrics(before):
+    """
+    Returns a dict of the rows rejected and seconds spent by each reducer
+    rule since reducer.stats() returned @before
+    """
+
+    return dict((name, {'rejected': hits - before[name][0], 'seconds': seconds - before[name][1]})
+                for name, (hits, seconds) in reducer.stats().iteritems())
+
+
+class CountingIterator(object):
+    """
+    Wraps an iterator and counts the items taken from it
+    """
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        item = self.iterator.next()
+        self.count += 1
+        return item
+
+
+def reduce_chunk(task):
+    """
+    Reduce one chunk of a general_log table into a sink (see Sinks.py), on
+    connections of its own. @task is a tuple (tablename, chunknum, lo, hi,
+    watermark, sink type, batch rows, fetch rows, queue depth, timing),
+    see plan_chunks() and chunk_condition(). Used as the task function of
+    the process pool in reduce_tables().
+
+    The rows are read in event_time order, and loaded and committed in
+    batches of about @batch rows, each in the same transaction as the
+    chunk's new watermark in reduce_progress, so an interrupted chunk can
+    be resumed from the last batch.
+
+    The work is pipelined over three threads (see Pipeline.py), so that
+    the db and the CPU are kept busy at once: a Fetcher pulls rows from
+    the general_log in blocks of @fetch_rows, this thread reduces them,
+    and a Writer writes them to the sink and runs the checkpoints. They
+    are linked by queues of @queue_depth blocks.
+
+    Returns a tuple (tablename, chunknum, rows read, rows written,
+    seconds taken, stats), stats being a Metrics.record() dict with, on
+    top of the usual counts and seconds (per-row stage times only if
+    @timing is True):
+
+    'normalize_cache' - hits, disk_hits and misses of the normalize cache
+    'rules'           - rows rejected and seconds spent in each reducer
+                        rule
+    'pipeline'        - the StallQueue stats of the 'fetch' and 'write'
+                        queues
+    """
+
+    (tablename, chunknum, lo, hi, watermark, sink_type, batch_rows, fetch_rows, queue_depth,
+     timing) = task
+    starttime = time.time()
+    metrics = Metrics(timing)
+    cache_counts = normalizer.counts()
+    rule_stats = reducer.stats()
+
+    db = get_conn(dbname = 'general_log')
+    cur = db.cursor()
+
+    # userids, serverids and queryids are handed out on a separate connection, since
+    # @cur will be busy streaming the general_log table
+    id_db = get_conn(dbname = 'reduced_log')
+    id_cur = id_db.cursor()
 
-    print >>sys.stderr, "Wrote temp file, loading data into {0} table...".format(tablename)
+    sink = sink_types[sink_type](tablename, chunknum)
 
+    # Run by the Writer, once everything before it is written
+    def checkpoint(event_time, done=False):
+        sink.flush()
+        sink.cur.execute("""UPDATE reduce_progress
+                            SET event_time = COALESCE(%s, event_time),
+                                done = %s
+                            WHERE tablename = %s AND chunknum = %s""",
+                         (event_time, done, tablename, chunknum))
+        sink.db.commit()
+
+    fetcher = outfile = None
+    try:
+        dims = DimensionCache(id_cur)
+
+        # The watermark only holds if the rows come in event_time order
+        print_and_execute("SELECT * FROM {0} WHERE {1} ORDER BY event_time".format(
+            tablename, chunk_condition(lo, hi, watermark)), cur)
+
+        fetch_queue = StallQueue(queue_depth)
+        fetcher = Fetcher(cur, fetch_queue, fetch_rows)
+        fetcher.start()
+        write_queue = StallQueue(queue_depth)
+        writer = Writer(write_queue, sink, checkpoint)
+        writer.start()
+        outfile = WriterQueue(write_queue, writer)
+
+        def queue_checkpoint(event_time, done=False):
+            # The sqlite connection of the normalize cache belongs to this thread
+            normalizer.save()
+            outfile.checkpoint(event_time, done)
+
+        rows = CountingIterator(fetcher.rows())
+        written, last_time = reduce_rows(rows, outfile, dims, queue_checkpoint, batch_rows, metrics)
+        queue_checkpoint(last_time, True)
+        outfile.close()
+        sink.close()
+    except:
+        # Nothing may use a connection once it is closed, nor @cur while
+        # the fetcher still is
+        if fetcher:
+            fetcher.stop()
+        if outfile:
+            outfile.abort()
+        sink.abort()
+        raise
+    finally:
+        id_cur.close()
+        id_db.close()
+        cur.close()
+        db.close()
+
+    metrics.counts.update(rows_read = rows.count, rows_written = written,
+                          bytes_written = sink.bytes_written)
+    metrics.seconds.update(write = writer.write_seconds, checkpoint = writer.checkpoint_seconds,
+                           load = sink.load_seconds)
+    cache_counts = [after - before for after, before in zip(normalizer.counts(), cache_counts)]
+    stats = metrics.record('chunk', table = tablename, chunk = chunknum,
+                           normalize_cache = dict(zip(('hits', 'disk_hits', 'misses'), cache_counts)),
+                           rules = rule_metrics(rule_stats),
+                           pipeline = {'fetch': fetch_queue.stats(), 'write': write_queue.stats()})
+    return tablename, chunknum, rows.count, written, time.time() - starttime, stats
+
+
+# (name, columns) of the secondary indexes of reduced tables. The single
+# column ones are named by MySQL's default. time_buckets covers the columns
+# that query_profile() groups by, so grouping only reads the index
+reduced_indexes = (('userid', 'userid'), ('serverid', 'serverid'), ('event_time', 'event_time'),
+                   ('queryid', 'queryid'),
+                   ('time_buckets', 'userid, query_type, hour_bucket'))
+
+# The buckets of the coarser periods, which older versions stored too
+old_bucket_columns = ('day_bucket', 'week_bucket', 'month_bucket', 'year_bucket')
+
+def create_reduced_table(tablename, cur, index_later=False):
+    """
+    Create the reduced_log table for @tablename, unless it exists already.
+    If @index_later is True, the secondary indexes are left out, to be
+    added by add_indexes() once the table is loaded
+    """
+
+    indexes = '' if index_later else ''.join(',\n INDEX {0} ({1})'.format(name, columns)
+                                             for name, columns in reduced_indexes)
     cur.execute("USE reduced_log")
-    cur.execute("""CREATE TABLE {0} (event_time DATETIME,
-                                     userid INT,
-                                     serverid INT,
-                                     thread_id INT(11),
-                                     query_type ENUM{1},
-                                     query MEDIUMTEXT,
-                                     vals MEDIUMTEXT,
-                                     INDEX (userid),
-                                     INDEX (serverid),
-                                     INDEX (event_time)
-                                    )""".format(tablename, querytypes))
-
-    cur.execute("LOAD DATA LOCAL INFILE '{0}' INTO TABLE {1}".format(temp_filename, tablename))
-    os.remove(temp_filename)
-
-    print >>sys.stderr, "Loaded data and removed temp file. Adding into users table..."
-
-    for user in newusers:
-        cur.execute("INSERT INTO users VALUES ('{0}', {1})".format(user, users[user]))
-    
-    print >>sys.stderr, "Added into users table, adding into servers table..."
+    cur.execute("""CREATE TABLE IF NOT EXISTS {0} (event_time DATETIME,
+                                                   userid INT,
+                                                   serverid INT,
+                                                   thread_id INT(11),
+                                                   query_type ENUM{1},
+                                                   queryid INT,
+                                                   vals MEDIUMTEXT,
+                                                   hour_bucket INT{2}
+                                                  ) ENGINE=InnoDB""".format(tablename, querytypes, indexes))
+
+
+def add_indexes(tablename, cur):
+    """
+    Build the secondary indexes of a reduced table that it doesn't have
+    yet (all of them, for a table created with index_later=True, or those
+    added since, for a table made by older versions), all in one pass over
+    the table. Does nothing if the table already has them
+    """
+
+    cur.execute("SHOW INDEX FROM {0}".format(tablename))
+    indexed = set(row[2] for row in cur.fetchall()) # Key_name
+    missing = [(name, columns) for name, columns in reduced_indexes if name not in indexed]
+    if not missing:
+        return
+    print_and_execute("ALTER TABLE {0} {1}".format(tablename,
+                                                   ', '.join('ADD INDEX {0} ({1})'.format(name, columns)
+                                                             for name, columns in missing)), cur)
+
+
+def index_event_time(tablename, cur):
+    """
+    Index the event_time of general_log.@tablename, unless it is already,
+    so that chunks are read in event_time order (see reduce_chunk())
+    without sorting them. Tables that can't be indexed (eg CSV ones) are
+    sorted instead
+    """
+
+    cur.execute("SHOW INDEX FROM general_log.{0}".format(tablename))
+    # Column_name of the first column of each index
+    if 'event_time' in set(row[4] for row in cur.fetchall() if row[3] == 1):
+        return
+    try:
+        print_and_execute("ALTER TABLE general_log.{0} ADD INDEX event_time (event_time)".format(tablename), cur)
+    except DatabaseError as e:
+        print >>sys.stderr, "Can't index the event_time of {0} ({1}); its rows will be sorted".format(tablename, e)
+
+
+def create_queries_table(cur):
+    """
+    Create the queries table, unless it exists already. It holds the text
+    of every distinct query template; the reduced tables refer to it by
+    queryid. query_hash is the SHA1 of the text, so that the same template
+    is never stored twice
+    """
+
+    cur.execute("""CREATE TABLE IF NOT EXISTS queries (queryid INT NOT NULL AUTO_INCREMENT,
+                                                       query_hash BINARY(20) NOT NULL,
+                                                       query_type ENUM{0},
+                                                       query MEDIUMTEXT,
+                                                       PRIMARY KEY (queryid),
+                                                       UNIQUE KEY (query_hash)
+                                                      )""".format(querytypes))
+
+
+def create_rollup_table(cur):
+    """
+    Create the hourly_counts table, unless it exists already. It holds the
+    number of rows of the unified table in each hour, for each user,
+    server and query type, so that the tool can plot them over time
+    without counting the rows. The counts are kept by partition of unified
+    (see rollup_partition())
+    """
+
+    cur.execute("""CREATE TABLE IF NOT EXISTS hourly_counts (partition_name VARCHAR(64) NOT NULL,
+                                                             hour DATETIME NOT NULL,
+                                                             userid INT NOT NULL,
+                                                             serverid INT NOT NULL,
+                                                             query_type ENUM{0} NOT NULL,
+                                                             count INT NOT NULL,
+                                                             PRIMARY KEY (partition_name, hour, userid,
+                                                                          serverid, query_type),
+                                                             INDEX (hour)
+                                                            )""".format(querytypes))
 
-    for server in newservers:
-        cur.execute("INSERT INTO servers VALUES ('{0}', {1})".format(server, servers[server]))
 
-    db.commit()
+def rollup_partition(partition, cur):
+    """
+    (Re)count the rows of the @partition partition of unified into
+    hourly_counts, replacing its old counts, in one transaction
+    """
+
+    cur.execute("DELETE FROM hourly_counts WHERE partition_name = %s", (partition,))
+    print_and_execute("""INSERT INTO hourly_counts
+                         SELECT '{0}',
+                                event_time - INTERVAL MINUTE(event_time) MINUTE
+                                           - INTERVAL SECOND(event_time) SECOND AS hour,
+                                userid, serverid, query_type, COUNT(*)
+                         FROM unified PARTITION ({0})
+                         GROUP BY hour, userid, serverid, query_type""".format(partition), cur)
+    cur.connection.commit()
+
+
+def create_progress_table(cur):
+    """
+    Create the reduce_progress table, unless it exists already. It has a
+    row for each chunk of each table that --reduce has worked on, with the
+    chunk's bounds and a watermark: the event_time of the last row reduced
+    and committed. The watermark is committed with the rows, so it and the
+    reduced tables must be transactional. 'unified' is set on the rows of
+    a table once unify() has put its rows in unified (see mark_unified())
+    """
 
-    print >>sys.stderr, "Added into servers table. Defining time functions..."
+    cur.execute("""CREATE TABLE IF NOT EXISTS reduce_progress (tablename VARCHAR(64) NOT NULL,
+                                                               chunknum INT NOT NULL,
+                                                               chunk_start DATETIME NULL,
+                                                               chunk_end DATETIME NULL,
+                                                               event_time DATETIME NULL,
+                                                               done BOOL NOT NULL DEFAULT FALSE,
+                                                               unified BOOL NOT NULL DEFAULT FALSE,
+                                                               PRIMARY KEY (tablename, chunknum)
+                                                              ) ENGINE=InnoDB""")
 
-    # This redefines the time fcns for every table reduced, but that's a small cost
-    define_time_functions(cur)
 
-    print >>sys.stderr, "Defined time functions. Reduction complete"
+def get_progress(cur):
+    """
+    Returns a dict mapping table names to lists of (chunknum, chunk_start,
+    chunk_end, event_time, done) tuples from reduce_progress, in chunk
+    order
+    """
+
+    cur.execute("""SELECT tablename, chunknum, chunk_start, chunk_end, event_time, done
+                   FROM reduced_log.reduce_progress
+                   ORDER BY tablename, chunknum""")
+    progress = {}
+    for row in cur.fetchall():
+        progress.setdefault(row[0], []).append(row[1:])
+    return progress
+
+
+def reduction_finished(chunks):
+    """
+    True if all the @chunks of a table (a value of the get_progress() dict)
+    are done and the last one has no upper bound, ie the month was over
+    when it was planned
+    """
+
+    return all(done for chunknum, lo, hi, watermark, done in chunks) and chunks[-1][2] is None
+
+
+def tables_to_reduce(cur):
+    """
+    Return the general_log tables that --reduce has work to do on: those
+    with no reduced table yet, those with unfinished chunks, and those
+    whose month was still going on at the last run. Reduced tables made
+    before reduce_progress existed count as finished.
+    """
+
+    cur.execute("SHOW TABLES FROM general_log")
+    gen_log_tables = set(x for x, in cur.fetchall())
+
+    cur.execute("SHOW TABLES FROM reduced_log")
+    red_log_tables = set(x for x, in cur.fetchall())
+
+    progress = get_progress(cur)
+
+    to_reduce = gen_log_tables - red_log_tables
+    for tablename, chunks in progress.iteritems():
+        if tablename in gen_log_tables and not reduction_finished(chunks):
+            to_reduce.add(tablename)
+
+    return sorted(to_reduce)
+
+
+def reduce_log(tablename, cur, **kwargs):
+    """
+    Reduce general_log.@tablename into reduced_log.@tablename. See
+    reduce_tables() for the keyword arguments
+    """
+
+    reduce_tables([tablename], cur, **kwargs)
+
+
+def reduce_tables(tablenames, cur, processes=1, chunks=1, chunk_stats=False,
+                  sink='tempfile', index_later=False, batch_rows=100000,
+                  fetch_rows=1000, queue_depth=8, metrics_file=None):
+    """
+    Reduce each of the general_log tables in @tablenames into a table of
+    the same name in reduced_log.
+
+    The work on each table is split into chunks, each a stretch of
+    event_time, recorded in reduce_progress. Chunks left unfinished by an
+    earlier run are resumed from their watermark. The rest of the table
+    (all of it, if it hasn't been reduced before, or what was logged since
+    the last run if its month was still going on) is split into @chunks
+    new chunks; see plan_chunks(). With @processes greater than 1 the
+    chunks of all the tables are spread across a pool of that many worker
+    processes, each with its own db connections, so a single busy month
+    can still use all the cores. Rows are committed in batches of about
+    @batch_rows. Within a chunk, fetching, reducing and writing overlap;
+    see reduce_chunk() for @fetch_rows and @queue_depth.
+
+    @sink is a key of Sinks.sink_types. With 'tempfile', each batch is
+    written to local disk before it is loaded; with 'fifo' it is streamed
+    into the table through a named pipe while it is being reduced. Either
+    way, a table reduced in one chunk ends up the same as it did before
+    chunking; with more chunks the rows are the same, but chunks reduced
+    at once end up interleaved.
+
+    If @index_later is True, new tables are created without their
+    secondary indexes, which are built once after all the rows are in.
+
+    If @chunk_stats is True, the rows read and rows/sec of every chunk, how
+    often the normalize cache was hit and how long each pipeline stage
+    waited on the others are reported on stderr, and so are the rows
+    dropped by each reducer rule at the end.
+
+    If @metrics_file is given, the stats of every chunk, and their totals
+    for every table, are appended to it as lines of JSON (see Metrics.py),
+    with the time spent in each stage of reduce_rows() measured as well
+    """
+
+    cur.execute("USE reduced_log")
+    create_progress_table(cur)
+    create_queries_table(cur)
+    cur.execute("SELECT NOW()")
+    now, = cur.fetchall()[0]
+    progress = get_progress(cur)
+
+    tasks = []
+    for tablename in tablenames:
+        index_event_time(tablename, cur)
+        create_reduced_table(tablename, cur, index_later)
+
+        chunkinfo = progress.get(tablename, [])
+        for chunknum, lo, hi, watermark, done in chunkinfo:
+            if not done:
+                tasks.append((tablename, chunknum, lo, hi, watermark, sink, batch_rows,
+                              fetch_rows, queue_depth, bool(metrics_file)))
+
+        if chunkinfo and chunkinfo[-1][2] is None:
+            # The month was over when its chunks were planned, and the last
+            # one has no upper bound: there is nothing left to plan
+            continue
+        last_end = chunkinfo[-1][2] if chunkinfo else None
+        first_chunknum = chunkinfo[-1][0] + 1 if chunkinfo else 0
+        for chunknum, (lo, hi) in enumerate(plan_chunks(tablename, last_end, now, chunks), first_chunknum):
+            cur.execute("""INSERT INTO reduce_progress (tablename, chunknum, chunk_start, chunk_end)
+                           VALUES (%s, %s, %s, %s)""", (tablename, chunknum, lo, hi))
+            tasks.append((tablename, chunknum, lo, hi, None, sink, batch_rows,
+                          fetch_rows, queue_depth, bool(metrics_file)))
+    cur.connection.commit()
+
+    remaining = dict((tablename, 0) for tablename in tablenames)
+    for task in tasks:
+        remaining[task[0]] += 1
+
+    if processes > 1 and len(tasks) > 1:
+        print >>sys.stderr, "Reducing {0} tables in {1} chunks with {2} processes".format(
+            len(tablenames), len(tasks), processes)
+        pool = Pool(processes)
+        results = pool.imap_unordered(reduce_chunk, tasks)
+    else:
+        pool = None
+        results = (reduce_chunk(task) for task in tasks)
+
+    table_stats = dict((tablename, {'event': 'table', 'table': tablename}) for tablename in tablenames)
+    total_rule_stats = {}
+    try:
+        for tablename, chunknum, nread, nwritten, seconds, stats in results:
+            write_metrics(metrics_file, stats)
+            add_records(table_stats[tablename], dict((key, stats[key]) for key in
+                                                     ('counts', 'seconds', 'rules', 'peak_rss_kb')))
+            add_records(total_rule_stats, stats['rules'])
+            if chunk_stats:
+                print >>sys.stderr, "{0} chunk {1}: read {2} rows, wrote {3} in {4:.1f} sec ({5:.0f} rows/sec)".format(
+                    tablename, chunknum, nread, nwritten, seconds, nread / seconds if seconds else 0)
+                print >>sys.stderr, "{0} chunk {1}: normalize cache hits {2[hits]}, from disk {2[disk_hits]}, misses {2[misses]}".format(
+                    tablename, chunknum, stats['normalize_cache'])
+                fetch, write = stats['pipeline']['fetch'], stats['pipeline']['write']
+                # A stage that is never waited on by the others is the bottleneck
+                print >>sys.stderr, ("{0} chunk {1}: fetcher waited {2:.1f} sec, reducer waited {3:.1f} sec for rows "
+                                     "and {4:.1f} sec for the writer, writer waited {5:.1f} sec; "
+                                     "queue depths mean/max: fetch {6:.1f}/{7}, write {8:.1f}/{9}").format(
+                    tablename, chunknum, fetch['put_stall'], fetch['get_stall'], write['put_stall'],
+                    write['get_stall'], fetch['mean_depth'], fetch['max_depth'],
+                    write['mean_depth'], write['max_depth'])
+            remaining[tablename] -= 1
+            if not remaining[tablename]:
+                if index_later:
+                    starttime = time.time()
+                    add_indexes(tablename, cur)
+                    table_stats[tablename]['seconds']['index'] = time.time() - starttime
+                write_metrics(metrics_file, table_stats[tablename])
+                print >>sys.stderr, "Reduction of {0} complete".format(tablename)
+        if pool:
+            pool.close()
+    except:
+        if pool:
+            pool.terminate()
+        raise
+    finally:
+        if pool:
+            pool.join()
+
+    if chunk_stats or reducer.profile:
+        print >>sys.stderr, "Rows dropped by each reducer rule (and seconds spent in it):"
+        for rule in reducer.rules:
+            if rule.name in total_rule_stats:
+                dropped, rule_seconds = total_rule_stats[rule.name]['rejected'], total_rule_stats[rule.name]['seconds']
+                print >>sys.stderr, "    {0: <16} {1: >12} {2: >10.2f}".format(rule.name, dropped, rule_seconds)
+
+
+def reduce_files(filenames, cur, sink='tempfile', index_later=False, batch_rows=100000,
+                 metrics_file=None):
+    """
+    Reduce general query log files (see LogFile.py), which may be
+    compressed, straight into the reduced_log, without loading them into
+    general_log tables first. Each row goes to the table of its month,
+    created if needed. See reduce_tables() for the keyword arguments.
+
+    Rows are committed in batches, but nothing records how far a file got,
+    so a file whose reduction failed should be reduced again only after
+    dropping the tables it was writing to. Likewise, a month shouldn't be
+    reduced from both a file and a general_log table.
+    """
+
+    cur.execute("USE reduced_log")
+    create_queries_table(cur)
+    cur.execute("SHOW TABLES")
+    existing_tables = set(x for x, in cur.fetchall())
+    dims = DimensionCache(cur)
+
+    tablenames = set()
+    for filename in filenames:
+        starttime = time.time()
+        metrics = Metrics(bool(metrics_file))
+        rule_stats = reducer.stats()
+        print >>sys.stderr, "Reducing {0}".format(filename)
+        rows = CountingIterator(LogFileReader(filename))
+        queries = (row for row in rows if row[4] in ('Execute', 'Query'))
+
+        written = 0
+        for tablename, month_rows in groupby(queries, lambda row: row[0].strftime('%Y_%m')):
+            if tablename in existing_tables:
+                print >>sys.stderr, "Adding rows to {0}, which already existed".format(tablename)
+                existing_tables.remove(tablename)
+            create_reduced_table(tablename, cur, index_later)
+            tablenames.add(tablename)
+
+            month_sink = sink_types[sink](tablename, 'file')
+            def checkpoint(event_time):
+                month_sink.flush()
+                month_sink.db.commit()
+            try:
+                written += reduce_rows(month_rows, month_sink, dims, checkpoint, batch_rows, metrics)[0]
+                month_sink.close()
+            except:
+                month_sink.abort()
+                raise
+            metrics.counts['bytes_written'] += month_sink.bytes_written
+            metrics.seconds['load'] += month_sink.load_seconds
+
+        metrics.counts.update(rows_read = rows.count, rows_written = written)
+        write_metrics(metrics_file, metrics.record('file', file = filename, rules = rule_metrics(rule_stats)))
+        seconds = time.time() - starttime
+        print >>sys.stderr, "{0}: read {1} entries, wrote {2} rows in {3:.1f} sec ({4:.0f} entries/sec)".format(
+            filename, rows.count, written, seconds, rows.count / seconds if seconds else 0)
+
+    if index_later:
+        for tablename in sorted(tablenames):
+            starttime = time.time()
+            add_indexes(tablename, cur)
+            write_metrics(metrics_file, {'event': 'index', 'table': tablename,
+                                         'seconds': {'index': time.time() - starttime}})
+
+
+# Fewest statements of each user_host that a stratified sample should have
+stratum_min_rows = 100
+
+def sample_rows(tablename, cur, fraction, stratified=False, seed=0):
+    """
+    Yields (row, weight) for a random sample of about @fraction of the
+    statements in general_log.@tablename: row is the general_log columns,
+    as reduce_rows() takes them, and weight the number of statements it
+    stands for (1 / its chance of being sampled). @seed seeds MySQL's
+    RAND(), so the same seed gives the same sample.
+
+    If @stratified is True, the sample is stratified by user_host: those
+    with too few statements to get stratum_min_rows into the sample are
+    sampled at a higher rate (all their statements, if need be), so that
+    rare users are tried against the reducer rules too. Counting the
+    statements of each user_host takes an extra pass over the table
+    """
+
+    rates = {}
+    if stratified:
+        cur.execute("SELECT user_host, COUNT(*) FROM {0} WHERE {1} GROUP BY user_host".format(
+            tablename, chunk_condition(None, None)))
+        for user_host, count in cur.fetchall():
+            rate = min(1.0, float(stratum_min_rows) / count)
+            if rate > fraction:
+                rates[user_host] = rate
+
+    condition = "RAND({0}) < CASE user_host {1} ELSE %s END".format(
+        int(seed), ' '.join(['WHEN %s THEN %s'] * len(rates))) if rates else "RAND({0}) < %s".format(int(seed))
+    params = [x for item in rates.iteritems() for x in item] + [fraction]
+    cur.execute("""SELECT event_time, user_host, thread_id, server_id, command_type, argument
+                   FROM {0} WHERE {1} AND {2}""".format(tablename, chunk_condition(None, None), condition),
+                params)
+    for row in iter(cur.fetchone, None):
+        yield row, 1.0 / rates.get(row[1], fraction)
+
+
+class ByteCounter:
+    """
+    A file that only counts the bytes written to it
+    """
+
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, s):
+        self.bytes += len(s)
+
+
+def dry_run(tablenames, cur, fraction=0.01, stratified=False, seed=0, processes=1):
+    """
+    Run the reducer over a sample of each of the general_log tables in
+    @tablenames (see sample_rows()), without writing anything, and print
+    what a --reduce of the whole tables would do, by the current config:
+    how many statements and bytes it would read and write, the number of
+    distinct query templates in the sample, the statements dropped by each
+    reducer rule, and how long reducing would take on @processes
+    processes. The rows are reduced by reduce_rows(), the same as by
+    --reduce, but with ids handed out in memory.
+
+    The estimates scale up what happened to the sample, weighting each row
+    by the statements it stands for. The time is only that of reduce_rows()
+    itself, leaving out fetching and loading the rows
+    """
+
+    for tablename in tablenames:
+        dims = MemoryDimensions()
+        outfile = ByteCounter()
+        sampled = 0
+        read = written = read_bytes = written_bytes = seconds = 0.0
+        dropped = defaultdict(float)
+
+        for row, weight in sample_rows(tablename, cur, fraction, stratified, seed):
+            hits = [rule.hits for rule in reducer.rules]
+            nbytes = outfile.bytes
+            starttime = time.time()
+            kept = reduce_rows([row], outfile, dims)[0]
+            seconds += (time.time() - starttime) * weight
+
+            sampled += 1
+            read += weight
+            read_bytes += len(row[5]) * weight
+            if kept:
+                written += weight
+                written_bytes += (outfile.bytes - nbytes) * weight
+            else:
+                for rule, before in zip(reducer.rules, hits):
+                    if rule.hits != before:
+                        dropped[rule.name] += weight
+
+        print "{0}: sampled {1} statements ({2:g}%{3}), standing for about {4:.0f}".format(
+            tablename, sampled, fraction * 100, ', stratified by user_host' if stratified else '', read)
+        if not sampled:
+            continue
+        print "    rows written:   about {0:.0f} ({1:.1f}% of those read, reduction ratio {2:.1f}:1)".format(
+            written, 100 * written / read, read / written if written else float('inf'))
+        print "    bytes written:  about {0:.1f} MB, from {1:.1f} MB of statements ({2:.1f}:1)".format(
+            written_bytes / (1 << 20), read_bytes / (1 << 20),
+            read_bytes / written_bytes if written_bytes else float('inf'))
+        print "    templates:      {0} distinct in the sample ({1:.1f} KB of text)".format(
+            len(dims.queryids), sum(len(query) for query in dims.queryids) / 1024.0)
+        print "    dropped by each reducer rule:"
+        for rule in reducer.rules:
+            print "        {0: <16} about {1: >12.0f} ({2:.1f}%)".format(
+                rule.name, dropped[rule.name], 100 * dropped[rule.name] / read)
+        print "    reducing time:  about {0:.0f} sec{1}, not counting fetching and loading".format(
+            seconds, ", or {0:.0f} sec on {1} processes".format(seconds / processes, processes)
+            if processes > 1 else '')
+
+
+# Names of the reduced month tables (and of their partitions in unified)
+month_re = re.compile(r'\d{4}_\d\d$')
 
 
 def create_schema(cur):
     """
-    Create the reduced_log db and the 'users' and 'servers' tables within
-    (initially empty)
+    Create the reduced_log db and the 'users', 'servers', 'queries',
+    'reduce_progress' and 'hourly_counts' tables within (initially empty).
+    User and server names are binary strings, since MySQL user names are
+    case sensitive: 'Bob' and 'bob' are different users
     """
 
     cur.execute("CREATE DATABASE reduced_log")
     cur.execute("USE reduced_log")
-    cur.execute("CREATE TABLE users (user MEDIUMTEXT, userid INT)")
-    cur.execute("CREATE TABLE servers (server MEDIUMTEXT, serverid INT)")
+    cur.execute("""CREATE TABLE users (user VARBINARY({0}) NOT NULL, userid INT NOT NULL,
+                                       PRIMARY KEY (userid), UNIQUE KEY (user))""".format(NAME_LEN))
+    cur.execute("""CREATE TABLE servers (server VARBINARY({0}) NOT NULL, serverid INT NOT NULL,
+                                         PRIMARY KEY (serverid), UNIQUE KEY (server))""".format(NAME_LEN))
+    create_queries_table(cur)
+    create_progress_table(cur)
+    create_rollup_table(cur)
 
 
 def create_unified(cur):
     """
-    When the reduced_log.unified table does not exist, or when the schema
-    changes, run this function to regenerate it.
-
-    @Precondition: all the tables in @initial_tables must be in the reduced log
+    Create the reduced_log.unified table, and add all the finished
+    reduced months to it (see unify()). unified has the same columns and
+    indexes as the month tables (see create_reduced_table()), partitioned
+    by month, so that months can be swapped into it rather than copied.
+    Does nothing if unified exists already
     """
 
     cur.execute("USE reduced_log")
+    cur.execute("SHOW TABLES LIKE 'unified'")
+    if cur.fetchall():
+        print >>sys.stderr, "The unified table exists already; use --unify to add new months to it"
+        return
 
-    # Get list of 2 initial tables
-    cur.execute("SHOW TABLES")
-    initial_tables = [x for x, in cur.fetchall()][:2]
+    create_reduced_table('unified', cur)
+    print_and_execute("""ALTER TABLE unified PARTITION BY RANGE( TO_DAYS(event_time) )
+                         (PARTITION other VALUES LESS THAN MAXVALUE)""", cur)
+    unify(cur)
 
-    print_and_execute("CREATE TABLE unified {0}".format(" UNION ALL ".join("SELECT * FROM {0}".format(t) for t in initial_tables)), cur)
-    print_and_execute("ALTER TABLE unified ADD INDEX (userid)", cur)
-    print_and_execute("ALTER TABLE unified ADD INDEX (serverid)", cur)
-    print_and_execute("ALTER TABLE unified ADD INDEX (event_time)", cur)
 
-    
-    print_and_execute("ALTER TABLE unified PARTITION BY RANGE( TO_DAYS(event_time) ) ( " + 
-                      ", ".join(partition_from_str(t) for t in initial_tables) + 
-                      ", PARTITION other VALUES LESS THAN MAXVALUE" + ")", cur)
+def mark_unified(tablename, cur, progress):
+    """
+    Record in reduce_progress that the rows of @tablename are in unified.
+    @progress is the get_progress() dict; tables reduced before
+    reduce_progress existed, or by --reduce_files, get a row of their own,
+    saying they are finished
+    """
+
+    if tablename in progress:
+        cur.execute("UPDATE reduce_progress SET unified = TRUE WHERE tablename = %s", (tablename,))
+    else:
+        cur.execute("""INSERT INTO reduce_progress (tablename, chunknum, done, unified)
+                       VALUES (%s, 0, TRUE, TRUE)""", (tablename,))
+
+
+def exchange_month(tablename, cur):
+    """
+    Put the rows of the month table @tablename into its partition of
+    unified, without touching unified's other rows or indexes: they are
+    copied into a staging table with unified's schema (loaded without its
+    secondary indexes, which are then built in one pass), which is then
+    swapped with the partition by EXCHANGE PARTITION. Rows already in the
+    partition (those of other months that fall in it, copied in by
+    unify() or moved there by the REORGANIZE of 'other') are copied into
+    the staging table too, so they are not lost with it. The month table
+    is left as it is. Raises DatabaseError if the rows can't be exchanged,
+    eg because some are outside the month
+    """
+
+    staging = '{0}_unifying'.format(tablename)
+    cur.execute("DROP TABLE IF EXISTS {0}".format(staging))
+    cur.execute("CREATE TABLE {0} LIKE unified".format(staging))
+    try:
+        cur.execute("ALTER TABLE {0} REMOVE PARTITIONING".format(staging))
+        cur.execute("SHOW INDEX FROM {0}".format(staging))
+        # Key_name -> (unique, columns in order)
+        indexes = {}
+        for row in cur.fetchall():
+            key_name, seq, column = row[2], row[3], row[4]
+            unique = not row[1] # Non_unique
+            if key_name != 'PRIMARY':
+                indexes.setdefault(key_name, (unique, {}))[1][seq] = column
+        if indexes:
+            cur.execute("ALTER TABLE {0} {1}".format(staging, ', '.join('DROP INDEX {0}'.format(name)
+                                                                         for name in indexes)))
+        print_and_execute("INSERT INTO {0} SELECT * FROM {1}".format(staging, tablename), cur)
+        cur.execute("SELECT 1 FROM unified PARTITION ({0}) LIMIT 1".format(tablename))
+        if cur.fetchall():
+            print_and_execute("INSERT INTO {0} SELECT * FROM unified PARTITION ({1})".format(staging, tablename),
+                              cur)
+        cur.connection.commit()
+        if indexes:
+            print_and_execute("ALTER TABLE {0} {1}".format(staging, ', '.join(
+                'ADD {0}INDEX {1} ({2})'.format('UNIQUE ' if unique else '', name,
+                                                ', '.join(columns[seq] for seq in sorted(columns)))
+                for name, (unique, columns) in sorted(indexes.items()))), cur)
+        print_and_execute("ALTER TABLE unified EXCHANGE PARTITION {0} WITH TABLE {1}".format(tablename, staging),
+                          cur)
+    finally:
+        cur.execute("DROP TABLE IF EXISTS {0}".format(staging))
+
 
 def unify(cur):
     """
-    When a new table comes in, reduce it using reduce_log() and then run this function
-    to incorporate it into the unified table, along with partitioning
+    When a new table comes in, reduce it using reduce_log() and then run
+    this function to incorporate it into the unified table, as a
+    partition of its own.
+
+    The new months get their partitions in one REORGANIZE of the 'other'
+    partition, which holds nothing but stray rows, so next to nothing is
+    copied. Then each month's rows are exchanged into its partition (see
+    exchange_month()), which leaves unified's other partitions and their
+    indexes alone. Months that can't be exchanged, eg with rows outside
+    their month, or whose table doesn't match unified, are copied in with
+    INSERT ... SELECT instead, as older versions did for every month. So
+    are months older than the last one in unified, which can't get a
+    partition of their own; their rows go into the partition of a later
+    month.
+
+    The month tables are kept, and reduce_progress records which have been
+    unified (see mark_unified()). Older versions instead took a month with
+    a partition to be unified (and left the tables of those exchanged
+    empty), so on the first run those are marked unified.
+
+    Then the hourly_counts of the new partitions (and of 'other', which
+    the REORGANIZE empties) are counted, and of any partition that has
+    none, eg those unified before hourly_counts existed. If a month had
+    to be copied, its rows may have gone into older partitions, so all of
+    them are recounted.
     """
     
     cur.execute("USE reduced_log")
     cur.execute('SHOW TABLES')
-    tables = set(x for x, in cur.fetchall())
+    tables = set(x for x, in cur.fetchall() if month_re.match(x))
     
     cur.execute("""SELECT PARTITION_NAME
                    FROM INFORMATION_SCHEMA.PARTITIONS
                    WHERE TABLE_SCHEMA = 'reduced_log'
-                         AND TABLE_NAME = 'unified'""")
-    partitions = set(x for x, in cur.fetchall())
+                         AND TABLE_NAME = 'unified'
+                   ORDER BY PARTITION_ORDINAL_POSITION""")
+    partition_list = [x for x, in cur.fetchall()]
+    partitions = set(partition_list)
+    if not partitions:
+        print >>sys.stderr, "There is no unified table; create it with --create_unified"
+        return
 
-    tables_to_add = sorted(tables - partitions - set(['unified', 'users', 'servers', 'unified_users', 'unified_servers']))
-    
-    for table in tables_to_add:
+    create_progress_table(cur)
+    progress = get_progress(cur)
+    cur.execute("SHOW COLUMNS FROM reduce_progress LIKE 'unified'")
+    if not cur.fetchall():
+        cur.execute("ALTER TABLE reduce_progress ADD COLUMN unified BOOL NOT NULL DEFAULT FALSE")
+        for table in sorted(tables & partitions):
+            mark_unified(table, cur, progress)
+        cur.connection.commit()
+        progress = get_progress(cur)
+    cur.execute("SELECT DISTINCT tablename FROM reduce_progress WHERE unified")
+    unified = set(x for x, in cur.fetchall())
+
+    # Months still being reduced are left out until they are finished
+    unfinished = set(tablename for tablename, chunks in progress.iteritems()
+                     if not reduction_finished(chunks))
+
+    tables_to_add = sorted(tables - unified - unfinished)
+
+    # A REORGANIZE can only split 'other', so only months after the last
+    # one in unified can get partitions of their own
+    months = [name for name in partition_list if month_re.match(name)]
+    new_partitions = [table for table in tables_to_add
+                      if table not in partitions and (not months or table > months[-1])]
+    if new_partitions:
         print_and_execute("""ALTER TABLE unified REORGANIZE PARTITION other INTO ({0},
-                  PARTITION other VALUES LESS THAN MAXVALUE)""".format(partition_from_str(table)), cur)
-        print_and_execute("INSERT INTO unified SELECT * FROM {0}".format(table), cur)
+                  PARTITION other VALUES LESS THAN MAXVALUE)""".format(
+            ', '.join(partition_from_str(table) for table in new_partitions)), cur)
+    partitions |= set(new_partitions)
+
+    exchanged = set()
+    copied = False
+    for table in tables_to_add:
+        # Tables made by older versions, or with index_later, may lack indexes unified has
+        add_indexes(table, cur)
+        if table in partitions:
+            try:
+                exchange_month(table, cur)
+                exchanged.add(table)
+            except DatabaseError as e:
+                print >>sys.stderr, "Can't exchange {0} into unified ({1}); copying its rows instead".format(table, e)
+        else:
+            print >>sys.stderr, "{0} is older than the last month in unified; copying its rows".format(table)
+        if table not in exchanged:
+            print_and_execute("INSERT INTO unified SELECT * FROM {0}".format(table), cur)
+            copied = True
+        mark_unified(table, cur, progress)
+        cur.connection.commit()
+
+    create_rollup_table(cur)
+    cur.execute("SELECT DISTINCT partition_name FROM hourly_counts")
+    rolled_up = set(x for x, in cur.fetchall())
+    if copied:
+        to_count = partitions
+    else:
+        to_count = (partitions - rolled_up) | exchanged
+        if new_partitions:
+            to_count.add('other')
+    for partition in sorted(to_count):
+        rollup_partition(partition, cur)
+
+
+def migrate(cur):
+    """
+    Convert reduced tables made before the queries table existed, which
+    store the text of each query on every row, to store queryids instead.
+    Each table is copied into a new one joined against queries, and
+    swapped in for the old one, so an interrupted migration can just be
+    run again.
 
+    Also makes the names in the users and servers tables binary strings
+    with unique keys (see create_schema()); older versions stored them as
+    text, without keys. Names too long for the new column, or stored
+    twice, would be lost or break the key, so a table with any is left
+    alone, after listing them. Also adds the hour_bucket column (see
+    myutils.periods) to reduced tables made without it, drops the
+    buckets of the coarser periods older versions stored, and converts
+    reduced tables and reduce_progress to InnoDB, so that each batch of
+    --reduce is committed with its watermark
+    """
+
+    cur.execute("USE reduced_log")
+    create_queries_table(cur)
+
+    for table, column in (('users', 'user'), ('servers', 'server')):
+        cur.execute("""SELECT DATA_TYPE FROM INFORMATION_SCHEMA.COLUMNS
+                       WHERE TABLE_SCHEMA = 'reduced_log' AND TABLE_NAME = %s AND COLUMN_NAME = %s""",
+                    (table, column))
+        if cur.fetchall()[0][0].lower() == 'varbinary':
+            continue
+        cur.execute("SELECT {0} FROM {1} WHERE LENGTH({0}) > {2}".format(column, table, NAME_LEN))
+        too_long = [x for x, in cur.fetchall()]
+        cur.execute("SELECT BINARY {0} FROM {1} GROUP BY BINARY {0} HAVING COUNT(*) > 1".format(column, table))
+        duplicates = [x for x, in cur.fetchall()]
+        if too_long or duplicates:
+            print >>sys.stderr, ("Can't convert {0}.{1}: {2} names are longer than {3} bytes, "
+                                 "{4} are stored more than once:").format(table, column, len(too_long),
+                                                                          NAME_LEN, len(duplicates))
+            for name in too_long + duplicates:
+                print >>sys.stderr, "    {0!r}".format(name)
+            continue
+
+        # Tables made by older versions have no keys at all
+        cur.execute("SHOW INDEX FROM {0}".format(table))
+        keys = '' if cur.fetchall() else ", ADD PRIMARY KEY ({0}id), ADD UNIQUE KEY ({0})".format(column)
+        print_and_execute("ALTER TABLE {0} MODIFY {1} VARBINARY({2}) NOT NULL, MODIFY {1}id INT NOT NULL{3}".format(
+            table, column, NAME_LEN, keys), cur)
 
+    cur.execute("""SELECT TABLE_NAME FROM INFORMATION_SCHEMA.COLUMNS
+                   WHERE TABLE_SCHEMA = 'reduced_log' AND COLUMN_NAME = 'query'
+                         AND TABLE_NAME != 'queries'""")
+    tables = []
+    for table, in cur.fetchall():
+        if table.endswith('_old'):
+            # Left over from an interrupted run, after the swap
+            cur.execute("DROP TABLE {0}".format(table))
+        elif not table.endswith('_migrating'):
+            tables.append(table)
+
+    for table in tables:
+        print >>sys.stderr, "Migrating {0}".format(table)
+        print_and_execute("""INSERT IGNORE INTO queries (query_hash, query_type, query)
+                             SELECT UNHEX(SHA1(query)), query_type, query FROM {0}""".format(table), cur)
+        cur.execute("DROP TABLE IF EXISTS {0}_migrating".format(table))
+        cur.execute("CREATE TABLE {0}_migrating LIKE {0}".format(table))
+        cur.execute("ALTER TABLE {0}_migrating ADD COLUMN queryid INT AFTER query_type, DROP COLUMN query".format(table))
+        cur.execute("ALTER TABLE {0}_migrating ADD INDEX (queryid)".format(table))
+        print_and_execute("""INSERT INTO {0}_migrating
+                             SELECT t.event_time, t.userid, t.serverid, t.thread_id, t.query_type,
+                                    queries.queryid, t.vals
+                             FROM {0} AS t JOIN queries ON queries.query_hash = UNHEX(SHA1(t.query))
+                          """.format(table), cur)
+        cur.execute("RENAME TABLE {0} TO {0}_old, {0}_migrating TO {0}".format(table))
+        cur.execute("DROP TABLE {0}_old".format(table))
+        cur.connection.commit()
+
+    # Tables made before the hour_bucket column existed
+    cur.execute("""SELECT TABLE_NAME FROM INFORMATION_SCHEMA.COLUMNS
+                   WHERE TABLE_SCHEMA = 'reduced_log' AND COLUMN_NAME = 'queryid'
+                         AND TABLE_NAME != 'queries'""")
+    with_queryid = set(x for x, in cur.fetchall())
+    cur.execute("""SELECT TABLE_NAME FROM INFORMATION_SCHEMA.COLUMNS
+                   WHERE TABLE_SCHEMA = 'reduced_log' AND COLUMN_NAME = 'hour_bucket'""")
+    for table in sorted(with_queryid - set(x for x, in cur.fetchall())):
+        print >>sys.stderr, "Adding hour buckets to {0}".format(table)
+        print_and_execute("ALTER TABLE {0} ADD COLUMN hour_bucket INT".format(table), cur)
+        print_and_execute("UPDATE {0} SET hour_bucket = {1}".format(
+            table, hour_bucket_sql.format('event_time')), cur)
+        add_indexes(table, cur)
+        cur.connection.commit()
+
+    # Tables made while the buckets of every period were stored. Dropping
+    # the columns narrows the time_buckets index to what is left of it
+    cur.execute("""SELECT TABLE_NAME, COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS
+                   WHERE TABLE_SCHEMA = 'reduced_log' AND COLUMN_NAME IN ({0})""".format(
+        ', '.join("'{0}'".format(column) for column in old_bucket_columns)))
+    old_buckets = {}
+    for table, column in cur.fetchall():
+        old_buckets.setdefault(table, []).append(column)
+    for table in sorted(set(old_buckets) & with_queryid):
+        print >>sys.stderr, "Dropping the day to year buckets of {0}".format(table)
+        print_and_execute("ALTER TABLE {0} {1}".format(
+            table, ', '.join('DROP COLUMN {0}'.format(column) for column in sorted(old_buckets[table]))), cur)
+        cur.connection.commit()
+
+    cur.execute("""SELECT TABLE_NAME FROM INFORMATION_SCHEMA.TABLES
+                   WHERE TABLE_SCHEMA = 'reduced_log' AND ENGINE != 'InnoDB'""")
+    for table in sorted(set(x for x, in cur.fetchall()) & (with_queryid | set(['reduce_progress']))):
+        print_and_execute("ALTER TABLE {0} ENGINE=InnoDB".format(table), cur)
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
+    if len(sys.argv) < 2 or (len(sys.argv) > 2 and sys.argv[1] not in ('--reduce_files', '--dry-run')):
         print "Usage: python create_reduced_log.py [operation]. Operations:"
         print "--initialize: Create the reduced_log db and 'users' and 'servers' tables, initially empty"
         print "--reduce: take all tables from general_log and create equivalent reduced tables in the reduced_log db by the rules in config.json"
-        print "--create_unified: Create the unified table in the reduced_log db"
-        print "--unify: add new tables (already redyced) into the unified table"
+        print "--reduce_files file [file ...]: reduce general query log files (may be .gz, .xz or .bz2) into the reduced_log db"
+        print "--dry-run [--sample=P] [--stratified] [--seed=N] [table ...]: estimate what --reduce would do with the current config from a fraction P (default 0.01) of the statements, without writing anything"
+        print "--create_unified: Create the unified table in the reduced_log db, and add the reduced months to it"
+        print "--unify: move new tables (already reduced) into the unified table"
+        print "--migrate: convert reduced_log tables made by older versions to the current schema"
         print "ONLY SPECIFY ONE OPTION"
         sys.exit(1)
 
     db = get_conn(dbname = 'general_log')
     cur = db.cursor()
         
-    if sys.argv[-1] == '--initialize':
+    if sys.argv[1] == '--initialize':
         print "Creating reduced_log db"
         create_schema(cur)
-    elif sys.argv[-1] == '--reduce':
+    elif sys.argv[1] == '--reduce':
         print "Reducing the general_log and storing in reduced_log"
 
-        cur.execute("SHOW TABLES")
-        gen_log_tables = set(x for x, in cur.fetchall())
+        reduce_tables(tables_to_reduce(cur), cur,
+                      processes = config.get('reduce_processes') or 1,
+                      chunks = config.get('reduce_chunks') or 1,
+                      chunk_stats = config.get('reduce_chunk_stats') or False,
+                      sink = config.get('reduce_sink') or 'tempfile',
+                      index_later = config.get('reduce_index_later') or False,
+                      batch_rows = config.get('reduce_batch_rows') or 100000,
+                      fetch_rows = config.get('reduce_fetch_rows') or 1000,
+                      queue_depth = config.get('reduce_queue_depth') or 8,
+                      metrics_file = config.get('reduce_metrics'))
+    elif sys.argv[1] == '--reduce_files':
+        print "Reducing general query log files and storing in reduced_log"
 
-        cur.execute("USE reduced_log")
-        cur.execute("SHOW TABLES")
-        red_log_tables = set(x for x, in cur.fetchall())
-        
-        to_reduce = gen_log_tables - red_log_tables
+        reduce_files(sys.argv[2:], cur,
+                     sink = config.get('reduce_sink') or 'tempfile',
+                     index_later = config.get('reduce_index_later') or False,
+                     batch_rows = config.get('reduce_batch_rows') or 100000,
+                     metrics_file = config.get('reduce_metrics'))
+    elif sys.argv[1] == '--dry-run':
+        try:
+            opts, tablenames = getopt.gnu_getopt(sys.argv[2:], '', ['sample=', 'stratified', 'seed='])
+            opts = dict(opts)
+            sample = opts.get('--sample', '0.01')
+            fraction = float(sample[:-1]) / 100 if sample.endswith('%') else float(sample)
+            if not 0 < fraction <= 1:
+                raise ValueError
+            seed = int(opts.get('--seed', 0))
+        except (getopt.GetoptError, ValueError):
+            print "Usage: python create_reduced_log.py --dry-run [--sample=P] [--stratified] [--seed=N] [table ...]"
+            print "P is a fraction (0.01) or a percentage (1%)"
+            sys.exit(1)
+        print "Estimating the reduction from a sample of the general_log"
 
-        for tablename in sorted(to_reduce):
-            reduce_log(tablename, cur)
-    elif sys.argv[-1] == '--create_unified':
+        dry_run(tablenames or tables_to_reduce(cur), cur, fraction,
+                stratified = '--stratified' in opts,
+                seed = seed,
+                processes = config.get('reduce_processes') or 1)
+    elif sys.argv[1] == '--create_unified':
         print "Creating the 'unified' table"
         create_unified(cur)
-    elif sys.argv[-1] == '--unify':
+    elif sys.argv[1] == '--unify':
         print "Unifying all reduced data"
         unify(cur)
+    elif sys.argv[1] == '--migrate':
+        print "Converting reduced_log tables to the current schema"
+        migrate(cur)
 
     cur.close()
     db.close()
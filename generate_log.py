@@ -0,0 +1,371 @@
+"""
+Generates a synthetic MySQL general log, for testing and benchmarking the
+reduction without real logs (see benchmark.py). Usage:
+
+    $ python generate_log.py <month> <rows> [--seed=N] [--users=N] [--table] [--replace] [--file=FILE]
+
+<month> is a general_log table name like 2010_04; <rows> entries are
+spread evenly over that month. --table loads them into
+general_log.<month> (which must not exist yet, unless --replace is
+given), and --file writes them to FILE in the log_output=FILE format
+read by --reduce_files (compressed if FILE ends in .gz, .xz or .bz2).
+Both can be given at once. The same seed (default 0) always gives the
+same log.
+"""
+
+import os
+import sys
+import getopt
+import random
+import subprocess
+from bisect import bisect
+from datetime import datetime, timedelta
+
+from myutils import get_conn
+
+# Programs that compress stdin to stdout, by file extension, like
+# LogFile.decompressors
+compressors = {'.gz': ['gzip', '-c'],
+               '.xz': ['xz', '-c'],
+               '.bz2': ['bzip2', '-c']}
+
+
+def skewed_length(r, lo, hi):
+    """
+    A length from @lo to @hi drawn from a Pareto distribution, so that most
+    are short and a few are very long, like the IN lists and multi-row
+    INSERTs in real logs
+    """
+    return min(hi, int(lo * r.paretovariate(1.1)))
+
+
+### The statements of the log. Each takes a random.Random and returns a statement
+
+tables = ('Object', 'Source', 'ForcedSource', 'DiaSource', 'Science_Ccd_Exposure', 'RunDeepSource')
+columns = ('objectId', 'sourceId', 'ra', 'decl', 'psfMag', 'taiMidPoint', 'filterId', 'scienceCcdExposureId')
+names = ('abc', 'r', 'g', 'i', 'O\\\'Brien', 'test run', 'a\\tb', '\\\\tmp')
+
+def point_select(r):
+    return "select ra, decl, psfMag from Object where objectId = {0} and ra > {1:.6f} and decl < {2:.6f}".format(
+        r.randint(0, 10**9), r.uniform(0, 360), r.uniform(-90, 90))
+
+def range_select(r):
+    ra = r.uniform(0, 350)
+    decl = r.uniform(-90, 80)
+    return ("SELECT objectId, ra, decl FROM Object WHERE ra BETWEEN {0:.4f} AND {1:.4f} "
+            "AND decl BETWEEN {2:.4f} AND {3:.4f} LIMIT {4}").format(
+        ra, ra + r.uniform(0, 10), decl, decl + r.uniform(0, 10), r.choice((10, 100, 1000)))
+
+def join_select(r):
+    return ("  select count(*)   from   Exposure e JOIN Filter f ON e.filterId = f.filterId  "
+            "where e.mjd >= {0:.6f} AND f.filterName = '{1}' ").format(r.uniform(0, 60000), r.choice('ugrizy'))
+
+def date_select(r):
+    return ("SELECT * FROM RunDeepSource WHERE taiMidPoint > '2010-04-{0:02d} {1:02d}:00:00' "
+            "ORDER BY objectId LIMIT 100").format(r.randint(1, 28), r.randint(0, 23))
+
+def numlist_select(r):
+    ids = ', '.join(str(r.randint(0, 10**9)) for i in xrange(skewed_length(r, 2, 5000)))
+    return "SELECT * FROM Source WHERE objectId IN ({0})".format(ids)
+
+def multiline_select(r):
+    return ("SELECT o.objectId,\n       s.sourceId, s.psfFlux\n  FROM Object o\n"
+            "  JOIN Source s ON (s.objectId = o.objectId)\n WHERE o.objectId = {0}\n"
+            "   AND s.psfFlux > {1:.3e}").format(r.randint(0, 10**9), r.uniform(0, 1))
+
+def adhoc_select(r):
+    # A long tail of one-off templates
+    return "SELECT {0} FROM {1}_{2} WHERE {3} < {4}".format(
+        r.choice(columns), r.choice(tables), skewed_length(r, 1, 100000), r.choice(columns), r.randint(0, 1000))
+
+def insert_values(r):
+    values = []
+    for i in xrange(skewed_length(r, 1, 2000)):
+        if r.random() < 0.05:
+            # A blob
+            text = '%x' % r.getrandbits(4 * skewed_length(r, 16, 20000))
+        else:
+            text = r.choice(names)
+        values.append("({0}, {1:.6f}, '{2}', {3})".format(r.randint(0, 10000), r.random(), text,
+                                                          r.randint(0, 100)))
+    return "INSERT INTO Science_Ccd_Exposure VALUES {0}".format(','.join(values))
+
+def schema_select(r):
+    return r.choice(("SELECT table_name FROM information_schema.TABLES WHERE table_schema = 'rplsst'",
+                     "select * from mysql.user where user = 'buildbot'"))
+
+def show_noise(r):
+    return r.choice(('SHOW TABLES', 'SHOW DATABASES', "SHOW VARIABLES LIKE 'version'",
+                     'SHOW WARNINGS', 'SHOW CREATE TABLE Object'))
+
+def set_noise(r):
+    return r.choice(('SET autocommit=1', 'SET autocommit=0', 'commit', 'SET NAMES utf8',
+                     "SET sql_mode='ANSI'", 'SET character_set_results = NULL',
+                     'SELECT DATABASE()', 'SELECT @@version_comment LIMIT 1'))
+
+def create_table(r):
+    return "CREATE TABLE tmp_{0} (objectId BIGINT, ra DOUBLE, decl DOUBLE)".format(r.randint(0, 10**6))
+
+def load_data(r):
+    return "LOAD DATA LOCAL INFILE '/tmp/load_{0}.csv' INTO TABLE Source_{1:02d}".format(
+        r.randint(0, 10**6), r.randint(0, 99))
+
+def alter_table(r):
+    return "ALTER TABLE Source_{0:02d} ADD INDEX (objectId)".format(r.randint(0, 99))
+
+# (relative frequency, statement)
+statements = ((30, point_select), (8, range_select), (10, join_select), (5, date_select),
+              (6, numlist_select), (3, multiline_select), (6, adhoc_select), (6, insert_values),
+              (2, schema_select), (8, show_noise), (12, set_noise), (1, create_table),
+              (1, load_data), (0.5, alter_table))
+
+
+class Chooser:
+    """
+    Picks from @items at random, with the relative frequencies @weights
+    """
+
+    def __init__(self, items, weights):
+        self.items = items
+        self.cumulative = []
+        total = 0.0
+        for weight in weights:
+            total += weight
+            self.cumulative.append(total)
+
+    def choice(self, r):
+        return self.items[bisect(self.cumulative, r.random() * self.cumulative[-1])]
+
+
+class LogGenerator:
+    """
+    Yields a month of synthetic general_log rows, like those of the
+    general_log tables: (event_time, user_host, thread_id, server_id,
+    command_type, argument), in event_time order.
+
+    @users users connect from one to three of a few dozen hosts each.
+    Their activity follows Zipf's law, so a few users issue most of the
+    statements, as in the real logs; 'root' and 'buildbot' are among the
+    busiest. Each connection starts with a Connect entry and ends with a
+    Quit. The statements are drawn from the templates above, with
+    numbers and strings that vary from row to row, IN lists and
+    multi-row INSERTs of Pareto-distributed length (up to thousands of
+    items, some with blobs of kilobytes), and plenty of the SET and SHOW
+    noise the reducer throws away. A share of the statements repeat one
+    of the last few hundred exactly, like scripts polling the same query.
+
+    Everything comes from a random.Random seeded with @seed, so the same
+    arguments always give the same rows.
+    """
+
+    # Connections open at once, at most
+    max_sessions = 64
+
+    # Fraction of statements that repeat a recent one, and how many recent
+    # statements they are picked from
+    repeat_fraction = 0.3
+    recent_statements = 500
+
+    def __init__(self, month, rows, seed=0, users=200):
+        self.start = datetime.strptime(month, '%Y_%m')
+        if self.start.month == 12:
+            end = datetime(self.start.year + 1, 1, 1)
+        else:
+            end = datetime(self.start.year, self.start.month + 1, 1)
+        self.seconds = int((end - self.start).total_seconds())
+        self.rows = rows
+        self.seed = seed
+
+        r = random.Random(seed)
+        user_names = ['user{0:03d}'.format(i) for i in xrange(users)]
+        user_names[2:2] = ['root']
+        user_names[9:9] = ['buildbot']
+        hosts = [('lsst{0:02d}.ncsa.illinois.edu'.format(i), '141.142.2.{0}'.format(i)) for i in xrange(40)]
+        hosts.append(('localhost', ''))
+        self.users = []
+        for name in user_names:
+            self.users.append((name, r.sample(hosts, r.randint(1, 3))))
+        self.user_chooser = Chooser(self.users, [1.0 / rank for rank in xrange(1, len(self.users) + 1)])
+        self.statement_chooser = Chooser([s for w, s in statements], [w for w, s in statements])
+
+    def __iter__(self):
+        r = random.Random(self.seed)
+        sessions = []
+        recent = []
+        next_thread = 1
+        event_time = None
+        last_second = None
+
+        for i in xrange(self.rows):
+            second = i * self.seconds // self.rows
+            if second != last_second:
+                event_time = self.start + timedelta(seconds = second)
+                last_second = second
+
+            x = r.random()
+            if not sessions or (x < 0.01 and len(sessions) < self.max_sessions):
+                user, hosts = self.user_chooser.choice(r)
+                host, ip = r.choice(hosts)
+                user_host = '{0}[{0}] @ {1} [{2}]'.format(user, host, ip)
+                sessions.append((next_thread, user_host))
+                yield event_time, user_host, next_thread, 0, 'Connect', '{0}@{1} on rplsst'.format(user, host)
+                next_thread += 1
+            elif x < 0.02:
+                thread_id, user_host = sessions.pop(r.randrange(len(sessions)))
+                yield event_time, user_host, thread_id, 0, 'Quit', ''
+            else:
+                # Busy users have more connections open, so they get more
+                # of the statements
+                thread_id, user_host = sessions[r.randrange(len(sessions))]
+                command_type = 'Query'
+                if x < 0.03:
+                    command_type = 'Init DB'
+                    statement = 'rplsst'
+                else:
+                    if recent and r.random() < self.repeat_fraction:
+                        statement = recent[r.randrange(len(recent))]
+                    else:
+                        statement = self.statement_chooser.choice(r)(r)
+                        if len(recent) < self.recent_statements:
+                            recent.append(statement)
+                        else:
+                            recent[r.randrange(self.recent_statements)] = statement
+                    if x > 0.95:
+                        command_type = 'Execute'
+                yield event_time, user_host, thread_id, 0, command_type, statement
+
+
+def escape(s):
+    """
+    Escape @s for a LOAD DATA file with the default field and line terminators
+    """
+    return s.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+class TableWriter:
+    """
+    Loads rows into general_log.@month, creating it like mysql.general_log
+    (but MyISAM, as the log tables are archived). The rows are loaded with
+    LOAD DATA LOCAL INFILE, through a temp file, every @batch_rows rows.
+    Fails if the table exists already, unless @replace is True
+    """
+
+    def __init__(self, month, replace=False, batch_rows=100000):
+        self.month = month
+        self.batch_rows = batch_rows
+        self.filename = '{0}_generated.tmp'.format(month)
+        self.db = get_conn(dbname = 'general_log')
+        self.cur = self.db.cursor()
+        if replace:
+            self.cur.execute("DROP TABLE IF EXISTS {0}".format(month))
+        self.cur.execute("CREATE TABLE {0} LIKE mysql.general_log".format(month))
+        self.cur.execute("ALTER TABLE {0} ENGINE=MyISAM".format(month))
+        self.outfile = None
+        self.batch = 0
+
+    def write_row(self, row):
+        if not self.outfile:
+            self.outfile = open(self.filename, 'w')
+        event_time, user_host, thread_id, server_id, command_type, argument = row
+        print >>self.outfile, '\t'.join((str(event_time), escape(user_host), str(thread_id),
+                                         str(server_id), command_type, escape(argument)))
+        self.batch += 1
+        if self.batch >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.outfile:
+            return
+        self.outfile.close()
+        self.outfile = None
+        self.cur.execute("LOAD DATA LOCAL INFILE '{0}' INTO TABLE {1}".format(self.filename, self.month))
+        os.remove(self.filename)
+        self.batch = 0
+
+    def close(self):
+        self.flush()
+        self.db.commit()
+        self.cur.close()
+        self.db.close()
+
+
+class FileWriter:
+    """
+    Writes rows to the general query log file @filename, in the format
+    written by MySQL up to 5.5, compressed if its extension is in
+    compressors
+    """
+
+    header = ("/usr/sbin/mysqld, Version: 5.1.46-log (Source distribution). started with:\n"
+              "Tcp port: 3306  Unix socket: /var/lib/mysql/mysql.sock\n"
+              "Time                 Id Command    Argument\n")
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.proc = None
+        self.command = None
+        self.outfile = open(filename, 'wb')
+        for extension, command in compressors.iteritems():
+            if filename.endswith(extension):
+                self.command = command
+                self.proc = subprocess.Popen(command, stdin = subprocess.PIPE, stdout = self.outfile,
+                                             bufsize = 1 << 16)
+                self.outfile.close()
+                self.outfile = self.proc.stdin
+                break
+        self.outfile.write(self.header)
+        self.last_time = None
+
+    def write_row(self, row):
+        event_time, user_host, thread_id, server_id, command_type, argument = row
+        if event_time != self.last_time:
+            # The hour isn't zero-padded
+            stamp = '{0:%y%m%d} {1: >2}:{0:%M:%S}'.format(event_time, event_time.hour)
+            self.last_time = event_time
+        else:
+            stamp = '\t'
+        self.outfile.write('{0}\t{1: >5} {2}\t{3}\n'.format(stamp, thread_id, command_type, argument))
+
+    def close(self):
+        self.outfile.close()
+        if self.proc and self.proc.wait():
+            raise IOError("{0} failed on {1}".format(' '.join(self.command), self.filename))
+
+
+def generate(month, rows, writers, seed=0, users=200):
+    """
+    Generate @rows rows of @month (see LogGenerator) and write them with
+    each of @writers (TableWriters and FileWriters)
+    """
+
+    try:
+        for i, row in enumerate(LogGenerator(month, rows, seed, users), 1):
+            for writer in writers:
+                writer.write_row(row)
+            if not i % 1000000:
+                print >>sys.stderr, "{0} rows".format(i)
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], '', ['seed=', 'users=', 'table', 'replace', 'file='])
+        opts = dict(opts)
+        month, rows = args
+        rows = int(rows)
+    except (getopt.GetoptError, ValueError):
+        print __doc__
+        sys.exit(1)
+
+    writers = []
+    if '--table' in opts:
+        writers.append(TableWriter(month, '--replace' in opts))
+    if '--file' in opts:
+        writers.append(FileWriter(opts['--file']))
+    if not writers:
+        print __doc__
+        sys.exit(1)
+
+    generate(month, rows, writers, int(opts.get('--seed', 0)), int(opts.get('--users', 200)))
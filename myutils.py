@@ -5,6 +5,7 @@ import sys
 import string
 import json
 import time
+from datetime import datetime
 
 # it is important that this order be maintained throughout all code
 querytypes = ('INSERT', 'SELECT', 'CREATE_TABLE', 'SET', 'LOAD', 'ALTER', 'OTHER')
@@ -17,34 +18,27 @@ with open('config.json') as configfile:
         config['db_conn_params']['cursorclass'] = getattr(sys.modules[__name__],
                                                           config['db_conn_params']['cursorclass'])
 
-def define_time_functions(cur):
-    cur.execute("DROP FUNCTION IF EXISTS my_year")
-    cur.execute("""CREATE FUNCTION my_year (e DATETIME)
-                   RETURNS INT DETERMINISTIC
-                   RETURN YEAR(e)""")
+# The periods the tool can count queries by. Reduced tables have an
+# hour_bucket column: the number of the hour the row falls in, counted
+# from 1970-01-01, in the time of event_time as logged. The coarser
+# periods are counted from it (see CountCube.hour_to_buckets())
+periods = ('hour', 'day', 'week', 'month', 'year')
 
-    cur.execute("DROP FUNCTION IF EXISTS my_month")
-    cur.execute("""CREATE FUNCTION my_month (e DATETIME)
-                   RETURNS INT DETERMINISTIC
-                   RETURN YEAR(e) * 12 + MONTH(e) - 1""")
+epoch = datetime(1970, 1, 1)
 
-    cur.execute("DROP FUNCTION IF EXISTS my_week")
-    cur.execute("""CREATE FUNCTION my_week (e DATETIME)
-                   RETURNS INT DETERMINISTIC
-                   RETURN YEAR(e) * 53 + WEEKOFYEAR(e)""")
+# SQL expression computing the hour bucket from the DATETIME {0}.
+# 719528 is TO_DAYS('1970-01-01')
+hour_bucket_sql = "(TO_DAYS({0}) - 719528) * 24 + HOUR({0})"
 
-    cur.execute("DROP FUNCTION IF EXISTS my_day")
-    cur.execute("""CREATE FUNCTION my_day (e DATETIME)
-                   RETURNS INT DETERMINISTIC
-                   RETURN FLOOR( UNIX_TIMESTAMP(e) / (24 * 60 * 60) )""")
-
-    cur.execute("DROP FUNCTION IF EXISTS my_hour")
-    cur.execute("""CREATE FUNCTION my_hour (e DATETIME)
-                   RETURNS INT DETERMINISTIC
-                   RETURN FLOOR( UNIX_TIMESTAMP(e) / (60 * 60) )""")
+def hour_bucket(event_time):
+    """
+    Returns the hour bucket of the datetime @event_time, as
+    hour_bucket_sql computes it
+    """
+    return (event_time - epoch).days * 24 + event_time.hour
 
 def get_conn(dbname=None):
-    kwargs = config.get('db_conn_params') or {}
+    kwargs = dict(config.get('db_conn_params') or {})
     if dbname:
         kwargs['db'] = dbname
 
@@ -0,0 +1,73 @@
+"""
+Tests of Normalizer. Run with
+
+    $ python -m unittest discover
+"""
+
+import unittest
+
+from Normalizer import Normalizer
+
+reserved_words = set(['SELECT', 'FROM', 'WHERE', 'AND', 'IN', 'INSERT', 'IGNORE', 'INTO', 'VALUES'])
+
+
+class NormalizerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.normalizer = Normalizer(reserved_words)
+
+    def normalize(self, query):
+        return self.normalizer.normalize(query)
+
+    def test_literals(self):
+        cleaned, query_type, template, vals = self.normalize(
+            "select  a from t where b = 'it''s' and c=\"x\" and d = 1.5e3")
+        self.assertEqual(cleaned, "SELECT a FROM t WHERE b = 'it''s' AND c=\"x\" AND d = 1.5e3")
+        self.assertEqual(query_type, 'SELECT')
+        self.assertEqual(template, "SELECT a FROM t WHERE b = ? AND c=? AND d = ?")
+        self.assertEqual(vals, ["'it''s'", '"x"', '1.5e3'])
+
+    def test_numbers_in_names(self):
+        template, vals = self.normalize("select t1.a from db.t2 join 2010_04 on x = 3")[2:]
+        self.assertEqual(template, "SELECT t1.a FROM db.t2 join 2010_04 on x = ?")
+        self.assertEqual(vals, ['3'])
+
+    def test_numlist_length(self):
+        cleaned, query_type, template, vals = self.normalize(
+            "select a from t where x in (1,2,3,4,5,6,7,8,9,10,11,12)")
+        self.assertEqual(template, "SELECT a FROM t WHERE x IN <numlist len=12>")
+        self.assertEqual(vals, [])
+
+    def test_quoted_numlist(self):
+        template, vals = self.normalize("select a from t where x in ('a', 'b,c', 'd') and y = 2")[2:]
+        self.assertEqual(template, "SELECT a FROM t WHERE x IN <numlist len=3> AND y = ?")
+        self.assertEqual(vals, ['2'])
+
+    def test_negative_numbers(self):
+        template, vals = self.normalize("select a from t where ra > -3.2e5 and b=-1 and c in (-2)")[2:]
+        self.assertEqual(template, "SELECT a FROM t WHERE ra > ? AND b=? AND c IN (?)")
+        self.assertEqual(vals, ['-3.2e5', '-1', '-2'])
+
+    def test_subtraction(self):
+        template, vals = self.normalize("select a - 3, b-4 from t")[2:]
+        self.assertEqual(template, "SELECT a - ?, b-? FROM t")
+        self.assertEqual(vals, ['3', '4'])
+
+    def test_insert_values(self):
+        for table in ('t', '`t`', 'db.t', '`db`.`t`', '`db`.t'):
+            cleaned, query_type, template, vals = self.normalize(
+                "insert ignore into {0} (a, b) values (1, 'x'), (2, 'y')".format(table))
+            self.assertEqual(query_type, 'INSERT')
+            self.assertEqual(template, 'INSERT INTO {0} <values>'.format(table))
+            self.assertEqual(vals, [])
+            self.assertEqual(cleaned, "INSERT IGNORE INTO {0} (a, b) values (1, 'x'), (2, 'y')".format(table))
+
+    def test_insert_select(self):
+        query_type, template, vals = self.normalize("insert into t select a from u where b = 5")[1:]
+        self.assertEqual(query_type, 'INSERT')
+        self.assertEqual(template, "INSERT INTO t SELECT a FROM u WHERE b = ?")
+        self.assertEqual(vals, ['5'])
+
+
+if __name__ == '__main__':
+    unittest.main()
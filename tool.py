@@ -1,15 +1,20 @@
 from GUI import Application, Window, ScrollableView, CheckBox, Frame, \
-TextField, RadioButton, RadioGroup, Button, Image, Label
+TextField, RadioButton, RadioGroup, Button, Label, Task
 
-from myutils import querytypes, clean_list, print_and_execute, get_conn, config
-from Filter import Filter, query_profile, gnuplot, SearchStringList
+from myutils import querytypes, clean_list, print_and_execute, config
+from Filter import Filter, PartitionLayout, load_cube, load_query_counts, approximate_topqueries, \
+     with_query_texts, gnuplot, SearchStringList
 from MyComponents import TopqueryPanel, TopqueryLabel, GraphView, \
 ResponsiveTextField
+from Dimensions import DimensionCache
+from QueryWorker import QueryWorker, Cancelled
+from Plotter import Plotter, LazyPlots
 
 import os
 import sys
 from datetime import datetime
-from glob import glob
+from collections import defaultdict
+from fnmatch import fnmatch
 
 DATEFORMAT = "%m/%d/%Y"
 
@@ -31,15 +36,28 @@ class Tool(Application):
         self.window = Window(size = (1200, 750), title = "Log Analysis Tool")
         print >>sys.stderr, "made window"
 
-        # Create db cursor
-        db = get_conn(dbname = 'reduced_log')
-        self.cur = db.cursor()
+        # Create the worker that runs the queries, and its db cursor. The
+        # cursor is only used by the worker's jobs, once it is started
+        self.worker = QueryWorker('reduced_log')
+        self.cur = self.worker.cur
         print >>sys.stderr, "made db cursor"
 
+        # User and server names and ids
+        self.dims = DimensionCache(self.cur)
+
         self.current_table_suffix = None
+
+        # The filters applied to unified to get the current table, and the next
+        self.table_filters = []
+        self.next_table_filters = []
+
+        # Where each month of the unified data is, read again for every
+        # new table, as --unify may have been run since
+        self.layout = None
         
         # Load the dummy image for now
-        self.image = GraphView(size = (640, 460), position = (10, 10))
+        self.image = GraphView(size = (640, 460), position = (10, 10),
+                               cache_size = config.get('image_cache') or 20)
         self.graph_panel = Frame()
         self.graph_panel.add(self.image)
         print >>sys.stderr, "loaded dummy image"
@@ -50,6 +68,11 @@ class Tool(Application):
         self.peruser_divided_total_ = None
         self.peruser_divided_ = None
 
+        # The LazyPlots shown, and the last made by the worker (which
+        # may not be shown yet)
+        self.shown_plots = None
+        self.plots = None
+
         # Create the display selection radio
         self.display_select_radiogroup = RadioGroup(action = 
                                                     self.change_images)
@@ -88,9 +111,18 @@ class Tool(Application):
         self.window.place(topqueries_prev_button, left = 830, top = top - 50)
         print >>sys.stderr, "made top queries text box"
 
-        # Declare the filter and last updated filter pointers
+        # Declare the filter, and what was last asked for and last shown
+        # (see request())
         self.fil = None
-        self.last_used_fil = None
+        self.last_request = None
+        self.shown_request = None
+
+        # The filter the next table was made with, and the counts of its
+        # rows (see CountCube.py). Filters it covers (see Filter.covers())
+        # are answered from these counts, without a new table
+        self.table_fil = None
+        self.cube = None
+        self.query_counts = None
         
         #
         # *************************
@@ -138,7 +170,6 @@ class Tool(Application):
                            group = self.time_division_radiogroup,
                            value = 'year')
         self.time_division_radiogroup.value = 'day'
-        self.last_grouped_by = None
 
         # Add all to date panel
         self.date_panel.add([self.begin_date_field, self.end_date_field])
@@ -197,12 +228,7 @@ class Tool(Application):
         # **CREATE USER AND SERVER CHECKBOX LISTS**
         self.user_panel = None
         self.server_panel = None
-        self.create_checkbox_lists(initial=True)
-
-        self.cur.execute("SELECT user, userid FROM users")
-        self.userids = dict(self.cur.fetchall())
-        self.cur.execute("SELECT server, serverid FROM servers")
-        self.serverids = dict(self.cur.fetchall())
+        self.create_checkbox_lists(*self.checkbox_counts('unified', initial=True), initial=True)
 
         print >>sys.stderr, "made user, server cboxes"
 
@@ -319,47 +345,50 @@ class Tool(Application):
 
         # **CREATE BUTTONS**
         self.negate = CheckBox("Negate Filter", position=(0, 0), value=False)
+        # Count top queries with sketches: fast, but approximate. Uncheck
+        # and refresh for exact counts
+        self.approximate = CheckBox("Approximate Top Queries", position=(0, 95), value=False)
         self.refresh_button = Button("Refresh",
                                      position = (0, 25),
                                      action=self.refresh)
         self.update_button = Button("Update",
                                     position = (0, 60),
                                     action = self.update)
+        self.cancel_button = Button("Cancel",
+                                    position = (0, 125),
+                                    action = self.cancel)
+        # What the worker is doing, or why the last refresh/update failed
+        self.status_label = Label("", position = (0, 160), width = 250)
+        self.message = ''
     
         # Add buttons to a panel
         self.button_panel = Frame()
         self.button_panel.add([self.negate,
+                               self.approximate,
                                self.refresh_button,
-                               self.update_button])
+                               self.update_button,
+                               self.cancel_button,
+                               self.status_label])
         self.window.place(self.button_panel, top = top,
                           left=self.search_string_panel + horiz_sp)
         print >>sys.stderr, "made button panel"
 
+        # The gnuplot processes the worker plots with
+        self.plotter = Plotter(config.get('plot_processes'))
 
-    def create_checkbox_lists(self, initial=False):
-        """
-        Removes the current user and server checkbox panels from the window,
-        if they exist (if they don't, they will be None, from __init__())
-        creates new ones with data from the current table, then adds them
-        to the window again. If @initial is True, only the last partition
-        (month) of the 'unified' table will be used for counts, but all
-        users and servers will still be shown
+        # Start the worker, and check on it a few times a second
+        self.worker.start()
+        self.poll_task = Task(self.poll_worker, 0.25, repeat = True)
 
-        @initial - if this is the first time the checkbox lists are being
-                   generated, it works a bit differently: the counts are
-                   taken from just the last partition of the unified table
-                   so that startup doesn't take forever. We then also need
-                   to grab the names of other users who didn't appear in
-                   this first partition
-        """
 
-        # Remove current user and server checkbox panels from the window
-        if self.user_panel:
-            self.window.remove(self.user_panel)
-        if self.server_panel:
-            self.window.remove(self.server_panel)
+    def checkbox_counts(self, table, initial=False):
+        """
+        Returns lists of (id, name, count) of the users and of the servers
+        in @table, most rows first, for create_checkbox_lists(). If
+        @initial, counts only the last partition (month) of the 'unified'
+        table, so that startup doesn't take forever
+        """
 
-        # Create user filter checkboxes
         if initial:
             print_and_execute("""SELECT PARTITION_NAME
                                  FROM INFORMATION_SCHEMA.PARTITIONS
@@ -370,17 +399,44 @@ class Tool(Application):
             last_partition = [x for x, in self.cur.fetchall()][-2]
             table_to_use = "unified PARTITION({0})".format(last_partition)
         else:
-            table_to_use = self.current_table_name()
+            table_to_use = table
 
-        print_and_execute("""SELECT userid, user, count
-                             FROM (SELECT userid, COUNT(*) AS count
-                                   FROM {0} GROUP BY userid
-                                  ) AS sth
-                               NATURAL JOIN users
+        print_and_execute("""SELECT userid, COUNT(*) AS count
+                             FROM {0} GROUP BY userid
                              ORDER BY count DESC
                           """.format(table_to_use), self.cur)
-        userlist = [x for x in self.cur.fetchall()]
+        userlist = [(userid, self.dims.user_names[userid], count)
+                    for userid, count in self.cur.fetchall() if userid in self.dims.user_names]
+
+        print_and_execute("""SELECT serverid, COUNT(*) AS count
+                             FROM {0} GROUP BY serverid
+                             ORDER BY count DESC
+                         """.format(table_to_use), self.cur)
+        serverlist = [(serverid, self.dims.server_names[serverid], count)
+                      for serverid, count in self.cur.fetchall() if serverid in self.dims.server_names]
+        return userlist, serverlist
+
+    def create_checkbox_lists(self, userlist, serverlist, initial=False):
+        """
+        Removes the current user and server checkbox panels from the window,
+        if they exist (if they don't, they will be None, from __init__())
+        creates new ones for @userlist and @serverlist (see
+        checkbox_counts()), then adds them to the window again.
+
+        @initial - if this is the first time the checkbox lists are being
+                   generated, the counts are taken from just the last
+                   partition of the unified table, so we then also need
+                   to grab the names of other users who didn't appear in
+                   this first partition
+        """
+
+        # Remove current user and server checkbox panels from the window
+        if self.user_panel:
+            self.window.remove(self.user_panel)
+        if self.server_panel:
+            self.window.remove(self.server_panel)
 
+        # Create user filter checkboxes
         x_pos = 0
         y_pos = 0
         y_spacing = 20
@@ -397,8 +453,7 @@ class Tool(Application):
 
         # Get users that didn't appear in the last partition, if @initial
         if initial:
-            self.cur.execute("SELECT user, userid FROM users")
-            for user, userid in self.cur.fetchall():
+            for user in self.dims.users:
                 if user in self.user_checkboxes:
                     continue
                 self.user_checkboxes[user] = CheckBox(user.replace('_', '_ ') + " (0)",
@@ -419,15 +474,6 @@ class Tool(Application):
                           left = self.query_type_panel + horiz_sp)
 
         # Create server filter checkboxes
-        print_and_execute("""SELECT serverid, server, count
-                             FROM (SELECT serverid, COUNT(*) AS count
-                                   FROM {0} GROUP BY serverid
-                                  ) as sth
-                               NATURAL JOIN servers
-                             ORDER BY count DESC
-                         """.format(table_to_use), self.cur)
-        serverlist = [x for x in self.cur.fetchall()]
-
         x_pos = 0
         y_pos = 0
         y_spacing = 20
@@ -443,8 +489,7 @@ class Tool(Application):
             y_pos += y_spacing
 
         if initial:
-            self.cur.execute("SELECT server FROM servers")
-            for server, in self.cur.fetchall():
+            for server in self.dims.servers:
                 if server in self.server_checkboxes:
                     continue
                 self.server_checkboxes[server] = CheckBox(server.replace('_', '_ ') + " (0)",
@@ -486,13 +531,13 @@ class Tool(Application):
             daterange = None
 
         # User
-        user = [self.userids[u] for u, cb in self.user_checkboxes.iteritems() \
+        user = [self.dims.users[u] for u, cb in self.user_checkboxes.iteritems() \
                 if cb.value]
         if len(user) == len(self.user_checkboxes): #all users selected
             user = None
 
         # Server
-        server = [self.serverids[s] for s, cb in self.server_checkboxes.iteritems() \
+        server = [self.dims.servers[s] for s, cb in self.server_checkboxes.iteritems() \
                   if cb.value]
         if len(server) == len(self.server_checkboxes):
             server = None
@@ -518,6 +563,55 @@ class Tool(Application):
                           negate = self.negate.value)
 
 
+    def request(self):
+        """
+        Returns what the GUI asks to be shown: the filter, the time
+        grouping and whether to count top queries approximately
+        """
+        return self.fil, self.time_division_radiogroup.value, self.approximate.value
+
+    def run_job(self, request, job, done):
+        """
+        Cancel what the worker is doing, and run @job() on it to get what
+        @request asks for. @done(result) is called from this thread once
+        it is done
+        """
+
+        self.worker.cancel()
+        self.last_request = request
+        self.message = ''
+
+        def finished(result, error):
+            if error is None:
+                done(result)
+                self.shown_request = request
+            elif request == self.last_request:
+                # Nothing newer was asked for, so say why it isn't shown
+                self.last_request = self.shown_request
+                self.message = str(error) if isinstance(error, Cancelled) else \
+                    "Failed: {0}".format(error)
+        self.worker.submit(lambda cur: job(*request), finished)
+
+    def poll_worker(self):
+        """
+        Called by self.poll_task: shows the results of the jobs done, and
+        what the worker is doing
+        """
+        self.worker.poll()
+        plots = self.shown_plots
+        if plots and plots.take_changed():
+            failures = plots.take_failures()
+            if failures:
+                self.message = "{0} of the plots failed: {1}".format(
+                    len(failures), ', '.join(os.path.basename(images[0]) for images, error in failures))
+            self.image.invalidate()
+        status = self.worker.status() or self.message
+        if self.status_label.text != status:
+            self.status_label.text = status
+
+    def cancel(self):
+        self.worker.cancel()
+
     def refresh(self):
         """
         Regenerate the graphs/top query lists without changing the table that
@@ -526,71 +620,132 @@ class Tool(Application):
         # Get the status of GUI elements
         self.get_new_filter()
 
-        # Don't repeat the query if self.filter hasn't changed since the last
-        # update
-        if self.fil != self.last_used_fil:
-            self.create_new_temp_table()
-            self.create_new_graphs_and_topqueries()
-        elif self.last_grouped_by != self.time_division_radiogroup.value:
-            self.create_new_graphs_and_topqueries()
-            
+        # Don't repeat the query if what is asked for is shown, or being
+        # worked on already
+        request = self.request()
+        if request != self.last_request:
+            self.run_job(request, self.profile_job, self.show_profiles)
 
-    def create_new_temp_table(self):
+    def profile_job(self, fil, period, approximate):
+        """
+        Makes the graphs and the top query lists for @fil, @period and
+        @approximate (see request()), in the worker. Doesn't make a new
+        table if the counts of the last one will do
+        """
+
+        if not (self.table_fil and self.table_fil.covers(fil)):
+            self.create_new_temp_table(fil)
+        return self.create_new_graphs_and_topqueries(fil, period, approximate)
+
+    def create_new_temp_table(self, fil):
         # Create a temp table
         lasttable = self.current_table_name()
         nexttable = self.next_table_name()
 
         # Create main table
+        self.worker.progress = "Selecting the data"
+        self.table_fil = None
         self.cur.execute("DROP TABLE IF EXISTS {0}".format(nexttable))
+        self.layout = PartitionLayout(self.cur)
         print_and_execute("CREATE TEMPORARY TABLE {0} AS {1}".format(nexttable,
-                                                                     self.fil.sql(lasttable)),
+                                                                     fil.sql(lasttable, layout = self.layout)),
                           self.cur)
+        self.worker.progress = "Indexing the data"
         print_and_execute("ALTER TABLE {0} ADD INDEX (userid)".format(nexttable), self.cur)
         print_and_execute("ALTER TABLE {0} ADD INDEX (serverid)".format(nexttable), self.cur)
 
-        self.last_used_fil = self.fil
+        self.table_fil = fil
+        self.cube = None
+        self.query_counts = None
+        self.next_table_filters = self.table_filters + [fil]
 
-    def create_new_graphs_and_topqueries(self):
-        prefix = config.get('plot_dir') or 'plots'
-        current_dir = os.getcwd()
+    def topquery_profile(self, fil, approximate, numtop):
+        """
+        Returns the top queries of all users and of each user that @fil
+        selects, and how far under the true counts they may be (see
+        Filter.query_profile()). They are counted from self.query_counts
+        if @fil has the date range the next table was made with;
+        otherwise, and if counting @approximate-ly, the next table is
+        read again
+        """
 
-        # Get profiles of the created table
         nexttable = self.next_table_name()
-        
-        profiles = query_profile(nexttable,
-                                 config.get("numtop") or 200,
-                                 self.time_division_radiogroup.value,
-                                 self.cur)
-        peruser_divided, peruser_alltime, full_divided, full_alltime, full_topqueries, peruser_topqueries = profiles
-
-        # Remove previous plotted data
-        if os.path.exists(prefix):
-            os.system("rm -r {0}".format(prefix))
-        os.mkdir(prefix)
-        os.chdir(prefix)
-        gnuplot(profiles, time_axis_label=self.time_division_radiogroup.value)
-        # use a for loop so that gnuplot settings don't stick around between scripts
-        os.system("for x in *.gnu; do gnuplot $x; done")
-
-        # Load the new image lists
-        self.full_ = [Image(file=x) for x in glob('full_*.png')]
-        self.peruser_alltime_ = [Image(file=x) for x in \
-                                 glob('peruser_alltime_*.png')]
-        self.peruser_divided_ = [Image(file=x) for x in \
-                                 glob('peruser_divided_*.png') if '_total_' not in x]
-        self.peruser_divided_total_ = [Image(file=x) for x in \
-                                       glob('peruser_divided_total_*.png')]
-        
-        os.chdir(current_dir)
+        selection = fil.counts_selection()
+        if approximate:
+            where = Filter(daterange = fil.daterange, user = fil.user,
+                           query_type = fil.query_type).where()
+            return approximate_topqueries(nexttable, numtop, self.cur, where)
+
+        if fil.daterange != self.table_fil.daterange:
+            counts = load_query_counts(nexttable, self.cur,
+                                       Filter(daterange = fil.daterange).where())
+        else:
+            if self.query_counts is None:
+                self.query_counts = load_query_counts(nexttable, self.cur)
+            counts = self.query_counts
+        counts = counts.select(selection['users'], selection['query_types'])
+        return counts.top(numtop, self.dims.user_names) + (defaultdict(int),)
+
+    def create_new_graphs_and_topqueries(self, fil, period, approximate):
+        """
+        Makes the plots of the data @fil selects of the next table, by
+        @period, in the worker. Returns the top query lists and the
+        LazyPlots, which renders each into the plot_dir once it is shown,
+        for show_profiles()
+        """
+        prefix = config.get('plot_dir') or 'plots'
 
-        # Set self.image.images = whatever's selected in the radio
-        # (we got new lists)
+        # Get profiles of the created table, from its counts by hour (loaded
+        # once for each table)
+        self.worker.progress = "Counting queries"
+        if self.cube is None:
+            self.dims.load()
+            self.cube = load_cube(self.next_table_name(), self.cur,
+                                  filters = self.next_table_filters, layout = self.layout)
+        profiles = self.cube.select(**fil.counts_selection()).profiles(period, self.dims.user_names)
+        self.worker.progress = "Counting top queries"
+        topqueries = with_query_texts(*self.topquery_profile(fil, approximate,
+                                                             config.get("numtop") or 200),
+                                      cur = self.cur)
+
+        # Each plot (or few) is a job of its own, rendered when first
+        # shown. The images are overwritten, so the last plots must stop
+        # rendering first
+        self.worker.check()
+        if not os.path.exists(prefix):
+            os.mkdir(prefix)
+        jobs = gnuplot(profiles, time_axis_label=period, directory=prefix)
+        if self.plots:
+            self.plots.close()
+        self.plots = LazyPlots(self.plotter, jobs)
+        images = [image for images, commands in jobs for image in images]
+        return topqueries, self.plots, images
+
+    def show_profiles(self, result):
+        """
+        Shows the graphs and top queries made by
+        create_new_graphs_and_topqueries(), which returned @result
+        """
+        topqueries, plots, images = result
+        full_topqueries, peruser_topqueries, topquery_errors = topqueries
+        self.shown_plots = plots
+
+        # The new image lists (of files, rendered and loaded by self.image
+        # as they are shown)
+        names = [os.path.basename(x) for x in images]
+        self.full_ = [x for x, name in zip(images, names) if fnmatch(name, 'full_*.png')]
+        self.peruser_alltime_ = [x for x, name in zip(images, names) \
+                                 if fnmatch(name, 'peruser_alltime_*.png')]
+        self.peruser_divided_ = [x for x, name in zip(images, names) \
+                                 if fnmatch(name, 'peruser_divided_*.png') and '_total_' not in name]
+        self.peruser_divided_total_ = [x for x, name in zip(images, names) \
+                                       if fnmatch(name, 'peruser_divided_total_*.png')]
+
+        # Show whatever's selected in the radio (we got new lists)
         self.change_images()
 
         # Generate the new topquery panel text
-        self.topqueries.new_profiles(full_topqueries, peruser_topqueries)
-
-        self.last_grouped_by = self.time_division_radiogroup.value
+        self.topqueries.new_profiles(full_topqueries, peruser_topqueries, topquery_errors)
 
 
     def update(self):
@@ -600,15 +755,44 @@ class Tool(Application):
         checkboxes.
         """
 
-        self.refresh()
+        self.get_new_filter()
+        request = self.request()
+        reprofile = request != self.shown_request
+        self.run_job(request,
+                     lambda *request: self.update_job(reprofile, *request),
+                     self.show_update)
+
+    def update_job(self, reprofile, fil, period, approximate):
+        """
+        The worker's part of update(). Makes the graphs and top query lists
+        only if @reprofile
+        """
+
+        profiles = self.profile_job(fil, period, approximate) if reprofile else None
+        if self.table_fil != fil:
+            # What's shown was counted from the last table
+            self.create_new_temp_table(fil)
+
+        self.worker.progress = "Counting users and servers"
+        lists = self.checkbox_counts(self.next_table_name())
 
         if self.current_table_suffix:
             self.current_table_suffix += 1
         else:
             self.current_table_suffix = 1
+        self.table_filters = self.next_table_filters
+        self.table_fil = None
+        self.cube = None
+        self.query_counts = None
+        return profiles, lists
+
+    def show_update(self, result):
+        profiles, lists = result
+        if profiles:
+            self.show_profiles(profiles)
         
         # update lists of checkboxes
-        self.create_checkbox_lists()
+        self.create_checkbox_lists(*lists)
         
         # reset status of GUI elements that weren't just recreated
         # self.begin_date_field.text = DEFAULT_BEGIN_DATE_TEXT
@@ -621,22 +805,21 @@ class Tool(Application):
 
     def change_images(self):
         string = self.display_select_radiogroup.value
+        images = None
         if string == 'all_users':
-            self.image.images = self.full_
+            images = self.full_
         elif string == 'peruser_querytype':
-            self.image.images = self.peruser_alltime_
+            images = self.peruser_alltime_
         elif string == 'peruser_time':
-            self.image.images = self.peruser_divided_total_
+            images = self.peruser_divided_total_
         elif string == 'peruser_querytype_time':
-            self.image.images = self.peruser_divided_
+            images = self.peruser_divided_
         else:
             print >>sys.stderr, "Unrecognized display_select_radiogroup value %s" % string
         
-        if not self.image.images:
-            print >>sys.stderr, "image list assigned to self.image.images is None, using dummy"
-            self.image.images = GraphView.DUMMY_IMLIST
-        self.image.im_num = 0
-        self.image.invalidate()
+        if not images:
+            print >>sys.stderr, "image list to show is empty, using dummy"
+        self.image.show(images, self.shown_plots)
 
     def current_table_name(self):
         """